@@ -87,13 +87,17 @@ get_Flair = LocalGetRefSeriesOperator_modded(
      ]
 )
 
+# Format of the label maps and masks handed off between the containers: None (each container's own format), "nii.gz",
+# or uncompressed "nii"/"nrrd" (no gzip at each hop, memory-mapped by the readers)
+intermediate_format = None
+
 convert_T1 = DcmConverterOperator(dag=dag, input_operator=get_T1,output_format='nii.gz',task_id="T1_to_nii")
 convert_Flair = DcmConverterOperator(dag=dag, input_operator=get_Flair, output_format='nii.gz',task_id="Flair_to_nii")
 
-dlicv = DLICVOperator(dag=dag, priority_weight=10000, input_operator=convert_T1, modeldir="/models/DLICV", batch_size=4,task_id="skull_stripping_dlicv")
+dlicv = DLICVOperator(dag=dag, priority_weight=10000, input_operator=convert_T1, modeldir="/models/DLICV", batch_size=4, intermediate_format=intermediate_format,task_id="skull_stripping_dlicv")
 wmls = DLICVOperator(dag=dag, priority_weight=1,input_operator=convert_Flair, modeldir="/models/WMLS", batch_size=4,task_id="wmls")
 applymask_run_muse = MuseOperator(dag=dag, input_operator=convert_T1,mask_operator=dlicv,batch_size=4,task_id="muse-roi-segmentation")
-merge_labels = CombineLabelsOperator(dag=dag,input_operator=applymask_run_muse,task_id="merge-rois")
+merge_labels = CombineLabelsOperator(dag=dag,input_operator=applymask_run_muse,label_transforms="combine:/MUSE_Kapaana_DerivedRegions_v3.csv",intermediate_format=intermediate_format,task_id="merge-rois")
 
 extract_metadata_T1 = LocalDcm2JsonOperator(dag=dag, input_operator=get_T1, delete_private_tags=True,task_id="GetT1Metadata")
 extract_metadata_Flair = LocalDcm2JsonOperator(dag=dag, input_operator=get_Flair, delete_private_tags=True,task_id="GetFlairMetadata")
@@ -8,6 +8,8 @@ class CombineLabelsOperator(KaapanaBaseOperator):
 
     def __init__(self,
                  dag,
+                 label_transforms="combine:/MUSE_Kapaana_DerivedRegions_v3.csv",
+                 intermediate_format=None,
                  env_vars=None,
                  execution_timeout=execution_timeout,
                  *args, **kwargs
@@ -16,6 +18,13 @@ class CombineLabelsOperator(KaapanaBaseOperator):
         if env_vars is None:
             env_vars = {}
 
+        envs = {
+            "LABEL_TRANSFORMS": str(label_transforms), # ordered label transforms run in one read/write, e.g. "relabel:<csv>;combine:<csv>;reorient:LPS"
+            "OPERATOR_EXTENSION": ".nrrd" if intermediate_format is None else "None",
+            "INTERMEDIATE_FORMAT": str(intermediate_format) # format of the label map written: None (nrrd), "nii.gz", "nii" or "nrrd"
+        }
+        env_vars.update(envs)
+
         pod_resources = PodResources(request_memory=None, request_cpu=None, limit_memory=None, limit_cpu=None, limit_gpu=None)
 
         super().__init__(
@@ -11,6 +11,7 @@ class DLICVOperator(KaapanaBaseOperator):
                  mask_operator=None,
                  batch_size=None,
                  modeldir=None,
+                 intermediate_format=None,
                  env_vars=None,
                  execution_timeout=execution_timeout,
                  *args, **kwargs
@@ -21,7 +22,8 @@ class DLICVOperator(KaapanaBaseOperator):
 
         envs = {
             "MODEL_DIR":str(modeldir),
-            "BATCH_SIZE":  str(batch_size)
+            "BATCH_SIZE":  str(batch_size),
+            "INTERMEDIATE_FORMAT": str(intermediate_format) # format of the mask written: None (nrrd), "nii.gz", "nii" or "nrrd"
         }
         env_vars.update(envs)
 
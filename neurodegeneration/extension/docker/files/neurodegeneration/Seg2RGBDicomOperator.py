@@ -17,6 +17,9 @@ class Seg2RGBDicomOperator(KaapanaBaseOperator):
                  color_csv_path=None,
                  opacity=0.5,
                  modality=None,
+                 write_workers=0,
+                 output_mode="slices",
+                 compression=None,
                  env_vars=None,
                  execution_timeout=execution_timeout,
                  *args, **kwargs
@@ -31,6 +34,9 @@ class Seg2RGBDicomOperator(KaapanaBaseOperator):
             "MODALITY": str(modality),
             "OPACITY": str(opacity),
             "COLOR_SCHEME": str(color_csv_path),
+            "WRITE_WORKERS": str(write_workers), # processes writing the dicom slices, 0: all cores
+            "OUTPUT_MODE": str(output_mode), # "slices": one dicom file per slice, "multiframe": one multi-frame dicom file
+            "COMPRESSION": str(compression), # lossless compression of the dicom files: None, "JPEG", "JPEG2000" or "RLE"
             "OPERATOR_IN_MASK_DIR":  ("None" if mask_operator is None else mask_operator.operator_out_dir), # directory that contains segmented mask object
             "OPERATOR_IN_DCM_JSON_DIR": dicom_metadata_json.operator_out_dir, # directory that contains input dicom metadata in json format
             "OPERATOR_IN_REFERENCE_IMAGE_DIR": ("None" if ref_image is None else ref_image.operator_out_dir) # directory that contains input reference dicom on which we want to overlay the mask
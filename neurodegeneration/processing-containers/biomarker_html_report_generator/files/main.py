@@ -5,7 +5,7 @@ import pandas as pd
 from roi_quantifier.roi_quantifier import roi_quantifier_main
 from spare_calculator.spare_calculator import spare_main
 from normative_biomarker_visualizer.normative_biomarker_visualizer import biomarker_main
-from brainvisualize.vtkBrainVisual import _main as brainvisual_main
+from brainvisualize.vtkBrainVisual import _main as brainvisual_main, has_label_cache
 from csv_extraction.csv_extraction import _main as csv_main
 from html_generator.html_generator import _main as html_main
 
@@ -68,7 +68,11 @@ def main(muse_roi, dlicv_mask, wmls_mask, dcm_json):
     ############################ Brain Visualize ########################################################
     
     #brainvisual_main(muse_roi[0], allz_num, tmp_file_path)
-    brainvisual_main('../refs/20181205_124179_T1_LPS_muse_relabeled.nii.gz', allz_num, tmp_file_path)
+    # Same template label map for every subject: its views are rendered once at the image build (Dockerfile) and only
+    # recolored per subject. Without the built cache, the template is ray cast (default mode) rather than cached in
+    # this (ephemeral) pod.
+    brain_template = '../refs/20181205_124179_T1_LPS_muse_relabeled.nii.gz'
+    brainvisual_main(brain_template, allz_num, tmp_file_path, mode='labelcache' if has_label_cache(brain_template) else None)
 
     print('BRAIN DONE !')
 
@@ -0,0 +1,137 @@
+import re
+import json
+
+#### Index of the DICOM metadata json files (LocalDcm2JsonOperator) ###
+# Keys are '<tag> <Keyword>_<type>', e.g. '00100020 PatientID_keyword', '00080020 StudyDate_date', and sequences are
+# nested objects, e.g. '00400275 RequestAttributesSequence_object_object': {'00080050 AccessionNumber_keyword': ...}.
+# The json is parsed once into an index: name -> values (in file order), each entry being indexed by
+#   tag            '00100020'
+#   keyword        'PatientID'
+#   keyword_type   'PatientID_keyword'
+# and the entries of sequences by their path: 'RequestAttributesSequence.AccessionNumber' (keyword or keyword_type).
+# With a list of names, the file is parsed incrementally and the parse stops when all names are found.
+
+# Size of the chunks read by the incremental parser #
+READ_CHUNK_SIZE = 1 << 16
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+################################################ FUNCTIONS ################################################
+
+### Function to normalize a tag: '0010|0020', '(0010,0020)' or '00100020' -> '00100020'
+def normalizeTag(tag):
+	return re.sub('[^0-9A-F]', '', tag.upper())
+
+### Function to split a key of the metadata json: '00100020 PatientID_keyword' -> ('00100020', 'PatientID', 'keyword')
+def splitKey(key):
+	tag, _, name = key.partition(' ')
+	if not name:
+		return None, key, ''
+	keyword, _, vtype = name.partition('_')
+	return normalizeTag(tag), keyword, vtype
+
+### Function to add one entry (and its nested entries) to the index
+def addEntry(index, key, value, prefix=''):
+	tag, keyword, vtype = splitKey(key)
+	names = [prefix + keyword]
+	if vtype:
+		names.append(prefix + keyword + '_' + vtype)
+	if tag and not prefix:
+		names.append(tag)
+	for name in names:
+		index.setdefault(name, []).append(value)
+
+	# Entries of sequences (one object or a list of objects)
+	items = value if isinstance(value, list) else [value]
+	for item in items:
+		if isinstance(item, dict):
+			for subkey, subvalue in item.items():
+				addEntry(index, subkey, subvalue, prefix + keyword + '.')
+
+	return tag
+
+### Function to index a parsed metadata json (dict)
+def indexDicomJson(data):
+	index = {}
+	for key, value in data.items():
+		addEntry(index, key, value)
+	return index
+
+### Function to iterate over the top-level (key, value) pairs of a json object file, reading it in chunks
+def iterJsonObject(f):
+	buf = f.read(READ_CHUNK_SIZE)
+	pos = _whitespace.match(buf).end()
+	if buf[pos:pos+1] != '{':
+		raise ValueError('Metadata json is not an object')
+	pos += 1
+	eof = False
+	while True:
+		# Next item: [,] "key" : value, or the end of the object
+		start = pos
+		try:
+			pos = _whitespace.match(buf, pos).end()
+			if buf[pos:pos+1] == '}':
+				return
+			if buf[pos:pos+1] == ',':
+				pos = _whitespace.match(buf, pos + 1).end()
+			key, pos = _decoder.raw_decode(buf, pos)
+			pos = _whitespace.match(buf, pos).end()
+			if buf[pos:pos+1] != ':':
+				raise json.JSONDecodeError('Expecting \':\' delimiter', buf, pos)
+			pos = _whitespace.match(buf, pos + 1).end()
+			value, end = _decoder.raw_decode(buf, pos)
+			# The value must be followed by a delimiter (a number may continue in the next chunk)
+			end = _whitespace.match(buf, end).end()
+			if buf[end:end+1] not in [',', '}']:
+				raise json.JSONDecodeError('Expecting \',\' delimiter', buf, end)
+		except (json.JSONDecodeError, IndexError):
+			if eof:
+				raise
+			# Item incomplete: keep it and read more (at least as much as kept, so that large items take few reads)
+			buf = buf[start:]
+			pos = 0
+			chunk = f.read(max(READ_CHUNK_SIZE, len(buf)))
+			eof = len(chunk) == 0
+			buf += chunk
+			continue
+
+		yield key, value
+		pos = end
+
+### Function to read a metadata json file into an index (see indexDicomJson)
+###   names: if given, the file is parsed incrementally and the parse stops once all names are found, after the last
+###   entry of their tags (the entries of a tag are adjacent, the keys being sorted by tag)
+def readDicomJson(jsonfile, names=None):
+	if names is None:
+		with open(jsonfile, 'r') as f:
+			return indexDicomJson(json.load(f))
+
+	index = {}
+	missing = set(names)
+	foundTags = set()
+	with open(jsonfile, 'r') as f:
+		for key, value in iterJsonObject(f):
+			tag = splitKey(key)[0]
+			if not missing and tag not in foundTags:
+				break
+			addEntry(index, key, value)
+			for name in [n for n in missing if len(getDicomValues(index, n)) > 0]:
+				missing.discard(name)
+				foundTags.add(tag)
+
+	return index
+
+### Function to get the first value of a name (tag, keyword, keyword_type or sequence path), default if not found
+def getDicomValue(index, name, default=None):
+	values = getDicomValues(index, name)
+	return values[0] if len(values) > 0 else default
+
+### Function to get all values of a name, in file order
+def getDicomValues(index, name):
+	if name in index:
+		return index[name]
+	tag = normalizeTag(name)
+	if len(tag) == 8 and tag in index:
+		return index[tag]
+	return []
@@ -1,12 +1,13 @@
 import pandas as pd
 import numpy as np
 import pickle
-import json
 import nibabel as nib
+import scipy.sparse as _sparse
 from datetime import datetime
 import csv as _csv
 import os as _os
 import copy
+from .dcmjson import readDicomJson, getDicomValues
 
 #### Hardcoded reference data ###
 # Harmonized reference MUSE values #
@@ -17,6 +18,8 @@ maphemi = pd.read_csv('/refs/MUSE_ROI_Dictionary.csv')
 MUSE_ROI_Mapping = '/refs/MUSE_DerivedROIs_Mappings.csv'
 # Harmonized reference WMLS values #
 WMLS_Ref_Values = '/refs/WMLS_combinedrefs.csv'
+# Largest label counted with np.bincount (bounds the size of the histogram), larger labels are counted with np.unique #
+BINCOUNT_MAX_LABEL = 65535
 
 ################################################ FUNCTIONS ################################################
 
@@ -34,28 +37,103 @@ def readSubjInfo(subjfile):
 				subDict = {rows[0]:rows[1] for rows in reader}
 	
 	if subjfile.endswith('.json'):
-		with open(subjfile, 'r') as read_file:
-			data = json.load(read_file)
-			
-			## WARNING: Trying to parse fields in a robust way
-			## This part is based on assumptions on dicom field names
-			## it should be tested carefully and updated for different patterns
-			subID = [value for key, value in data.items() if 'PatientID' in key][0]
-			
-			for key, value in data.items():
-				if ('PatientAge' in key) and ('Y' in str(value)):
-					print("Successfully identified patient age in JSON...")
-					subAge = float(str(value).replace('Y',''))
-					break
-
-			subSex = [value for key, value in data.items() if 'PatientSex' in key][0]
-			subExamDate = [value for key, value in data.items() if 'StudyDate_date' in key][0]
-			subExamDate = datetime.strptime(subExamDate, "%Y-%m-%d").strftime("%m/%d/%Y")
-			
-			subDict = {'MRID':subID, 'Age':subAge, 'Sex':subSex, "ExamDate":subExamDate}
+		## Single pass over the json, up to the last field needed
+		data = readDicomJson(subjfile, ['PatientID','PatientAge','PatientSex','StudyDate_date'])
+		## WARNING: Trying to parse fields in a robust way
+		## This part is based on assumptions on dicom field names
+		## it should be tested carefully and updated for different patterns
+		subID = getDicomValues(data, 'PatientID')[0]
+		
+		for value in getDicomValues(data, 'PatientAge'):
+			if 'Y' in str(value):
+				print("Successfully identified patient age in JSON...")
+				subAge = float(str(value).replace('Y',''))
+				break
+
+		subSex = getDicomValues(data, 'PatientSex')[0]
+		subExamDate = getDicomValues(data, 'StudyDate_date')[0]
+		subExamDate = datetime.strptime(subExamDate, "%Y-%m-%d").strftime("%m/%d/%Y")
+		
+		subDict = {'MRID':subID, 'Age':subAge, 'Sex':subSex, "ExamDate":subExamDate}
 
 	return subDict
 
+### Function to count the voxels of each label in a label/mask image
+###   The image is read in its stored type (no float64 copy) and labels are counted
+###   slice by slice with np.bincount instead of sorting the whole image with np.unique
+def calcLabelCounts(maskfile):
+
+	### Read the input image (proxy only)
+	roinii = nib.load(maskfile)
+	roiimg = np.asanyarray(roinii.dataobj)
+
+	### Get voxel dimensions
+	voxdims1, voxdims2, voxdims3 = roinii.header.get_zooms()[:3]
+	voxvol = float(voxdims1)*float(voxdims2)*float(voxdims3)
+
+	### Calculate label counts
+	if np.issubdtype(roiimg.dtype, np.integer) and roiimg.min() >= 0 and roiimg.max() <= BINCOUNT_MAX_LABEL:
+		maxLabel = int(roiimg.max())
+		Counts = np.zeros(maxLabel+1, dtype=np.int64)
+		# Slices along the last axis are contiguous in the (Fortran ordered) nifti array
+		for k in range(roiimg.shape[-1]):
+			Counts += np.bincount(roiimg[..., k].ravel(order='K'), minlength=maxLabel+1)
+		ROIs = np.nonzero(Counts)[0]
+		Counts = Counts[ROIs]
+	else:
+		# Non-integer, signed or very large labels, e.g. scaled or float images
+		ROIs, Counts = np.unique(roiimg, return_counts=True)
+
+	return ROIs, Counts, voxvol
+
+### Function to compile the single to derived ROI mapping into a sparse matrix
+###   Row i of the matrix adds up the single ROIs of the i-th derived ROI, so that derived
+###   volumes are a single product with a volume vector (one subject) or matrix (many subjects)
+###   The compiled mapping is cached per mapping file (and modification time)
+_derivedMappingCache = {}
+def readDerivedMapping(mapcsv):
+	cacheKey = (_os.path.abspath(mapcsv), _os.path.getmtime(mapcsv))
+	if cacheKey in _derivedMappingCache:
+		return _derivedMappingCache[cacheKey]
+
+	DerivedROIs = []
+	mapRows = []
+	mapCols = []
+	with open(mapcsv) as mapcsvfile:
+		reader = _csv.reader(mapcsvfile, delimiter=',')
+		# Read each line in the csv map files
+		for row in reader:
+			row = list(filter(lambda a: a != '', row))
+			# Append the ROI number to the list
+			roiInds = [int(x) for x in row[2:]]
+			mapRows.extend([len(DerivedROIs)] * len(roiInds))
+			mapCols.extend(roiInds)
+			DerivedROIs.append(row[0])
+
+	# Repeated single ROIs in a row are summed up, as with np.sum(VolumesInd[roiInds])
+	mapMat = _sparse.csr_matrix((np.ones(len(mapCols)), (mapRows, mapCols)), shape=(len(DerivedROIs), max(mapCols)+1))
+
+	_derivedMappingCache[cacheKey] = (DerivedROIs, mapMat)
+	return DerivedROIs, mapMat
+
+### Function to calculate derived ROI volumes from single ROI volumes indexed by ROI number
+###   VolumesInd is a vector (one subject) or a matrix with one row per subject
+def calcDerivedVolumes(VolumesInd, mapcsv):
+	DerivedROIs, mapMat = readDerivedMapping(mapcsv)
+
+	# Match the single ROI axis to the mapping (ROIs not in the image have zero volume)
+	VolumesInd = np.asarray(VolumesInd, dtype=np.float64)
+	numROIs = mapMat.shape[1]
+	if VolumesInd.shape[-1] < numROIs:
+		padding = [(0, 0)] * (VolumesInd.ndim - 1) + [(0, numROIs - VolumesInd.shape[-1])]
+		VolumesInd = np.pad(VolumesInd, padding)
+	else:
+		VolumesInd = VolumesInd[..., :numROIs]
+
+	DerivedVols = mapMat.dot(VolumesInd.T).T
+
+	return DerivedROIs, DerivedVols
+
 ### Function to calculate any mask volume
 def calcMaskVolume(maskfile):
 	
@@ -63,16 +141,11 @@ def calcMaskVolume(maskfile):
 	if not maskfile:
 		raise Exception('Input file not provided!!!')
 		
-	### Read the input image
-	roinii = nib.load(maskfile)
-	roiimg = roinii.get_fdata()
-
-	### Get voxel dimensions
-	voxdims1, voxdims2, voxdims3 = roinii.header.get_zooms()
-	voxvol = float(voxdims1)*float(voxdims2)*float(voxdims3)
+	### Count voxels of each label
+	ROIs, Counts, voxvol = calcLabelCounts(maskfile)
 
 	### Calculate mask volume
-	maskVol = voxvol * np.sum(roiimg.flatten()>0)
+	maskVol = voxvol * np.sum(Counts[ROIs > 0])
 	
 	return maskVol
 
@@ -83,40 +156,20 @@ def calcRoiVolumes(maskfile, mapcsv, dfRef, subDict, icvVol):
 	if not maskfile:
 		raise Exception('ERROR: Input file not provided!!!')
 
-	### Read the input image
-	roinii = nib.load(maskfile)
-	roiimg = roinii.get_fdata()
-
-	### Get voxel dimensions
-	voxdims1, voxdims2, voxdims3 = roinii.header.get_zooms()
-	voxvol = float(voxdims1)*float(voxdims2)*float(voxdims3)
-
 	### Calculate ROI count and volume
-	ROIs, Counts = np.unique(roiimg, return_counts=True)
+	ROIs, Counts, voxvol = calcLabelCounts(maskfile)
 	ROIs = ROIs.astype(int)
 	Volumes = voxvol * Counts
 
 	### Create an array indexed from 0 to max ROI index
 	###   This array will speed up calculations for calculating derived ROIs
-	###   Instead of adding ROIs in a loop, they are added at once using: 
-	###          np.sum(all indexes for a derived ROI)  (see below)
+	###   Instead of adding ROIs in a loop, all derived ROIs are added at once using
+	###          the sparse single to derived ROI matrix (see readDerivedMapping)
 	VolumesInd = np.zeros(ROIs.max()+1)
 	VolumesInd[ROIs] = Volumes
 	
 	### Calculate derived volumes
-	DerivedROIs = []
-	DerivedVols = []
-	ROIlist = []
-	Vollist = []
-	with open(mapcsv) as mapcsvfile:
-		reader = _csv.reader(mapcsvfile, delimiter=',')
-		# Read each line in the csv map files
-		for row in reader:
-			row = list(filter(lambda a: a != '', row))
-			# Append the ROI number to the list
-			DerivedROIs.append(row[0])
-			roiInds = [int(x) for x in row[2:]]
-			DerivedVols.append(np.sum(VolumesInd[roiInds]))
+	DerivedROIs, DerivedVols = calcDerivedVolumes(VolumesInd, mapcsv)
 
 	### Declare objects we want to store
 	all_MuseROIs =  dict(zip(DerivedROIs, DerivedVols))
@@ -1,46 +1,51 @@
 import pandas as pd
 import numpy as np
 import spare_scores as spare
+from spare_scores.util import load_model
 import pickle
 import os as _os
 import shutil
 
+#### Trained spare_scores models ###
+SPARE_AD_Model = '/refs/kaapana_spareAD.pkl.gz'
+SPARE_BA_Model = '/refs/kaapana_spareBA_cpu.pkl.gz'
+
+# Models loaded in this process (decompressed and unpickled once) #
+_spareModels = {}
+
+### Function to load a spare_scores model and its meta data, once per process
+def loadSpareModel(mdl_path):
+	if mdl_path not in _spareModels:
+		_spareModels[mdl_path] = load_model(mdl_path)
+
+	return _spareModels[mdl_path]
+
+### Function to calculate SPARE scores of all subjects (rows) in df, in memory (no output csv)
+def spareScores(df, mdl_path, spare_var, key_var='MRID'):
+	res = spare.spare_test(df = df,
+                           mdl_path    = loadSpareModel(mdl_path),
+                           key_var     = key_var,
+                           output      = '',
+                           spare_var   = spare_var)
+
+	if res['status_code'] != 0:
+		raise Exception('ERROR: ' + spare_var + ' could not be calculated: ' + str(res['status']))
+
+	return res['data'][spare_var]
+
 # Main function that decides order in which functions run in this script
 def spare_main(dfSub,all_MuseROIs_num,out_path):
 	UID = _os.path.basename(out_path.removesuffix(".pdf"))
- 
+
 	df = pd.DataFrame(columns=['Age','Sex','MRID'])
 	df.loc[0,['Age','Sex','MRID']] = [dfSub.loc[0,'Age'], dfSub.loc[0,'Sex'], dfSub.loc[0, 'MRID']]
 	col_names = ['H_MUSE_Volume_' + i for i in all_MuseROIs_num if int(i) <= 207]
 	col_values = [all_MuseROIs_num[i] for i in all_MuseROIs_num if int(i) <= 207]
 	df[col_names] = [col_values]
- 
-	### Create a tmp folder to store SPARE AD csv file, delete the old one if exist
-	### Although in our case we don't need the csv file. but it is necessery to have for spare_test method
-	# if _os.path.exists('../tmp_folder/SPARE_AD.csv'):
-	# 	_os.remove('../tmp_folder/SPARE_AD.csv')
- 
-	spare_AD = spare.spare_test(df = df,
-                                mdl_path    = '/refs/kaapana_spareAD.pkl.gz',
-                                key_var     = 'MRID',
-                                output      = '/tmp_folder/SPARE_AD.csv',
-                                spare_var   = 'SPARE_AD')
-	
-	spareAD = spare_AD['data']['SPARE_AD'][0]
- 
- 
-	### Create a tmp folder to store SPARE BA csv file, delete the old one if exist
-	### Although in our case we don't need the csv file. but it is necessery to have for spare_test method
-	#if _os.path.exists('../tmp_folder/SPARE_BA.csv'):
-		#_os.remove('../tmp_folder/SPARE_BA.csv')
- 
-	spare_BA = spare.spare_test(df = df,
-                                mdl_path    = '/refs/kaapana_spareBA_cpu.pkl.gz',
-                                key_var     = 'MRID',
-                                output      = '/tmp_folder/SPARE_BA.csv',
-                                spare_var   = 'SPARE_BA')
-	
-	spareBA = spare_BA['data']['SPARE_BA'][0]
+
+	### Models are loaded once per process and scores are returned in memory (no tmp csv files)
+	spareAD = spareScores(df, SPARE_AD_Model, 'SPARE_AD')[0]
+	spareBA = spareScores(df, SPARE_BA_Model, 'SPARE_BA')[0]
 
 	out = _os.path.dirname(out_path)
 
@@ -49,9 +54,5 @@ def spare_main(dfSub,all_MuseROIs_num,out_path):
 		pickle.dump(spareAD,pickle_file)
 	with open(_os.path.join(out,UID+'_spareBA.pkl'), 'wb') as pickle_file:
 		pickle.dump(spareBA,pickle_file)
-  
-	#### delete the temporal folder store spare_AD and spare_BA csv files
-	# if _os.path.exists('../tmp'):
-	# 	shutil.rmtree('../tmp/')
-  
-	return spareAD, spareBA
\ No newline at end of file
+
+	return spareAD, spareBA
@@ -0,0 +1,96 @@
+import sys, os
+import time
+import pickle
+import subprocess
+import tempfile
+import numpy as np
+import cv2
+import SimpleITK as sitk
+
+# Benchmark of the rendering modes of vtkBrainVisual
+#   'volume'     ray cast of the label map, at each quality tier ('report' is the reference)
+#   'surface'    cached label surfaces, run twice: first with an empty cache (extraction), then from the cache
+#   'labelcache' cached label-ID/shading views, run twice as well
+#   Each run is a fresh process, images are compared with the volume render (mean absolute difference, PSNR), after
+#   resizing to the size of the reference if needed
+#   Usage: python3 benchmark_brainvisual.py [label map (.nii.gz)] [z-scores pkl (dict roi label -> z-score)]
+#   Without an input label map, a synthetic 182x218x182 ellipsoid with MUSE-like labels and random z-scores is used
+
+MODES = ['volume', 'surface', 'labelcache']
+QUALITIES = ['report', 'draft', 'publication']
+
+### Function to write a synthetic label map (blocky MUSE-like labels in an ellipsoid, deep labels and corpus callosum in the center)
+def writeSyntheticLabels(path, shape=(182,218,182)):
+	rng = np.random.default_rng(0)
+	labels = np.array([4,11,31,32,35,38,39,40,41,47,48,49,50,51,52,61,62,71,72,73,75,76] + list(range(100,208)), dtype=np.int16)
+	deep = np.array([23,30,36,37,55,56,57,58,59,60], dtype=np.int16)
+	z, y, x = np.meshgrid(*[np.arange(s, dtype=np.float32) - s/2 for s in shape], indexing='ij')
+	blocks = rng.choice(labels, size=(shape[0]//12 + 1, shape[1]//12 + 1, shape[2]//12 + 1))
+	img = np.kron(blocks, np.ones((12,12,12), dtype=np.int16))[:shape[0],:shape[1],:shape[2]]
+	img[(z/70)**2 + (y/90)**2 + (x/72)**2 >= 1] = 0
+	center = (z/20)**2 + (y/25)**2 + (x/25)**2 < 1
+	img[center] = deep[((y[center] + 25)//5).astype(int) % len(deep)]
+	img[(np.abs(x) < 12) & (np.abs(y) < 35) & (np.abs(z - 22) < 4)] = 95
+	sitk.WriteImage(sitk.GetImageFromArray(img), path)
+
+	present = np.unique(img)
+	return {str(l):float(rng.normal(-0.8, 1.0)) for l in present[present > 0]}
+
+### Function to render the views in the current process and print the wall time
+def runCase(mode, quality, roi, zscores, pdf_path):
+	import vtkBrainVisual
+	with open(zscores, 'rb') as f:
+		allz_num = pickle.load(f)
+	start = time.perf_counter()
+	vtkBrainVisual._main(roi, allz_num, pdf_path, mode, quality)
+	print(f'{time.perf_counter() - start:.3f}')
+
+### Function to compare two renders: mean absolute difference (0-255) and PSNR (dB)
+def compareImages(fname, reference):
+	img = sitk.GetArrayFromImage(sitk.ReadImage(fname))[:,:,:3]
+	ref = sitk.GetArrayFromImage(sitk.ReadImage(reference)).astype(np.float64)[:,:,:3]
+	if img.shape != ref.shape:
+		img = cv2.resize(img, (ref.shape[1], ref.shape[0]), interpolation=cv2.INTER_AREA)
+	img = img.astype(np.float64)
+	mse = np.mean((img - ref)**2)
+	return np.abs(img - ref).mean(), (10*np.log10(255**2/mse) if mse > 0 else np.inf)
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '--case':
+		runCase(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[5], sys.argv[6])
+		exit(0)
+
+	with tempfile.TemporaryDirectory() as tmp:
+		zscores = os.path.join(tmp, 'allz_num.pkl')
+		if len(sys.argv) > 1:
+			roi = sys.argv[1]
+			if len(sys.argv) > 2:
+				zscores = sys.argv[2]
+			else:
+				# Random z-scores of the labels of the label map
+				stats = sitk.LabelShapeStatisticsImageFilter()
+				stats.Execute(sitk.ReadImage(roi))
+				rng = np.random.default_rng(0)
+				with open(zscores, 'wb') as f:
+					pickle.dump({str(l):float(rng.normal(-0.8, 1.0)) for l in stats.GetLabels()}, f)
+		else:
+			roi = os.path.join(tmp, 'labels.nii.gz')
+			with open(zscores, 'wb') as f:
+				pickle.dump(writeSyntheticLabels(roi), f)
+		print('Label map: ' + roi + ' ' + str(sitk.ReadImage(roi).GetSize()))
+
+		# Empty cache for the first runs
+		env = dict(os.environ, BRAINVIS_CACHE_DIR=os.path.join(tmp, 'cache'))
+		reference = None
+		print(f'{"mode":12s} {"quality":12s} {"cache":6s} {"size":>10s} {"wall s":>8s} {"mean abs":>9s} {"PSNR dB":>8s}')
+		runs = [('volume', quality, '-') for quality in QUALITIES] + [(mode, 'report', run) for mode in MODES[1:] for run in ['cold', 'warm']]
+		for mode, quality, run in runs:
+			pdf_path = os.path.join(tmp, mode + '_' + quality + '_' + run + '.pdf')
+			res = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', mode, quality, roi, zscores, pdf_path], check=True, capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+			wall = float(res.stdout.strip().splitlines()[-1])
+			fname = pdf_path.removesuffix('.pdf') + '_finalvis.png'
+			if reference is None:
+				reference = fname
+			diff, psnr = compareImages(fname, reference)
+			size = 'x'.join(str(s) for s in sitk.ReadImage(fname).GetSize())
+			print(f'{mode:12s} {quality:12s} {run:6s} {size:>10s} {wall:8.2f} {diff:9.2f} {psnr:8.2f}')
@@ -4,6 +4,7 @@ import pylab as pl
 import numpy as np
 import pandas as pd
 import vtk
+from vtk.util import numpy_support
 import pickle
 import SimpleITK as sitk
 import sys, glob, csv
@@ -15,10 +16,20 @@ from PIL import ImageDraw
 from PIL import ImageFont
 
 from createcmap import get_continuous_cmap
+from landmarks import find_landmarks, bounding_box
+from cpuquota import available_cpus
 
 #maphemi = pd.read_csv('/Users/vikasbommineni/Desktop/MRIreport/brainvisualize/refs/MUSE_ROI_Dictionary.csv')
 maphemi = pd.read_csv('../refs/MUSE_ROI_Dictionary.csv')
 
+# Orientations of the report views #
+ORIENTATIONS = ['left_medial','bg_t_axial','right_medial','axialtop','axialbottom','lefthemosphere_lateral','righthemosphere_lateral']
+# Threads of each ray cast mapper (0: the cores available to the container, see cpuquota.py) #
+RAYCAST_THREADS = int(_os.environ.get('BRAINVIS_RAYCAST_THREADS', 0))
+
+# Volumes of the orientations being rendered #
+_renderVolumes = {}
+
 # def write_image(img, output_file_path):
 #     writer = sitk.ImageFileWriter()
 #     writer.SetFileName ( output_file_path )
@@ -32,13 +43,7 @@ maphemi = pd.read_csv('../refs/MUSE_ROI_Dictionary.csv')
 
 def getbounds(arr):
 	arr = np.mean(arr,axis=2)
-	pos = np.nonzero(arr == 0)
-
-	top = pos[0].min()
-	bottom = pos[0].max()
-
-	left = pos[1].min()
-	right = pos[1].max()
+	(top, bottom), (left, right) = bounding_box(arr == 0)
 
 	return top,bottom,left,right
 
@@ -81,15 +86,11 @@ def vtk_show(orientation, fname, renderer, width=400, height=300):
     elif orientation == 'righthemosphere_lateral':
         imgrot = cv2.rotate(img,cv2.ROTATE_180)
 	    
-	### Delete associated file for each of the following screenshot images to clear up space ###
     elif orientation == 'right_medial':
-        _os.remove(fname+'_r.nii.gz')
         imgrot = cv2.rotate(img,cv2.ROTATE_180)
     elif orientation == 'left_medial':
-        _os.remove(fname+'_l.nii.gz')
         imgrot = cv2.rotate(img,cv2.ROTATE_180)
     elif orientation == 'bg_t_axial':
-        _os.remove(fname+'_bg_t.nii.gz')
         imgrot = cv2.rotate(img,cv2.ROTATE_90_CLOCKWISE)
     
     crop_and_write(imgrot,orientation,fname,width,height)
@@ -105,6 +106,23 @@ def write_image(img, output_file_path):
     writer.SetFileName ( output_file_path )
     writer.Execute ( img )
 
+# Whether an image is left-handed: sitk writes it as a NIfTI with qfac -1, whose slices vtkNIFTIImageReader reverses
+def is_left_handed(image):
+    return np.linalg.det(np.reshape(image.GetDirection(), (3, 3))) < 0
+
+# Wraps a label array (numpy z,y,x order) as a VTK image without copying it, as read by vtkNIFTIImageReader (spacing,
+# and slices reversed if flip_slices, see is_left_handed)
+def numpy_to_vtk_image(nda, spacing, flip_slices=False):
+    nda = np.ascontiguousarray(nda[::-1] if flip_slices else nda)
+    image = vtk.vtkImageData()
+    image.SetDimensions(nda.shape[2], nda.shape[1], nda.shape[0])
+    image.SetSpacing(spacing)
+    image.SetOrigin(0, 0, 0)
+    # numpy_to_vtk keeps a reference to nda, the image shares its memory
+    scalars = numpy_support.numpy_to_vtk(nda.ravel(), deep=0, array_type=numpy_support.get_vtk_array_type(nda.dtype))
+    image.GetPointData().SetScalars(scalars)
+    return image
+
 def create_relabel_map(muse_mask,roi_zscore_dict):
     stats = sitk.LabelShapeStatisticsImageFilter()
     stats.Execute(muse_mask)
@@ -119,6 +137,93 @@ def create_relabel_map(muse_mask,roi_zscore_dict):
 
     return merge_label_dict
 
+# Renders one orientation of the volumes in _renderVolumes in its own offscreen window (see vtk_show)
+def render_orientation(orientation, fname):
+	normal = [0,0,0]
+	viewUp = [0,0,0]
+
+	if (orientation == 'axialtop') | (orientation == 'axialbottom') | (orientation == 'lefthemosphere_lateral') | (orientation == 'righthemosphere_lateral'):
+		renderer = vtk.vtkRenderer()
+		renderWin = vtk.vtkRenderWindow()
+		renderWin.SetOffScreenRendering(1)
+
+		renderWin.AddRenderer(renderer)
+		renderInteractor = vtk.vtkRenderWindowInteractor()
+		renderInteractor.SetRenderWindow(renderWin)
+
+		renderer.AddVolume(_renderVolumes['all'])
+		renderer.SetBackground((255,255,255))
+
+		if orientation == 'axialtop':
+			viewUp = [0, 0, 1]
+			normal = [0, -1, 0]
+		elif orientation == 'axialbottom':
+			viewUp = [0, 0, -1]
+			normal = [0, 1, 0]
+		elif orientation == 'lefthemosphere_lateral':
+			viewUp = [0, 1, 0]
+			normal = [0, 0, 1]
+		elif orientation == 'righthemosphere_lateral':
+			viewUp = [0, 1, 0]
+			normal = [0,0,-1]
+
+	elif orientation == 'right_medial':
+		renderer = vtk.vtkRenderer()
+		renderWin = vtk.vtkRenderWindow()
+		renderWin.SetOffScreenRendering(1)
+
+		renderWin.AddRenderer(renderer)
+		renderInteractor = vtk.vtkRenderWindowInteractor()
+		renderInteractor.SetRenderWindow(renderWin)
+
+		renderer.AddVolume(_renderVolumes['r'])
+		renderer.SetBackground((255,255,255))
+
+		viewUp = [0, 1, 0]
+		normal = [0,0,-1]
+
+	elif orientation == 'left_medial':
+		renderer = vtk.vtkRenderer()
+		renderWin = vtk.vtkRenderWindow()
+		renderWin.SetOffScreenRendering(1)
+
+		renderWin.AddRenderer(renderer)
+		renderInteractor = vtk.vtkRenderWindowInteractor()
+		renderInteractor.SetRenderWindow(renderWin)
+
+		renderer.AddVolume(_renderVolumes['l'])
+		renderer.SetBackground((255,255,255))
+
+		viewUp = [0, 1, 0]
+		normal = [0, 0, 1]
+
+	elif orientation == 'bg_t_axial':
+		renderer = vtk.vtkRenderer()
+		renderWin = vtk.vtkRenderWindow()
+		renderWin.SetOffScreenRendering(1)
+
+		renderWin.AddRenderer(renderer)
+		renderInteractor = vtk.vtkRenderWindowInteractor()
+		renderInteractor.SetRenderWindow(renderWin)
+
+		renderer.AddVolume(_renderVolumes['bg_t'])
+		renderer.SetBackground((255,255,255))
+
+		viewUp = [0, 0, 1]
+		normal = [0, -1, 0]
+
+	renderer.ResetCamera()
+	camera =  renderer.GetActiveCamera()
+	focus = camera.GetFocalPoint()
+	d = camera.GetDistance()
+
+	camera.SetPosition(focus[0] + d*normal[0], focus[1] + d*normal[1], focus[2] + d*normal[2])
+	camera.SetFocalPoint(focus)
+	camera.SetViewUp(viewUp)
+	camera.OrthogonalizeViewUp()
+
+	vtk_show(orientation, fname, renderer, 800, 800)
+
 def atrophyvisualization(maskfile, allz, fname):
 	# Path to the file
 	filenameSegmentation = maskfile
@@ -136,110 +241,40 @@ def atrophyvisualization(maskfile, allz, fname):
 	need2relabel = [int(k) for k,v in roi_zscore_dict.items() if float(v) <= -0.524] ### 30th percentile upper bound 
 	#relabelGray = [int(k) for k in relabelMap.keys() if k not in need2relabel]
 
-	nda_all = sitk.GetArrayFromImage(muse_labelmap)
-	nda_l = sitk.GetArrayFromImage(muse_labelmap)
-	nda_r = sitk.GetArrayFromImage(muse_labelmap)
-	nda_bg_t = sitk.GetArrayFromImage(muse_labelmap)
+	# Label array as unsigned short (as the volume mappers expect), a view of the image buffer if it already is
+	nda_all = sitk.GetArrayViewFromImage(muse_labelmap).astype(np.uint16, copy=False)
 
 	print(nda_all.shape)
-	print(nda_l.shape)
-	print(nda_r.shape)
-	print(nda_bg_t.shape)
-
-	# TODO: get equitable split
-	bg_t = ((nda_bg_t == 59) | (nda_bg_t == 60) | (nda_bg_t == 23) | (nda_bg_t == 30) | (nda_bg_t == 36) | (nda_bg_t == 37) | (nda_bg_t == 55) | (nda_bg_t == 56) | (nda_bg_t == 57) | (nda_bg_t == 58)).astype(int)
-	print(bg_t.shape)
-	cnt = np.inf
-	bg_t_slice = 0
-	for y in range(bg_t.shape[1]):
-		if abs(np.sum(bg_t[:,:y,:]) - np.sum(bg_t[:,y:,:])) < cnt:
-			bg_t_slice = y
-			cnt = abs(np.sum(bg_t[:,:y,:]) - np.sum(bg_t[:,y:,:]))
 
-	# Set voxels to 0 above V.O.I
-	nda_bg_t[:,:bg_t_slice,:] = 0
+	# Equitable splits of the basal ganglia/thalamus (second axis) and of the corpus callosum (first axis),
+	# transition point from left to right hemisphere
+	bg_t_slice, mid_slice, bounds = find_landmarks(nda_all, 1, 0)
+
 	print('bgt slice: ', bg_t_slice)
 
-	# Get transition point from left to right hemisphere from corpus callosum
-	cc = (nda_all == 95).astype(int)
+	print('mid slice: ', mid_slice)
 
-	#### test slices to get the most equitable cc split
-	cnt = np.inf
-	mid_slice = 0
-	for x in range(cc.shape[0]):
-		if abs(np.sum(cc[x:,:,:])-np.sum(cc[:x,:,:])) < cnt:
-			mid_slice = x
-			cnt = abs(np.sum(cc[x:,:,:])-np.sum(cc[:x,:,:]))
+	# Hemispheres and basal ganglia/thalamus slab as in-memory masked copies (no temporary files). Clipping planes
+	# would avoid the copies, but the cut faces would lose their shading: the mappers shade with the label gradients
+	nda_l = nda_all.copy()
+	nda_r = nda_all.copy()
+	nda_bg_t = nda_all.copy()
 
-	print('mid slice: ', mid_slice)
+	# Set voxels to 0 above V.O.I
+	nda_bg_t[:,:bg_t_slice,:] = 0
 
 	# Set voxels to 0 based on middle slice
 	nda_l[mid_slice:,:,:] = 0
 	nda_r[:mid_slice,:,:] = 0
 
-	all_post = sitk.GetImageFromArray(nda_all)
-	l_post = sitk.GetImageFromArray(nda_l)
-	r_post = sitk.GetImageFromArray(nda_r)
-	bg_t_post = sitk.GetImageFromArray(nda_bg_t)
-
-	all_post.CopyInformation(muse_labelmap)
-	l_post.CopyInformation(muse_labelmap)
-	r_post.CopyInformation(muse_labelmap)
-	bg_t_post.CopyInformation(muse_labelmap)
-
-	all_filenameSegmentation = fname+'_all.nii.gz'
-	l_filenameSegmentation = fname+'_l.nii.gz'
-	r_filenameSegmentation = fname+'_r.nii.gz'
-	bg_t_filenameSegmentation = fname+'_bg_t.nii.gz'
-	
-	print(174)
-
-	write_image(all_post,all_filenameSegmentation)
-	write_image(l_post,l_filenameSegmentation)
-	write_image(r_post,r_filenameSegmentation)
-	write_image(bg_t_post,bg_t_filenameSegmentation)
-
 	##################################################
 
-	reader_all = vtk.vtkNIFTIImageReader()
-	reader_l = vtk.vtkNIFTIImageReader()
-	reader_r = vtk.vtkNIFTIImageReader()
-	reader_bg_t = vtk.vtkNIFTIImageReader()
-
-	reader_all.SetFileName(all_filenameSegmentation)
-	reader_l.SetFileName(l_filenameSegmentation)
-	reader_r.SetFileName(r_filenameSegmentation)
-	reader_bg_t.SetFileName(bg_t_filenameSegmentation)
-
-	castFilter_all = vtk.vtkImageCast()
-	castFilter_l = vtk.vtkImageCast()
-	castFilter_r = vtk.vtkImageCast()
-	castFilter_bg_t = vtk.vtkImageCast()
-
-	castFilter_all.SetInputConnection(reader_all.GetOutputPort())
-	castFilter_l.SetInputConnection(reader_l.GetOutputPort())
-	castFilter_r.SetInputConnection(reader_r.GetOutputPort())
-	castFilter_bg_t.SetInputConnection(reader_bg_t.GetOutputPort())
-
-	castFilter_all.SetOutputScalarTypeToUnsignedShort()
-	castFilter_l.SetOutputScalarTypeToUnsignedShort()
-	castFilter_r.SetOutputScalarTypeToUnsignedShort()
-	castFilter_bg_t.SetOutputScalarTypeToUnsignedShort()
-
-	castFilter_all.Update()
-	castFilter_l.Update()
-	castFilter_r.Update()
-	castFilter_bg_t.Update()
-
-	imdataBrainSeg_all = castFilter_all.GetOutputPort()
-	imdataBrainSeg_l = castFilter_l.GetOutputPort()
-	imdataBrainSeg_r = castFilter_r.GetOutputPort()
-	imdataBrainSeg_bg_t = castFilter_bg_t.GetOutputPort()
-
-	idbs_all = castFilter_all.GetOutput()
-	idbs_l = castFilter_l.GetOutput()
-	idbs_r = castFilter_r.GetOutput()
-	idbs_bg_t = castFilter_bg_t.GetOutput()
+	# VTK images sharing the memory of the arrays (of flipped copies for a left-handed label map)
+	flip_slices = is_left_handed(muse_labelmap)
+	idbs_all = numpy_to_vtk_image(nda_all, muse_labelmap.GetSpacing(), flip_slices)
+	idbs_l = numpy_to_vtk_image(nda_l, muse_labelmap.GetSpacing(), flip_slices)
+	idbs_r = numpy_to_vtk_image(nda_r, muse_labelmap.GetSpacing(), flip_slices)
+	idbs_bg_t = numpy_to_vtk_image(nda_bg_t, muse_labelmap.GetSpacing(), flip_slices)
 
 	# Define color legend #
 	funcColor = vtk.vtkColorTransferFunction()
@@ -322,10 +357,17 @@ def atrophyvisualization(maskfile, allz, fname):
 	volumeMapper_r = vtk.vtkFixedPointVolumeRayCastMapper()
 	volumeMapper_bg_t = vtk.vtkFixedPointVolumeRayCastMapper()
 
-	volumeMapper_all.SetInputConnection(imdataBrainSeg_all)
-	volumeMapper_l.SetInputConnection(imdataBrainSeg_l)
-	volumeMapper_r.SetInputConnection(imdataBrainSeg_r)
-	volumeMapper_bg_t.SetInputConnection(imdataBrainSeg_bg_t)
+	volumeMapper_all.SetInputData(idbs_all)
+	volumeMapper_l.SetInputData(idbs_l)
+	volumeMapper_r.SetInputData(idbs_r)
+	volumeMapper_bg_t.SetInputData(idbs_bg_t)
+
+	# Threads capped by the CPU quota of the pod (VTK would start one per core of the node)
+	threads = RAYCAST_THREADS if RAYCAST_THREADS > 0 else available_cpus()
+	volumeMapper_all.SetNumberOfThreads(threads)
+	volumeMapper_l.SetNumberOfThreads(threads)
+	volumeMapper_r.SetNumberOfThreads(threads)
+	volumeMapper_bg_t.SetNumberOfThreads(threads)
 
 	volume_all = vtk.vtkVolume()
 	volume_l = vtk.vtkVolume()
@@ -342,92 +384,11 @@ def atrophyvisualization(maskfile, allz, fname):
 	volume_r.SetProperty(propVolume_r)
 	volume_bg_t.SetProperty(propVolume_bg_t)
 
-	normal = [0,0,0]
-	viewUp = [0,0,0]
-
 	# Set orientation logic #
-	for orientation in ['left_medial','bg_t_axial','right_medial','axialtop','axialbottom','lefthemosphere_lateral','righthemosphere_lateral']:
-		if (orientation == 'axialtop') | (orientation == 'axialbottom') | (orientation == 'lefthemosphere_lateral') | (orientation == 'righthemosphere_lateral'):
-			renderer = vtk.vtkRenderer()
-			renderWin = vtk.vtkRenderWindow()
-			renderWin.SetOffScreenRendering(1)
-
-			renderWin.AddRenderer(renderer)
-			renderInteractor = vtk.vtkRenderWindowInteractor()
-			renderInteractor.SetRenderWindow(renderWin)
-
-			renderer.AddVolume(volume_all)
-			renderer.SetBackground((255,255,255))
-
-			if orientation == 'axialtop':
-				viewUp = [0, 0, 1]
-				normal = [0, -1, 0]
-			elif orientation == 'axialbottom':
-				viewUp = [0, 0, -1]
-				normal = [0, 1, 0]
-			elif orientation == 'lefthemosphere_lateral':
-				viewUp = [0, 1, 0]
-				normal = [0, 0, 1]
-			elif orientation == 'righthemosphere_lateral':
-				viewUp = [0, 1, 0]
-				normal = [0,0,-1]
-
-		elif orientation == 'right_medial':
-			renderer = vtk.vtkRenderer()
-			renderWin = vtk.vtkRenderWindow()
-			renderWin.SetOffScreenRendering(1)
-
-			renderWin.AddRenderer(renderer)
-			renderInteractor = vtk.vtkRenderWindowInteractor()
-			renderInteractor.SetRenderWindow(renderWin)
-
-			renderer.AddVolume(volume_r)
-			renderer.SetBackground((255,255,255))
-
-			viewUp = [0, 1, 0]
-			normal = [0,0,-1]
-
-		elif orientation == 'left_medial':
-			renderer = vtk.vtkRenderer()
-			renderWin = vtk.vtkRenderWindow()
-			renderWin.SetOffScreenRendering(1)
-
-			renderWin.AddRenderer(renderer)
-			renderInteractor = vtk.vtkRenderWindowInteractor()
-			renderInteractor.SetRenderWindow(renderWin)
-
-			renderer.AddVolume(volume_l)
-			renderer.SetBackground((255,255,255))
-
-			viewUp = [0, 1, 0]
-			normal = [0, 0, 1]
-
-		elif orientation == 'bg_t_axial':
-			renderer = vtk.vtkRenderer()
-			renderWin = vtk.vtkRenderWindow()
-			renderWin.SetOffScreenRendering(1)
-
-			renderWin.AddRenderer(renderer)
-			renderInteractor = vtk.vtkRenderWindowInteractor()
-			renderInteractor.SetRenderWindow(renderWin)
-
-			renderer.AddVolume(volume_bg_t)
-			renderer.SetBackground((255,255,255))
-
-			viewUp = [0, 0, 1]
-			normal = [0, -1, 0]
-
-		renderer.ResetCamera()
-		camera =  renderer.GetActiveCamera()
-		focus = camera.GetFocalPoint()
-		d = camera.GetDistance()
-
-		camera.SetPosition(focus[0] + d*normal[0], focus[1] + d*normal[1], focus[2] + d*normal[2])
-		camera.SetFocalPoint(focus)
-		camera.SetViewUp(viewUp)
-		camera.OrthogonalizeViewUp()
-
-		vtk_show(orientation, fname, renderer, 800, 800)
+	_renderVolumes.update({'all':volume_all, 'l':volume_l, 'r':volume_r, 'bg_t':volume_bg_t})
+	for orientation in ORIENTATIONS:
+		render_orientation(orientation, fname)
+	_renderVolumes.clear()
 
 	# Get colorbar and combine 4 images to get final image!!!
 	img_lhl = cv2.imread(fname+'_lefthemosphere_lateral.png')
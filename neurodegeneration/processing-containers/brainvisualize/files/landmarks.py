@@ -0,0 +1,63 @@
+import numpy as np
+
+#### Landmark planes of the MUSE label maps ###
+# The basal ganglia/thalamus plane and the corpus callosum (mid-sagittal) plane split the voxels of their labels in
+# two balanced halves along one axis. The voxel counts of each slice (profiles) are computed once per axis, and the
+# balanced split is found from their cumulative sum, instead of summing two full slabs for every candidate slice.
+
+# Labels of the basal ganglia and thalamus #
+BG_T_LABELS = [59, 60, 23, 30, 36, 37, 55, 56, 57, 58]
+# Label of the corpus callosum #
+CC_LABEL = 95
+
+### Function to count the voxels of a boolean mask in each slice along each axis
+###   Returns one profile (voxel counts per slice) per axis
+def mask_profiles(mask):
+	if mask.ndim == 2:
+		return [np.count_nonzero(mask, axis=1), np.count_nonzero(mask, axis=0)]
+
+	# Sum over the first axis once, the profiles of the other axes are derived from it
+	plane = mask.sum(axis=0, dtype=np.int64)
+	profiles = [mask.reshape(mask.shape[0], -1).sum(axis=1, dtype=np.int64)]
+	for axis in range(plane.ndim):
+		profiles.append(plane.sum(axis=tuple(a for a in range(plane.ndim) if a != axis)))
+	return profiles
+
+### Function to get the first and last non-empty slice of each profile: [(first, last), ...], None for empty profiles
+def profile_bounds(profiles):
+	bounds = []
+	for profile in profiles:
+		nonzero = np.flatnonzero(profile)
+		bounds.append((int(nonzero[0]), int(nonzero[-1])) if len(nonzero) > 0 else None)
+	return bounds
+
+### Function to get the bounding box of a boolean mask: [(first, last), ...] for each axis
+def bounding_box(mask):
+	return profile_bounds(mask_profiles(mask))
+
+### Function to find the slice splitting the voxels of a profile in two balanced halves
+###   Same result as the first slice s minimizing |sum(mask[:s]) - sum(mask[s:])|
+def balanced_split(profile):
+	# Voxels before each slice
+	before = np.concatenate([[0], np.cumsum(profile, dtype=np.int64)[:-1]])
+	return int(np.argmin(np.abs(2*before - np.sum(profile, dtype=np.int64))))
+
+### Function to find the landmark planes of a label map (numpy array)
+###   bg_t_axis/cc_axis: axes along which the basal ganglia/thalamus and the corpus callosum voxels are balanced
+###   Returns the basal ganglia/thalamus slice, the mid slice and the bounding boxes ('brain', 'bg_t' and 'cc') of the
+###   non-zero labels, the basal ganglia/thalamus and the corpus callosum
+def find_landmarks(nda, bg_t_axis, cc_axis):
+	# Label -> landmark lookup table (0: none, 1: basal ganglia/thalamus, 2: corpus callosum), one pass over the volume
+	lut = np.zeros(max(int(nda.max()), CC_LABEL, max(BG_T_LABELS)) + 1, dtype=np.uint8)
+	lut[BG_T_LABELS] = 1
+	lut[CC_LABEL] = 2
+	landmarks = lut[np.clip(nda, 0, None)]
+
+	bg_t_profiles = mask_profiles(landmarks == 1)
+	cc_profiles = mask_profiles(landmarks == 2)
+	bg_t_slice = balanced_split(bg_t_profiles[bg_t_axis])
+	mid_slice = balanced_split(cc_profiles[cc_axis])
+
+	bounds = {'brain': bounding_box(nda > 0), 'bg_t': profile_bounds(bg_t_profiles), 'cc': profile_bounds(cc_profiles)}
+
+	return bg_t_slice, mid_slice, bounds
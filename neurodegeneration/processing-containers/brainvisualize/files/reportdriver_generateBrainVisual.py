@@ -2,6 +2,7 @@ import sys, os
 import glob
 import generateBrainVisual
 import vtkBrainVisual
+import imageformat
 import pickle
 import SimpleITK as sitk
 from datetime import datetime
@@ -34,7 +35,7 @@ for batch_element_dir in batch_folders:
     roi = []
 
     roi_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR_MUSE'])
-    roi = sorted(glob.glob(os.path.join(roi_input_dir, "*.nii*"), recursive=True))
+    roi = imageformat.find_images(roi_input_dir)
 
     in_dir_quant = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR_QUANT'])
     allz_num = sorted(glob.glob(os.path.join(in_dir_quant, "*allz_num.pkl*"), recursive=True))
@@ -2,15 +2,20 @@ import os as _os
 import numpy as np
 import pandas as pd
 import vtk
+from vtk.util import numpy_support
 import SimpleITK as sitk
 import sys, glob, csv
 import pickle
+import hashlib
 
 # import matplotlib.pyplot as plt
 # from matplotlib.colors import ListedColormap
 
 from enum import Enum
 
+from landmarks import find_landmarks
+from cpuquota import available_cpus
+
 #Standard atrophy buckets(chosen by Ilya)
 PERCENTILE_1  = -2.326 #(2.326 sd below the mean i.e. zscore)
 PERCENTILE_3  = -1.881 #(1.881 sd below the mean i.e. zscore)
@@ -28,9 +33,9 @@ class ORIENTATION(Enum):
 	BASAL_GANGLIA_THALAMUS = 7
 	COLORBAR = 8
 
-def creat_title(renderer, text):
+def creat_title(renderer, text, font_size=20):
 	titleProperty = vtk.vtkTextProperty()
-	titleProperty.SetFontSize(20)
+	titleProperty.SetFontSize(font_size)
 	titleProperty.SetBold(1)
 	titleProperty.SetJustificationToCentered()
 
@@ -129,41 +134,48 @@ def get_color_TF(relabelMap,need2relabel):
 
 
 def get_plane_from_mri(muse_labelmap):
-	nda_bg_t = sitk.GetArrayFromImage(muse_labelmap)
-
-	bg_t = ((nda_bg_t == 59) | (nda_bg_t == 60) | (nda_bg_t == 23) | (nda_bg_t == 30) | (nda_bg_t == 36) | (nda_bg_t == 37) | (nda_bg_t == 55) | (nda_bg_t == 56) | (nda_bg_t == 57) | (nda_bg_t == 58)).astype(int)
-	# print(bg_t.shape)
-	cnt = np.inf
-	bg_t_slice = 0
-
-	## balanced the voxel volumn for both left and right
-	for x in range(bg_t.shape[0]):
-		if abs(np.sum(bg_t[:x,:,:]) - np.sum(bg_t[x:,:,:])) < cnt:
-			bg_t_slice = x
-			cnt = abs(np.sum(bg_t[:x,:,:]) - np.sum(bg_t[x:,:,:]))
-		
-	# Get transition point from left to right hemisphere from corpus callosum
-	nda_all = nda_bg_t
-	cc = (nda_all == 95).astype(int)
-
-	#### test slices to get the most equitable cc split
-	cnt = np.inf
-	mid_slice = 0
-	for y in range(cc.shape[1]):
-		if abs(np.sum(cc[:,:y,:]) - np.sum(cc[:,y:,:])) < cnt:
-			mid_slice = y
-			cnt = abs(np.sum(cc[:,:y,:]) - np.sum(cc[:,y:,:]))
+	nda = sitk.GetArrayFromImage(muse_labelmap)
+
+	## balanced the voxel volumn for both left and right:
+	## basal ganglia/thalamus split along the first axis, transition from left to right hemisphere from corpus callosum along the second
+	bg_t_slice, mid_slice, bounds = find_landmarks(nda, 0, 1)
 
 	return bg_t_slice, mid_slice
 
 
-def get_volume(image,relabelMap,need2relabel,clip, orientation, *args):
+### Function to get the plane clipping the medial and basal ganglia/thalamus views
+def get_clip_plane(center, orientation, bg_t_slice, mid_slice):
+	plane = vtk.vtkPlane()
+	if(orientation == ORIENTATION.RIGHT_HEMISPHERE_MEDIAL):
+
+		origin = list(center)
+		origin[1] = mid_slice
+		plane.SetOrigin(origin)
+		plane.SetNormal(-1,0,0)
+
+	elif(orientation == ORIENTATION.LEFT_HEMISPHERE_MEDIAL):
+
+		origin = list(center)
+		origin[1] = mid_slice
+		plane.SetOrigin(origin)
+		plane.SetNormal(1,0,0)
+	elif(orientation == ORIENTATION.BASAL_GANGLIA_THALAMUS):
+
+		origin = list(center)
+		origin[2] = bg_t_slice
+		plane.SetOrigin(origin)
+		plane.SetNormal(0,0,-1)
+
+	return plane
+
+def get_volume(image,relabelMap,need2relabel,clip, orientation, *args, color_tf=None, shade=True, quality=None):
 	
 	if len(args) != 0:
 		bg_t_slice, mid_slice = args #get_plane_from_mri()
 
 	#get color transfer function
-	color_tf = get_color_TF(relabelMap,need2relabel)
+	if color_tf is None:
+		color_tf = get_color_TF(relabelMap,need2relabel)
 
 	# Define opacity scheme 
 	scalar_opacity = vtk.vtkPiecewiseFunction()
@@ -180,40 +192,22 @@ def get_volume(image,relabelMap,need2relabel,clip, orientation, *args):
 	vol_property.SetScalarOpacity(scalar_opacity)
 	vol_property.SetGradientOpacity(gradient_opacity)
 	vol_property.SetInterpolationTypeToNearest()
-	vol_property.ShadeOn()
+	if shade:
+		vol_property.ShadeOn()
 	vol_property.SetDiffuse(0.7)
 	vol_property.SetAmbient(0.8)
 
 	#volume mapper
 	vol_mapper = vtk.vtkFixedPointVolumeRayCastMapper()
 	vol_mapper.SetInputData(image)
+	#threads capped by the CPU quota of the pod (VTK would start one per core of the node)
+	vol_mapper.SetNumberOfThreads(RAYCAST_THREADS if RAYCAST_THREADS > 0 else available_cpus())
+	if quality is not None:
+		vol_mapper.SetSampleDistance(quality['sample_distance'])
+		vol_mapper.SetImageSampleDistance(quality['image_sample_distance'])
 	if(clip):
-		plane = vtk.vtkPlane()
-		if(orientation == ORIENTATION.RIGHT_HEMISPHERE_MEDIAL):
-
-			plane = vtk.vtkPlane()
-			origin = list(image.GetCenter())
-			origin[1] = mid_slice
-			plane.SetOrigin(origin)
-			plane.SetNormal(-1,0,0)
-
-		elif(orientation == ORIENTATION.LEFT_HEMISPHERE_MEDIAL):
-      
-			plane = vtk.vtkPlane()
-			origin = list(image.GetCenter())
-			origin[1] = mid_slice
-			plane.SetOrigin(origin)
-			plane.SetNormal(1,0,0)
-		elif(orientation == ORIENTATION.BASAL_GANGLIA_THALAMUS):
-
-			plane = vtk.vtkPlane()
-			origin = list(image.GetCenter())
-			origin[2] = bg_t_slice
-			plane.SetOrigin(origin)
-			plane.SetNormal(0,0,-1)
-
 		#add clipping plane to clip the volume
-		vol_mapper.AddClippingPlane(plane)
+		vol_mapper.AddClippingPlane(get_clip_plane(image.GetCenter(), orientation, bg_t_slice, mid_slice))
 
 	vol = vtk.vtkVolume()
 	vol.SetMapper(vol_mapper)
@@ -337,98 +331,148 @@ def setup_camera(orientation,renderer):
 		renderer.ResetCameraClippingRange()	
 
 
-def setup_vtk_pipeline(roi,allz_num,out):
-	#read muse roi as itk image once and use everywhere
-	muse_itk_image = read_itk_image(roi)
-
-	#generate dict[roi label]=zscore
-	relabelMap = create_relabel_map(muse_itk_image,allz_num)
-
-	#read muse roi image as vtk image once and use everywhere
-	muse_vtk_img = get_vtk_image(roi)
-
-	#list of roi that need relabeling for visualization
-	need2relabel = get_zscore_labeled_roi_list(allz_num)
-
-	# render_scalarbar(relabelMap,need2relabel)
+# Title of each view #
+VIEW_TITLES = {
+	ORIENTATION.RIGHT_HEMISPHERE_LATERAL: 'Right hemisphere lateral',
+	ORIENTATION.RIGHT_HEMISPHERE_MEDIAL: 'Right hemisphere medial',
+	ORIENTATION.LEFT_HEMISPHERE_LATERAL: 'Left hemisphere lateral',
+	ORIENTATION.LEFT_HEMISPHERE_MEDIAL: 'Left hemisphere medial',
+	ORIENTATION.BOTTOM: 'Bottom',
+	ORIENTATION.TOP: 'Top',
+	ORIENTATION.BASAL_GANGLIA_THALAMUS: 'Basal Ganglia/Thalamus'}
+
+# Views clipped at the medial or basal ganglia plane #
+CLIPPED_VIEWS = [ORIENTATION.RIGHT_HEMISPHERE_MEDIAL, ORIENTATION.LEFT_HEMISPHERE_MEDIAL, ORIENTATION.BASAL_GANGLIA_THALAMUS]
+
+# Size of the rendered report views #
+RENDER_SIZE = (1280, 720)
+
+# Viewport of each view in the report window: [xmin, ymin, xmax, ymax] #
+VIEWPORTS = {
+	ORIENTATION.BOTTOM: [0, 0, 0.25, 0.5],
+	ORIENTATION.TOP: [0.25, 0, 0.5, 0.5],
+	ORIENTATION.BASAL_GANGLIA_THALAMUS: [0.5, 0, 0.75, 0.5],
+	ORIENTATION.COLORBAR: [0.75, 0, 1, 0.5],
+	ORIENTATION.RIGHT_HEMISPHERE_LATERAL: [0, 0.5, 0.25, 1],
+	ORIENTATION.RIGHT_HEMISPHERE_MEDIAL: [0.25, 0.5, 0.5, 1],
+	ORIENTATION.LEFT_HEMISPHERE_LATERAL: [0.5, 0.5, 0.75, 1],
+	ORIENTATION.LEFT_HEMISPHERE_MEDIAL: [0.75, 0.5, 1, 1]}
+
+# Quality tiers of the volume renders #
+#   size: render size of the report views, image_sample_distance: pixels between the rays cast (ray cast mapper),
+#   sample_distance: distance between the samples along a ray (mm), downsample: subsampling factor of the label map
+#   (nearest neighbour, no new labels)
+#   The report page displays the views at 792 pixels wide: 'draft' renders just above that size
+QUALITY_TIERS = {
+	'draft': {'size': (800, 450), 'image_sample_distance': 1.0, 'sample_distance': 2.0, 'downsample': 2},
+	'report': {'size': RENDER_SIZE, 'image_sample_distance': 1.0, 'sample_distance': 1.0, 'downsample': 1},
+	'publication': {'size': (2560, 1440), 'image_sample_distance': 1.0, 'sample_distance': 0.5, 'downsample': 1}}
+BRAINVIS_QUALITY = _os.environ.get('BRAINVIS_QUALITY', 'report')
+
+### Function to get the settings of a quality tier (default: BRAINVIS_QUALITY)
+def get_quality_tier(quality=None):
+	if quality is None:
+		quality = BRAINVIS_QUALITY
+	if quality not in QUALITY_TIERS:
+		raise ValueError('Unknown brain visualization quality: ' + str(quality))
+	return QUALITY_TIERS[quality]
+
+### Function to subsample a vtk label map by an integer factor (nearest neighbour, labels are preserved)
+def downsample_vtk_image(image, factor):
+	if factor <= 1:
+		return image
+	shrink = vtk.vtkImageShrink3D()
+	shrink.SetInputData(image)
+	shrink.SetShrinkFactors(factor, factor, factor)
+	shrink.AveragingOff()
+	shrink.Update()
+	return shrink.GetOutput()
+
+# Threads of each ray cast mapper (0: the cores available to the container, see cpuquota.py) #
+RAYCAST_THREADS = int(_os.environ.get('BRAINVIS_RAYCAST_THREADS', 0))
+
+### Function to add the actors (volume or surfaces, title or colorbar) and the camera of one view to its renderer
+def add_view(ren, orientation, muse_vtk_img, relabelMap, need2relabel, bg_t_slice, mid_slice, color_tf=None, shade=True, volumes=True, annotations=True, surfaces=None, quality=None):
+	if(orientation == ORIENTATION.COLORBAR): #bottom row, last renderer for colorbar
+		if annotations:
+			add_scalarbar(ren)
+		return
 
+	if volumes and surfaces is not None:
+		if orientation in CLIPPED_VIEWS:
+			actor = get_surface_actor(surfaces,muse_vtk_img,relabelMap,need2relabel,True,orientation, bg_t_slice, mid_slice)
+		else:
+			actor = get_surface_actor(surfaces,muse_vtk_img,relabelMap,need2relabel,False,orientation)
+		ren.AddActor(actor)
+		#invisible outline of the image, so that the cameras frame the surfaces as the volume
+		ren.AddActor(get_outline_actor(muse_vtk_img))
+	elif volumes:
+		if orientation in CLIPPED_VIEWS:
+			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,True,orientation, bg_t_slice, mid_slice, color_tf=color_tf, shade=shade, quality=quality)
+		else:
+			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,False,orientation, color_tf=color_tf, shade=shade, quality=quality)
+		ren.AddVolume(volume)
+	if annotations:
+		#titles scale with the render size
+		size = RENDER_SIZE if quality is None else quality['size']
+		creat_title(ren,VIEW_TITLES[orientation],font_size=int(round(20*size[1]/RENDER_SIZE[1])))
+	setup_camera(orientation,ren)
+
+### Function to render the report views (7 views of the label map and the colorbar) in one offscreen window
+###   color_tf/shade: color transfer function and shading of the volumes (default: z-score colors, shaded)
+###   background: background color, volumes/annotations: whether to render the volumes and the titles/colorbar
+###   surfaces: label surfaces (get_label_surfaces) rendered instead of the volume, if given
+###   quality: quality tier (get_quality_tier) of the volumes and render size (default: RENDER_SIZE, VTK sampling)
+def render_views(muse_itk_image, muse_vtk_img, relabelMap, need2relabel, color_tf=None, shade=True, background=(1,1,1), volumes=True, annotations=True, surfaces=None, quality=None):
 	# One render window, multiple viewports.
 	rw = vtk.vtkRenderWindow()
 	iren = vtk.vtkRenderWindowInteractor()
 	iren.SetRenderWindow(rw)
 
 	rw.SetOffScreenRendering(1)
- 
-	# Define 8 viewports
-	viewport_positions = {}
-	viewport_positions[ORIENTATION.BOTTOM] = [0, 0, 0.25, 0.5]
-	viewport_positions[ORIENTATION.TOP] = [0.25, 0, 0.5, 0.5]
-	viewport_positions[ORIENTATION.BASAL_GANGLIA_THALAMUS] = [0.5, 0, 0.75, 0.5]
-	viewport_positions[ORIENTATION.COLORBAR] = [0.75, 0, 1, 0.5]
-	viewport_positions[ORIENTATION.RIGHT_HEMISPHERE_LATERAL] = [0, 0.5, 0.25, 1]
-	viewport_positions[ORIENTATION.RIGHT_HEMISPHERE_MEDIAL] = [0.25, 0.5, 0.5, 1]
-	viewport_positions[ORIENTATION.LEFT_HEMISPHERE_LATERAL] = [0.5, 0.5, 0.75, 1]
-	viewport_positions[ORIENTATION.LEFT_HEMISPHERE_MEDIAL] = [0.75, 0.5, 1, 1]
 
 	#create all renderers
-	viewport_keys = list(viewport_positions.keys())
 	list_renderers = {}
-	for i in range(8):
+	for orientation, pos in VIEWPORTS.items():
 		ren = vtk.vtkRenderer()
 		rw.AddRenderer(ren)
-		pos = viewport_positions[viewport_keys[i]]
 		ren.SetViewport(pos[0], pos[1], pos[2], pos[3])
-		ren.SetBackground(1,1,1) #white background
+		ren.SetBackground(background[0], background[1], background[2])
 		ren.ResetCamera()
-		list_renderers[viewport_keys[i]] = ren
+		list_renderers[orientation] = ren
 
 	#get medial and basal ganglia slice to generate clipping plane
 	bg_t_slice, mid_slice = get_plane_from_mri(muse_itk_image)
 
 	#add actors to individual renderers
-	for i in  range(len(list_renderers)):
-		ren = list_renderers[viewport_keys[i]]
-		if(viewport_keys[i] == ORIENTATION.RIGHT_HEMISPHERE_LATERAL):
-			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,False,viewport_keys[i])
-			ren.AddVolume(volume)
-			creat_title(ren,'Right hemisphere lateral')
-			setup_camera(viewport_keys[i],ren)
-		elif(viewport_keys[i] == ORIENTATION.LEFT_HEMISPHERE_LATERAL):
-			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,False,viewport_keys[i])
-			ren.AddVolume(volume)
-			creat_title(ren,'Left hemisphere lateral')
-			setup_camera(viewport_keys[i],ren)
-		elif(viewport_keys[i] == ORIENTATION.BOTTOM):
-			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,False,viewport_keys[i])
-			ren.AddVolume(volume)
-			creat_title(ren,'Bottom')
-			setup_camera(viewport_keys[i],ren)
-		elif(viewport_keys[i] == ORIENTATION.TOP):
-			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,False,viewport_keys[i])
-			ren.AddVolume(volume)
-			creat_title(ren,'Top')
-			setup_camera(viewport_keys[i],ren)
-		elif(viewport_keys[i] == ORIENTATION.RIGHT_HEMISPHERE_MEDIAL):
-			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,True,viewport_keys[i], bg_t_slice, mid_slice)
-			ren.AddVolume(volume)
-			creat_title(ren,'Right hemisphere medial')
-			setup_camera(viewport_keys[i],ren)
-		elif(viewport_keys[i] == ORIENTATION.LEFT_HEMISPHERE_MEDIAL):
-			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,True,viewport_keys[i], bg_t_slice, mid_slice)
-			ren.AddVolume(volume)
-			creat_title(ren,'Left hemisphere medial')
-			setup_camera(viewport_keys[i],ren)
-		elif(viewport_keys[i] == ORIENTATION.BASAL_GANGLIA_THALAMUS):
-			volume = get_volume(muse_vtk_img,relabelMap,need2relabel,True,viewport_keys[i], bg_t_slice, mid_slice)
-			ren.AddVolume(volume)
-			creat_title(ren,'Basal Ganglia/Thalamus')
-			setup_camera(viewport_keys[i],ren)
-		elif(viewport_keys[i] == ORIENTATION.COLORBAR): #bottom row, last renderer for colorbar
-			add_scalarbar(ren)
+	for orientation, ren in list_renderers.items():
+		add_view(ren, orientation, muse_vtk_img, relabelMap, need2relabel, bg_t_slice, mid_slice, color_tf=color_tf, shade=shade, volumes=volumes, annotations=annotations, surfaces=surfaces, quality=quality)
 				
 	rw.Render()
 	rw.SetWindowName('Report Views')
-	rw.SetSize(1280, 720)
+	size = RENDER_SIZE if quality is None else quality['size']
+	rw.SetSize(size[0], size[1])
+
+	return rw, iren
+
+def setup_vtk_pipeline(roi,allz_num,out,quality=None):
+	quality = get_quality_tier(quality)
+
+	#read muse roi as itk image once and use everywhere
+	muse_itk_image = read_itk_image(roi)
+
+	#generate dict[roi label]=zscore
+	relabelMap = create_relabel_map(muse_itk_image,allz_num)
+
+	#list of roi that need relabeling for visualization
+	need2relabel = get_zscore_labeled_roi_list(allz_num)
+
+	# render_scalarbar(relabelMap,need2relabel)
+
+	#read muse roi image as vtk image once and use everywhere (the clipping planes are found on the full resolution image)
+	muse_vtk_img = downsample_vtk_image(get_vtk_image(roi), quality['downsample'])
+
+	rw, iren = render_views(muse_itk_image, muse_vtk_img, relabelMap, need2relabel, quality=quality)
 
 	#save rendered image
 	fname= out +'_finalvis.png'
@@ -436,6 +480,334 @@ def setup_vtk_pipeline(roi,allz_num,out):
 
 	iren.Start()
 
+#### Label-ID render cache ###
+# For a label map that is the same for all subjects (e.g. a template), the views are rendered once into
+#   - a label-ID image: index of the label seen at each pixel (labels rendered with flat, unique code colors)
+#   - a shading image: diffuse and specular factors of each pixel (labels rendered in two shades of gray)
+#   - an overlay image: titles and colorbar
+# and cached on disk, keyed by the hash of the label map. Each subject's views are then recolored with a lookup
+# table of the z-score colors of get_color_TF, without rendering.
+
+# Location of the cache (one file per label map) #
+LABEL_CACHE_DIR = _os.environ.get('BRAINVIS_CACHE_DIR', '/refs/brainvis_cache')
+# Bump when the views or the cache layout change #
+LABEL_CACHE_VERSION = 1
+# Gray levels of the two shading renders #
+SHADE_GRAYS = (0.5, 0.1)
+# Largest distance (in code levels) of a rendered code color to an exact code #
+ID_CODE_TOLERANCE = 0.2
+
+### Function to hash a label map file
+def hash_label_map(fname):
+	with open(fname, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+### Function to get the code color (0-255 RGB) of label index i: 16 levels per channel, 17 apart
+def label_id_code(i):
+	return np.array([i % 16, (i // 16) % 16, i // 256])*17
+
+### Function to get the color transfer function coloring each label with its code color
+###   codes: code index of each label (1..number of labels, 0 is the background)
+def get_label_id_TF(labels, codes):
+	funcColor = vtk.vtkColorTransferFunction()
+	for idx, i in zip(labels, codes):
+		code = label_id_code(i)/255
+		funcColor.AddRGBPoint(idx, code[0], code[1], code[2])
+	funcColor.AddRGBPoint(0, 0, 0, 0)
+	return funcColor
+
+### Function to decode a code color render into code indices, with a mask of the pixels showing an exact code color
+def decode_label_ids(pixels):
+	codes = pixels*255/17
+	levels = np.rint(codes).astype(np.int64)
+	ids = levels[:,:,0] + levels[:,:,1]*16 + levels[:,:,2]*256
+	exact = np.abs(codes - levels).max(axis=2) < ID_CODE_TOLERANCE
+	return ids, exact
+
+### Function to replace the invalid label IDs with the ID of a valid neighbor (8-connected, grown up to max_steps pixels)
+def fill_label_ids(ids, valid, max_steps=8):
+	ids = ids.copy()
+	valid = valid.copy()
+	for step in range(max_steps):
+		if valid.all():
+			break
+		for dy, dx in [(-1,0),(1,0),(0,-1),(0,1),(-1,-1),(-1,1),(1,-1),(1,1)]:
+			neighbor_ids = np.roll(ids, (dy, dx), axis=(0, 1))
+			neighbor_valid = np.roll(valid, (dy, dx), axis=(0, 1))
+			take = ~valid & neighbor_valid & (neighbor_ids > 0)
+			ids[take] = neighbor_ids[take]
+			valid |= take
+	ids[~valid] = 0
+	return ids
+
+### Function to get the color transfer function coloring all labels with one gray level
+def get_gray_TF(labels, gray):
+	funcColor = vtk.vtkColorTransferFunction()
+	for idx in labels:
+		funcColor.AddRGBPoint(idx, gray, gray, gray)
+	funcColor.AddRGBPoint(0, gray, gray, gray)
+	return funcColor
+
+### Function to read the pixels of a render window as a (height, width, 3) float array, top row first
+def window_to_array(rw):
+	return window_pixels(rw).astype(np.float32)/255
+
+### Function to read the pixels of a render window as a (height, width, 3) uint8 array, top row first
+def window_pixels(rw):
+	windowToImageFilter = vtk.vtkWindowToImageFilter()
+	windowToImageFilter.SetInput(rw)
+	windowToImageFilter.Update()
+	image = windowToImageFilter.GetOutput()
+	width, height, _ = image.GetDimensions()
+	pixels = numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(height, width, -1)[:,:,:3]
+	return np.ascontiguousarray(pixels[::-1])
+
+### Function to render the label-ID, shading and overlay images of a label map
+def build_label_cache(roi):
+	muse_itk_image = read_itk_image(roi)
+	muse_vtk_img = get_vtk_image(roi)
+	stats = sitk.LabelShapeStatisticsImageFilter()
+	stats.Execute(muse_itk_image)
+	labels = np.array(stats.GetLabels(), dtype=np.int64)
+	if len(labels) >= 16**3:
+		raise ValueError('Too many labels for the label-ID cache: ' + str(len(labels)))
+	relabelMap = dict.fromkeys(labels.tolist(), 0)
+
+	# Label index seen at each pixel (0: background), rendered twice with flat code colors in opposite orders
+	# Pixels blending several labels (or a label and the background) do not show the same exact code in both renders,
+	# they take the label of their nearest neighbor with a consistent code
+	nlabels = len(labels)
+	passes = []
+	for codes in [np.arange(1, nlabels + 1), np.arange(nlabels, 0, -1)]:
+		rw, iren = render_views(muse_itk_image, muse_vtk_img, relabelMap, [], color_tf=get_label_id_TF(labels, codes), shade=False, background=(0,0,0), annotations=False)
+		code_ids, exact = decode_label_ids(window_to_array(rw))
+		# code index -> label index (1..number of labels)
+		index = np.zeros(max(code_ids.max(), nlabels) + 1, dtype=np.int64)
+		index[codes] = np.arange(1, nlabels + 1)
+		passes.append((index[code_ids], exact))
+	ids = passes[0][0]
+	background = (passes[0][0] == 0) & (passes[1][0] == 0)
+	valid = background | (passes[0][1] & passes[1][1] & (passes[0][0] == passes[1][0]))
+	ids = fill_label_ids(np.where(background, 0, ids), valid)
+
+	# Shaded gray renders: pixel = gray*diffuse + specular (both including the blending with the white background)
+	shades = []
+	for gray in SHADE_GRAYS:
+		rw, iren = render_views(muse_itk_image, muse_vtk_img, relabelMap, [], color_tf=get_gray_TF(labels, gray), annotations=False)
+		shades.append(window_to_array(rw)[:,:,0])
+	diffuse = (shades[0] - shades[1])/(SHADE_GRAYS[0] - SHADE_GRAYS[1])
+	specular = shades[0] - SHADE_GRAYS[0]*diffuse
+
+	# Titles and colorbar only
+	rw, iren = render_views(muse_itk_image, muse_vtk_img, relabelMap, [], volumes=False)
+	overlay = window_to_array(rw)
+	overlay_mask = np.any(overlay < 1, axis=2)
+
+	return {'version':LABEL_CACHE_VERSION, 'labels':labels, 'ids':ids.astype(np.uint16), 'diffuse':diffuse, 'specular':specular, 'overlay':overlay, 'overlay_mask':overlay_mask}
+
+### Function to read the label-ID cache of a label map, None if it is missing or stale
+def read_label_cache(roi, cachedir=LABEL_CACHE_DIR):
+	cachefile = _os.path.join(cachedir, hash_label_map(roi) + '.npz')
+	if not _os.path.exists(cachefile):
+		return None
+	cache = dict(np.load(cachefile))
+	if int(cache['version']) != LABEL_CACHE_VERSION or tuple(cache['ids'].shape) != (RENDER_SIZE[1], RENDER_SIZE[0]):
+		return None
+	return cache
+
+### Function to check if the label-ID cache of a label map is built and up to date (e.g. at the image build)
+def has_label_cache(roi, cachedir=LABEL_CACHE_DIR):
+	return _os.path.exists(roi) and read_label_cache(roi, cachedir) is not None
+
+### Function to load the label-ID cache of a label map, rendering and saving it if it is missing or stale
+def load_label_cache(roi, cachedir=LABEL_CACHE_DIR):
+	cache = read_label_cache(roi, cachedir)
+	if cache is not None:
+		return cache
+	print("Label-ID cache not found or out of date, rendering " + roi + "...")
+
+	cachefile = _os.path.join(cachedir, hash_label_map(roi) + '.npz')
+	cache = build_label_cache(roi)
+	try:
+		_os.makedirs(cachedir, exist_ok=True)
+		np.savez_compressed(cachefile + '.tmp.npz', **cache)
+		_os.replace(cachefile + '.tmp.npz', cachefile)
+	except OSError as e:
+		print("Label-ID cache could not be saved: " + str(e))
+
+	return cache
+
+### Function to color the cached views of a label map with the z-scores of a subject
+###   Returns the (height, width, 3) uint8 RGB image of the views
+def recolor_label_cache(cache, allz_num):
+	labels = cache['labels']
+	relabelMap = relabel_map_from_labels(labels, allz_num)
+	need2relabel = get_zscore_labeled_roi_list(allz_num)
+
+	# Lookup table: label index -> z-score color (index 0: background)
+	color_tf = get_color_TF(relabelMap, need2relabel)
+	lut = np.ones((len(labels) + 1, 3), dtype=np.float32)
+	lut[1:] = [color_tf.GetColor(int(idx)) for idx in labels]
+
+	ids = cache['ids']
+	rgb = lut[ids]*cache['diffuse'][:,:,None] + cache['specular'][:,:,None]
+	rgb[ids == 0] = 1
+	rgb = np.where(cache['overlay_mask'][:,:,None], cache['overlay'], rgb)
+
+	return np.clip(np.rint(rgb*255), 0, 255).astype(np.uint8)
+
+def setup_cached_pipeline(roi,allz_num,out):
+	cache = load_label_cache(roi)
+	rgb = recolor_label_cache(cache, allz_num)
+
+	#save recolored image
+	fname= out +'_finalvis.png'
+	sitk.WriteImage(sitk.GetImageFromArray(rgb, isVector=True), fname)
+
+#### Surface rendering ###
+# Alternative to the volume ray cast for subject label maps: the boundary surface of each label is extracted once
+# (discrete flying edges, then decimation), cached on disk keyed by the hash of the label map, and rendered as
+# polygons colored by label with the same color transfer function.
+# Opt-in (BRAINVIS_MODE='surface'): a subject label map is seen once, so the extraction is paid on every report, and
+# the software-rendered meshes are slower than the ray cast and further from it (see benchmark_brainvisual.py).
+
+# Bump when the surface extraction changes #
+SURFACE_CACHE_VERSION = 1
+# Fraction of the triangles removed by the decimation of each label surface #
+SURFACE_DECIMATION = 0.98
+# Smoothing iterations of each label surface (voxel staircase), before the decimation #
+SURFACE_SMOOTHING_ITERATIONS = 15
+
+### Function to extract the decimated boundary surface of each label, as one polydata with a 'label' cell array
+def extract_label_surfaces(image, labels):
+	surface = vtk.vtkDiscreteFlyingEdges3D()
+	surface.SetInputData(image)
+	for i, idx in enumerate(labels):
+		surface.SetValue(i, int(idx))
+	surface.ComputeNormalsOff()
+	surface.ComputeGradientsOff()
+	surface.ComputeScalarsOn()
+	surface.Update()
+	surface.GetOutput().GetPointData().SetActiveScalars(surface.GetOutput().GetPointData().GetArrayName(0))
+
+	append = vtk.vtkAppendPolyData()
+	for idx in labels:
+		# Surface of one label (shared boundaries are extracted once per label)
+		label_surface = vtk.vtkThreshold()
+		label_surface.SetInputConnection(surface.GetOutputPort())
+		label_surface.SetLowerThreshold(int(idx))
+		label_surface.SetUpperThreshold(int(idx))
+		label_surface.SetThresholdFunction(vtk.vtkThreshold.THRESHOLD_BETWEEN)
+		geometry = vtk.vtkGeometryFilter()
+		geometry.SetInputConnection(label_surface.GetOutputPort())
+		geometry.Update()
+		if geometry.GetOutput().GetNumberOfCells() == 0:
+			continue
+
+		smooth = vtk.vtkWindowedSincPolyDataFilter()
+		smooth.SetInputConnection(geometry.GetOutputPort())
+		smooth.SetNumberOfIterations(SURFACE_SMOOTHING_ITERATIONS)
+		smooth.NonManifoldSmoothingOn()
+		smooth.NormalizeCoordinatesOn()
+
+		decimate = vtk.vtkQuadricDecimation()
+		decimate.SetInputConnection(smooth.GetOutputPort())
+		decimate.SetTargetReduction(SURFACE_DECIMATION)
+		decimate.Update()
+
+		label_polydata = vtk.vtkPolyData()
+		label_polydata.ShallowCopy(decimate.GetOutput())
+		label_polydata.GetPointData().Initialize()
+		label_array = numpy_support.numpy_to_vtk(np.full(label_polydata.GetNumberOfCells(), int(idx), dtype=np.int32), deep=1)
+		label_array.SetName('label')
+		label_polydata.GetCellData().AddArray(label_array)
+		append.AddInputData(label_polydata)
+
+	normals = vtk.vtkPolyDataNormals()
+	normals.SetInputConnection(append.GetOutputPort())
+	normals.SplittingOff()
+	normals.Update()
+	return normals.GetOutput()
+
+### Function to load the label surfaces of a label map, extracting and saving them if they are missing or stale
+def get_label_surfaces(roi, image, labels, cachedir=LABEL_CACHE_DIR):
+	cachefile = _os.path.join(cachedir, hash_label_map(roi) + '_surfaces_v' + str(SURFACE_CACHE_VERSION) + '.vtp')
+	if _os.path.exists(cachefile):
+		reader = vtk.vtkXMLPolyDataReader()
+		reader.SetFileName(cachefile)
+		reader.Update()
+		return reader.GetOutput()
+
+	print("Label surfaces not found, extracting " + roi + "...")
+	surfaces = extract_label_surfaces(image, labels)
+	try:
+		_os.makedirs(cachedir, exist_ok=True)
+		writer = vtk.vtkXMLPolyDataWriter()
+		writer.SetFileName(cachefile + '.tmp.vtp')
+		writer.SetInputData(surfaces)
+		writer.SetDataModeToBinary()
+		writer.Write()
+		_os.replace(cachefile + '.tmp.vtp', cachefile)
+	except OSError as e:
+		print("Label surfaces could not be saved: " + str(e))
+
+	return surfaces
+
+def get_surface_actor(surfaces,image,relabelMap,need2relabel,clip, orientation, *args):
+
+	if len(args) != 0:
+		bg_t_slice, mid_slice = args #get_plane_from_mri()
+
+	#polygons colored by label with the color transfer function of the volume
+	mapper = vtk.vtkPolyDataMapper()
+	mapper.SetInputData(surfaces)
+	mapper.SetLookupTable(get_color_TF(relabelMap,need2relabel))
+	mapper.SetScalarModeToUseCellFieldData()
+	mapper.SelectColorArray('label')
+	mapper.UseLookupTableScalarRangeOn()
+	mapper.ScalarVisibilityOn()
+	if(clip):
+		#add clipping plane to clip the surfaces
+		mapper.AddClippingPlane(get_clip_plane(image.GetCenter(), orientation, bg_t_slice, mid_slice))
+
+	actor = vtk.vtkActor()
+	actor.SetMapper(mapper)
+	#lower than the volume: surfaces are lit once, not accumulated along the ray (closest to the volume views)
+	actor.GetProperty().SetDiffuse(0.6)
+	actor.GetProperty().SetAmbient(0.1)
+	return actor
+
+def get_outline_actor(image):
+	outline = vtk.vtkOutlineFilter()
+	outline.SetInputData(image)
+	mapper = vtk.vtkPolyDataMapper()
+	mapper.SetInputConnection(outline.GetOutputPort())
+	actor = vtk.vtkActor()
+	actor.SetMapper(mapper)
+	actor.GetProperty().SetOpacity(0)
+	return actor
+
+def setup_surface_pipeline(roi,allz_num,out):
+	#read muse roi as itk image once and use everywhere
+	muse_itk_image = read_itk_image(roi)
+
+	#generate dict[roi label]=zscore
+	relabelMap = create_relabel_map(muse_itk_image,allz_num)
+
+	#read muse roi image as vtk image once and use everywhere
+	muse_vtk_img = get_vtk_image(roi)
+
+	#list of roi that need relabeling for visualization
+	need2relabel = get_zscore_labeled_roi_list(allz_num)
+
+	#label surfaces, extracted once per label map
+	surfaces = get_label_surfaces(roi, muse_vtk_img, [idx for idx in relabelMap.keys() if idx > 0])
+
+	rw, iren = render_views(muse_itk_image, muse_vtk_img, relabelMap, need2relabel, surfaces=surfaces)
+
+	#save rendered image
+	fname= out +'_finalvis.png'
+	save_screeenshot(rw,fname)
 
 def read_itk_image(input_file_path):
 	reader = sitk.ImageFileReader()
@@ -449,14 +821,25 @@ def write_itk_image(img, output_file_path):
 	writer.Execute ( img )
 
 def create_relabel_map(muse_mask,roi_zscore_dict):
-	stats = sitk.LabelShapeStatisticsImageFilter()
-	stats.Execute(muse_mask)
-
+	return relabel_map_from_labels(get_labels(muse_mask),roi_zscore_dict)
+
+### Function to list the labels (non-zero values) of a label map, as LabelShapeStatisticsImageFilter but without
+### computing the shape statistics
+def get_labels(muse_mask):
+	nda = sitk.GetArrayViewFromImage(muse_mask)
+	if np.issubdtype(nda.dtype, np.integer) and nda.min() >= 0:
+		labels = np.flatnonzero(np.bincount(nda.ravel()))
+	else:
+		labels = np.unique(nda)
+	return [int(l) for l in labels if l != 0]
+
+def relabel_map_from_labels(labels,roi_zscore_dict):
 	#create dict
 	#dict: roi label->z score
 	#dict[roi label] = z score
 	merge_label_dict={}
-	for i in stats.GetLabels():
+	for i in labels:
+		i = int(i)
 		#if roi label not found in z score dict, then assign a non muse label(220)
 		if str(i) not in roi_zscore_dict.keys():
 			merge_label_dict[i] = 220
@@ -479,11 +862,37 @@ def get_zscore_labeled_roi_list(roi_zscore_dict):
 	need2relabel = [int(k) for k,v in roi_zscore_dict.items() if float(v) <= -0.524]
 	return need2relabel
 
-def _main( roi, allz_num, pdf_path):
+# Rendering mode: 'volume' (ray cast the label map for each subject, default), 'surface' (opt-in, render the label
+#   surfaces, see Surface rendering)
+#   or 'labelcache' (recolor the cached views of the label map) #
+# The quality tier (BRAINVIS_QUALITY, QUALITY_TIERS) applies to the 'volume' mode #
+BRAINVIS_MODE = _os.environ.get('BRAINVIS_MODE', 'volume')
+
+def _main( roi, allz_num, pdf_path, mode=None, quality=None):
 	UID = _os.path.basename(pdf_path.removesuffix(".pdf"))
 	out = _os.path.dirname(pdf_path)
 	out = out + '/' + UID
-	setup_vtk_pipeline(roi,allz_num,out)
+
+	if mode is None:
+		mode = BRAINVIS_MODE
+	if mode == 'labelcache':
+		setup_cached_pipeline(roi,allz_num,out)
+	elif mode == 'surface':
+		setup_surface_pipeline(roi,allz_num,out)
+	elif mode == 'volume':
+		setup_vtk_pipeline(roi,allz_num,out,quality)
+	else:
+		raise ValueError('Unknown brain visualization mode: ' + str(mode))
+
+# Label-ID caches built ahead of time (image build), for label maps that are the same for every subject
+#   Usage: python3 vtkBrainVisual.py <label map> [<label map> ...] (from /src)
+if __name__ == '__main__':
+	for roi in sys.argv[1:]:
+		if not _os.path.exists(roi):
+			print("Label map not found, no label-ID cache built: " + roi)
+			continue
+		load_label_cache(roi)
+		print("Label-ID cache built: " + roi)
 
 # if __name__ == '__main__':
 # 	roi_file = '/home/diwu/Desktop/F2/2.16.840.1.114362.1.12066432.24920037488.604832326.447.1607/relabel/2.16.840.1.114362.1.12066432.24920037488.604832326.447.1607.nii.gz'
@@ -0,0 +1,89 @@
+import csv
+import numpy as np
+import SimpleITK as sitk
+
+#### Lookup-table relabeling of label images ###
+# A label mapping {old label: new label} is compiled once into a dense lookup table (lut[old label] = new label) and a
+# label image is relabeled in one pass, lut[labels], on its native-dtype array (no statistics, no per-label filter).
+# Labels that are not in the mapping keep their value (default=None, as sitk.ChangeLabel) or are set to a default
+# label (e.g. 0 to drop them).
+# The output has the pixel type and the geometry (origin, spacing, direction) of the input, as with sitk.ChangeLabel.
+
+### Function to compile a label mapping {old label: new label} into a lookup table (int64 array over 0..max old label)
+###   default: new label of the labels not in the mapping, None: unchanged
+def compile_lut(mapping, default=None):
+    old_labels = np.array([int(k) for k in mapping.keys()], dtype=np.int64)
+    new_labels = np.array([int(v) for v in mapping.values()], dtype=np.int64)
+    if len(old_labels) > 0 and old_labels.min() < 0:
+        raise ValueError('Negative labels are not supported in a label mapping')
+
+    size = int(old_labels.max()) + 1 if len(old_labels) > 0 else 1
+    lut = np.arange(size, dtype=np.int64) if default is None else np.full(size, int(default), dtype=np.int64)
+    lut[old_labels] = new_labels
+    return lut
+
+### Function to read a label mapping from two columns of a csv file (with header), e.g. IndexConsecutive -> IndexMUSE
+def read_mapping_csv(csv_path, label_from, label_to):
+    with open(csv_path) as roiMap:
+        return {int(row[label_from]): int(row[label_to]) for row in csv.DictReader(roiMap)}
+
+### Function to read the combine_labels mapping csv (no header): derived label in the 2nd column, labels combined into
+### it from the 4th column onwards
+def read_combine_csv(csv_path):
+    with open(csv_path) as roiMap:
+        mapDict = {}
+        for row in csv.reader(roiMap, delimiter=','):
+            for x in row[3:]:
+                mapDict[int(x)] = int(row[1])
+    return mapDict
+
+### Function to extend a lookup table to the labels 0..size-1, the labels added being handled as the labels not in the
+### mapping (default)
+def extend_lut(lut, size, default=None):
+    if size > len(lut):
+        extra = np.arange(len(lut), size, dtype=np.int64) if default is None else np.full(size - len(lut), int(default), dtype=np.int64)
+        lut = np.concatenate([lut, extra])
+    return lut
+
+### Function to get the new label of one label with a lookup table
+def lookup_label(lut, label, default=None):
+    if 0 <= label < len(lut):
+        return int(lut[label])
+    return label if default is None else int(default)
+
+### Function to compose two lookup tables (first, then second) into one: (lookup table, default)
+###   relabeling with the result is the same as relabeling with first then with second, in one pass
+def compose_lut(first, second, first_default=None, second_default=None):
+    # The tables only cover the labels of the mappings, whatever the new labels of first
+    lut = apply_lut_array(extend_lut(first, len(second), first_default), second, second_default)
+    # Labels outside of the table: unchanged by first, or all set to its default
+    default = second_default if first_default is None else lookup_label(second, int(first_default), second_default)
+    return lut, default
+
+### Function to relabel an array of labels with a lookup table (compile_lut), in the dtype of the array
+###   labels outside of the table (negative or above it) are not looked up, so the table is never grown to the labels
+def apply_lut_array(labels, lut, default=None):
+    if not np.issubdtype(labels.dtype, np.integer):
+        raise ValueError('Label images must have an integer pixel type, not ' + str(labels.dtype))
+
+    # New labels cast to the pixel type (as sitk.ChangeLabel does)
+    lut = lut.astype(labels.dtype)
+    low, high = int(labels.min()), int(labels.max())
+    if low >= 0 and high < len(lut):
+        return lut[labels]
+
+    inside = (labels >= 0) & (labels < len(lut)) if low < 0 else labels < len(lut)
+    # Labels clipped to the table (the upper bound is at most the highest label, so it fits the dtype)
+    index = np.clip(labels, 0, max(min(high, len(lut) - 1), 0))
+    outside = labels if default is None else np.array(int(default)).astype(labels.dtype)
+    return np.where(inside, lut[index], outside)
+
+### Function to relabel a label image with a lookup table (compile_lut)
+def apply_lut(image, lut, default=None):
+    output = sitk.GetImageFromArray(apply_lut_array(sitk.GetArrayViewFromImage(image), lut, default))
+    output.CopyInformation(image)
+    return output
+
+### Function to relabel a label image with a label mapping {old label: new label}
+def relabel_image(image, mapping, default=None):
+    return apply_lut(image, compile_lut(mapping, default), default)
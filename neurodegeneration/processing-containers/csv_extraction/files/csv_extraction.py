@@ -4,19 +4,29 @@ import pandas as pd
 import numpy as np
 import csv
 
-def extractTable1(dfRef,dfSub):
+# Mean and std of a reference column, precomputed by roi_quantifier if available
+def refMeanStd(dfRef,col,normStats=None):
+	if normStats is not None and col in normStats['Report']:
+		return normStats['Report'][col]['mean'], normStats['Report'][col]['std']
+	return dfRef[col].mean(), dfRef[col].std()
+
+def zscore(value,dfRef,col,normStats=None):
+	refmean, refstd = refMeanStd(dfRef,col,normStats)
+	return round((value - refmean)/refstd,2)
+
+def extractTable1(dfRef,dfSub,normStats=None):
 	names = ['Brain', 'Ventricle', 'Gray Matter', 'White Matter', 'Brainstem', 'Cerebellum', 'Hippocampus']
 
 	for key in names:
-		totalnorm = round((dfSub["Total " + key + " Volume"].values[0] - dfRef["Total " + key + " Volume"].mean())/dfRef["Total " + key + " Volume"].std(),2)
+		totalnorm = zscore(dfSub["Total " + key + " Volume"].values[0],dfRef,"Total " + key + " Volume",normStats)
 
 		if 'Brainstem' in key:
 			dfSub["Brainstem Bilateral Z-score"] = totalnorm
 		# If roi does have L/R component
 		else:
-			Rnorm = round((dfSub["Right " + key + " Volume"].values[0] - dfRef["Right " + key + " Volume"].mean())/dfRef["Right " + key + " Volume"].std(),2)
-			Lnorm = round((dfSub["Left " + key + " Volume"].values[0] - dfRef["Left " + key + " Volume"].mean())/dfRef["Left " + key + " Volume"].std(),2)
-			AInorm = round((dfSub[key + " AI"].values[0] - dfRef[key + " AI"].mean())/dfRef[key + " AI"].std(),2)
+			Rnorm = zscore(dfSub["Right " + key + " Volume"].values[0],dfRef,"Right " + key + " Volume",normStats)
+			Lnorm = zscore(dfSub["Left " + key + " Volume"].values[0],dfRef,"Left " + key + " Volume",normStats)
+			AInorm = zscore(dfSub[key + " AI"].values[0],dfRef,key + " AI",normStats)
 			
 			# Add Whole prefix to Brain ROI
 			if key == 'Brain':
@@ -32,7 +42,7 @@ def extractTable1(dfRef,dfSub):
 
 	return dfSub
 
-def extractTable2(dfRef,dfSub,mydict,MUSErois,path):
+def extractTable2(dfRef,dfSub,mydict,MUSErois,path,normStats=None):
 	maphemi = pd.read_csv('/refs/MUSE_ROI_Dictionary.csv')
 	all_entries = ""
 
@@ -55,14 +65,21 @@ def extractTable2(dfRef,dfSub,mydict,MUSErois,path):
 		base[0] = 'Right'
 		j = ' '.join(base)
 
-		# Calculate AI column for ROI-pairing
-		AI_ref = (dfRef[str(L[i])] - dfRef[str(R[j])]).abs().div((dfRef[str(L[i])] + dfRef[str(R[j])])/2, axis = 0)
 		AI = abs(MUSErois[i] - MUSErois[j])/((MUSErois[i] + MUSErois[j])/2)
 
 		# Add to AI_zscore dictionary with format 'Base name of single ROI: AI z-score'
 		base[1] = base[1].title()
 		basename = ' '.join(base[1:])
-		AI_zscores[basename] = abs(round((AI - AI_ref.mean())/AI_ref.std(),2))
+
+		# Reference AI distribution for ROI-pairing, precomputed by roi_quantifier if available
+		if normStats is not None and basename in normStats['AI']:
+			AI_ref_mean = normStats['AI'][basename]['mean']
+			AI_ref_std = normStats['AI'][basename]['std']
+		else:
+			AI_ref = (dfRef[str(L[i])] - dfRef[str(R[j])]).abs().div((dfRef[str(L[i])] + dfRef[str(R[j])])/2, axis = 0)
+			AI_ref_mean = AI_ref.mean()
+			AI_ref_std = AI_ref.std()
+		AI_zscores[basename] = abs(round((AI - AI_ref_mean)/AI_ref_std,2))
 		AI_subj[basename] = round(AI,2)
 
 	# Identify flagrant z-scores (anything >=abs(1.28))
@@ -99,7 +116,7 @@ def extractTable2(dfRef,dfSub,mydict,MUSErois,path):
 
 	dfSub.to_csv(path)
 
-def _main(dfSub, dfRef, WMLSref, allz_num, allz, all_MuseROIs_name, spareAD, spareBA, pdf_path):
+def _main(dfSub, dfRef, WMLSref, allz_num, allz, all_MuseROIs_name, spareAD, spareBA, pdf_path, normStats=None):
 	UID = _os.path.basename(pdf_path.removesuffix(".pdf"))
 	out = _os.path.dirname(pdf_path)
 
@@ -108,5 +125,5 @@ def _main(dfSub, dfRef, WMLSref, allz_num, allz, all_MuseROIs_name, spareAD, spa
 	dfSub['SPARE_AD'] = spareAD
 	dfSub['SPARE_BA'] = spareBA
 
-	dfSub = extractTable1(dfRef,dfSub)
-	extractTable2(dfRef,dfSub,allz,all_MuseROIs_name,_os.path.join(out,UID+'_info.csv'))
\ No newline at end of file
+	dfSub = extractTable1(dfRef,dfSub,normStats)
+	extractTable2(dfRef,dfSub,allz,all_MuseROIs_name,_os.path.join(out,UID+'_info.csv'),normStats)
\ No newline at end of file
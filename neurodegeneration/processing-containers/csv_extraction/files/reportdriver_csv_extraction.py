@@ -28,6 +28,7 @@ for batch_element_dir in batch_folders:
     all_MuseROIs_name = sorted(glob.glob(os.path.join(in_dir_quant, "*all_MuseROIs_name.pkl*"), recursive=True))
     spareAD = sorted(glob.glob(os.path.join(in_dir_spare, "*spareAD.pkl*"), recursive=True))
     spareBA = sorted(glob.glob(os.path.join(in_dir_spare, "*spareBA.pkl*"), recursive=True))
+    normStats = sorted(glob.glob(os.path.join(in_dir_quant, "*normStats.pkl*"), recursive=True))
 
     element_output_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_OUT_DIR'])
     if not os.path.exists(element_output_dir):
@@ -53,8 +54,14 @@ for batch_element_dir in batch_folders:
         spareAD = pickle.load(f)
     with open(spareBA[0],'rb') as f:
         spareBA = pickle.load(f)
+    # Precomputed normative statistics are optional
+    if len(normStats) > 0:
+        with open(normStats[0],'rb') as f:
+            normStats = pickle.load(f)
+    else:
+        normStats = None
 
     out_path=os.path.join(batch_element_dir, os.environ['OPERATOR_OUT_DIR'])
     pdf_file_path = os.path.join(out_path, "{}.pdf".format(os.path.basename(batch_element_dir)))
 
-    csv_extraction._main(dfSub, dfRef, WMLSref, allz_num, allz, all_MuseROIs_name, spareAD, spareBA, pdf_file_path)
\ No newline at end of file
+    csv_extraction._main(dfSub, dfRef, WMLSref, allz_num, allz, all_MuseROIs_name, spareAD, spareBA, pdf_file_path, normStats)
\ No newline at end of file
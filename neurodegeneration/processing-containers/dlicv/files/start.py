@@ -5,6 +5,7 @@ import SimpleITK as sitk
 import nibabel
 import sys, os
 import glob
+import imageformat
 from datetime import datetime
 
 ### For local testng
@@ -100,12 +101,12 @@ for batch_element_dir in batch_folders:
         if not os.path.exists(element_output_dir):
             os.makedirs(element_output_dir)
 
-        #generate output nrrd file path
-        output_file_path = os.path.join(element_output_dir, "{}.nrrd".format(os.path.basename(batch_element_dir)))
+        #generate output file path (nrrd, or the intermediate format of the pipeline)
+        output_file_path = os.path.join(element_output_dir, "{}{}".format(os.path.basename(batch_element_dir), imageformat.intermediate_extension(".nrrd")))
 
-        #read nifti & write output as nrrd
+        #read nifti & write output
         dlicv_nii_result = read_image(temp_dlicv_output_nii)
-        write_image(dlicv_nii_result,output_file_path)
+        imageformat.write_image(dlicv_nii_result,output_file_path)
 
         #delete all temp files
         remove_files_from_folder('/tempmuse')
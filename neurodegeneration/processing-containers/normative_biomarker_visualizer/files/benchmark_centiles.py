@@ -0,0 +1,62 @@
+import sys
+import time
+import warnings
+import numpy as np
+import refstore
+import centiles
+
+# Benchmark of the centile curve estimators on the bundled reference values
+#   Fits the 10/50/90 curves of each sex, variable and diagnosis group with ExpectileGAM ('gam') and with the
+#   local-linear expectiles ('loess'), and reports the fitting times and the differences between the two curves
+#   (in % of the ExpectileGAM 10th-90th spread, averaged over the grid and at the worst age of the grid)
+#   Usage: python3 benchmark_centiles.py [--rois]
+#   --rois: also fit every single MUSE ROI of the reference values (ICV-adjusted), not only the plotted variables
+
+### Function to list the reference values to fit: (sex, variable, diagnosis, X, y)
+def benchmarkCases(allRois):
+	cases = []
+	for sex in ['F','M']:
+		dfRef, WMLSref = centiles.refPlotValues(refstore.MUSE_Ref_Values, refstore.WMLS_Ref_Values, sex, True)
+		variables = [(dfRef, v) for v in list(centiles.REF_PLOT_ROIS.keys()) + centiles.REF_PLOT_SCORES] + [(WMLSref, v) for v in centiles.WMLS_PLOT_ROIS.keys()]
+		if allRois:
+			dfRois = refstore.loadRef(refstore.MUSE_Ref_Values, sex)
+			for col in dfRois.columns:
+				if col.isdigit() and int(col) < 300:
+					dfRef[col] = dfRois[col].div(dfRois['702'], axis=0)*float(dfRois['702'].mean())/1000
+					variables.append((dfRef, col))
+		for ref, variable in variables:
+			for diagnosis in centiles.DIAGNOSES:
+				diagRef = ref.loc[ref['Diagnosis_nearest_2.0'] == diagnosis].dropna(subset=[variable])
+				cases.append((sex, variable, diagnosis, diagRef.Age.values.reshape([-1,1]), diagRef[variable].values.reshape([-1,1])))
+
+	return cases
+
+### Function to time one estimator
+def timeFit(method, X, y):
+	start = time.perf_counter()
+	curves = centiles.fitCentileCurves(X, y, method)
+	return curves, time.perf_counter() - start
+
+if __name__ == '__main__':
+	warnings.filterwarnings('ignore')
+	allRois = '--rois' in sys.argv[1:]
+
+	times = {'gam':[], 'loess':[]}
+	meanErrs = []
+	maxErrs = []
+	print(f'{"sex":3s} {"variable":42s} {"dx":2s} {"n":>5s} {"gam ms":>8s} {"loess ms":>8s} {"mean %":>7s} {"max %":>7s}')
+	for sex, variable, diagnosis, X, y in benchmarkCases(allRois):
+		gam, tGam = timeFit('gam', X, y)
+		loess, tLoess = timeFit('loess', X, y)
+		times['gam'].append(tGam)
+		times['loess'].append(tLoess)
+
+		# Differences of the 90th, 50th and 10th curves, relative to the 10th-90th spread of ExpectileGAM
+		spread = np.mean(np.array(gam[1]) - np.array(gam[3]))
+		diff = np.abs(np.array(gam[1:]) - np.array(loess[1:]))/spread*100
+		meanErrs.append(diff.mean())
+		maxErrs.append(diff.max())
+		print(f'{sex:3s} {variable[:42]:42s} {diagnosis:2s} {len(y):5d} {tGam*1000:8.1f} {tLoess*1000:8.1f} {diff.mean():7.2f} {diff.max():7.2f}')
+
+	print(f'\n{len(meanErrs)} curves   gam {np.sum(times["gam"]):.2f} s   loess {np.sum(times["loess"]):.2f} s   speedup {np.sum(times["gam"])/np.sum(times["loess"]):.1f}x')
+	print(f'difference (% of the 10th-90th spread)   mean {np.mean(meanErrs):.2f}   median of max {np.median(maxErrs):.2f}   worst {np.max(maxErrs):.2f}')
@@ -0,0 +1,280 @@
+import sys
+import json
+import numpy as np
+import os as _os
+import refstore
+from cpuquota import pool_workers
+from multiprocessing import Pool
+from pygam import ExpectileGAM
+
+#### Precomputed 10/50/90 centile curves of the normative plots ###
+# The curves only depend on the reference values, the sex of the subject, the plotted variable, the diagnosis
+# group and whether the volumes are ICV-adjusted, so they are fitted once, at image build time, and read at report time.
+# Each curve is stored with a fingerprint of the reference values it was fitted on. If the reference values
+# passed on by the roi quantifier do not match it (or the curve is missing), the curve is fitted for the report.
+# Curves that have to be fitted are fitted in parallel, in CENTILE_WORKERS processes (default: 1, 0: all cores available to the
+# container), capped by the CPU quota of the container.
+# Curves are fitted with ExpectileGAM ('gam') or with the vectorized local-linear expectiles ('loess'), per variable.
+# The method of each variable can be set with CENTILE_METHODS="<variable>=<method>;..." (use "default=<method>" for all others).
+# Usage: python3 centiles.py [output json]   (default: /refs/MUSE_NormCentiles.json)
+
+# Precomputed centile curves #
+MUSE_Norm_Centiles = '/refs/MUSE_NormCentiles.json'
+# Bump when the fitting or the reference values of the plots change #
+NORM_CENTILES_VERSION = 2
+
+# Number of ages in the grid of each curve #
+CENTILE_GRID = 100
+
+# Fitting method of each variable (variables that are not listed use 'default') #
+CENTILE_METHODS = {'default':'gam'}
+for entry in _os.environ.get('CENTILE_METHODS', '').split(';'):
+	if '=' in entry:
+		CENTILE_METHODS[entry.split('=')[0].strip()] = entry.split('=')[1].strip()
+
+# Number of processes fitting the curves #
+CENTILE_WORKERS = pool_workers(int(_os.environ.get('CENTILE_WORKERS', 1)))
+
+# Plotted reference ROIs (sum of MUSE ROIs, as in calcRefReportVolumes of the roi quantifier) #
+REF_PLOT_ROIS = {'Total Brain Volume':['701'],
+                 'Total Ventricle Volume':['509'],
+                 'Total Gray Matter Volume':['601'],
+                 'Total Brainstem Volume':['35','61','62'],
+                 'Total Hippocampus Volume':['47','48']}
+WMLS_PLOT_ROIS = {'Total White Matter Hyperintensity Volume':['604']}
+# Plotted reference scores (not adjusted) #
+REF_PLOT_SCORES = ['SPARE_AD','SPARE_BA']
+
+DIAGNOSES = ['CN','AD']
+
+# Curves read (or fitted) in this process #
+_normCentiles = None
+
+################################################ FUNCTIONS ################################################
+
+### Function to fit the 10th, 50th and 90th expectile curves of y over age X with ExpectileGAM
+###   Returns the age grid and the 90th, 50th and 10th centile curves as lists
+def fitGamExpectiles(X, y, n=CENTILE_GRID):
+	# fit the mean model first by CV
+	gam50 = ExpectileGAM(expectile=0.5).gridsearch(X, y)
+
+	# and copy the smoothing to the other models
+	lam = gam50.lam
+
+	# fit a few more models
+	gam90 = ExpectileGAM(expectile=0.90, lam=lam).fit(X, y)
+	gam10 = ExpectileGAM(expectile=0.10, lam=lam).fit(X, y)
+
+	XX = gam50.generate_X_grid(term=0, n=n)
+	XX90 = list(gam90.predict(XX).flatten())
+	XX50 = list(gam50.predict(XX).flatten())
+	XX10 = list(gam10.predict(XX).flatten())
+	XX = list(XX.flatten())
+
+	return XX, XX90, XX50, XX10
+
+### Function to choose the kernel width (in years) of the local expectiles
+###   Normal reference rule, widened by 1.5 as the 10th/90th expectiles are noisier than the mean
+def loessBandwidth(x):
+	spread = min(np.std(x), (np.percentile(x, 75) - np.percentile(x, 25))/1.34)
+	if spread <= 0:
+		spread = max(np.std(x), 1.0)
+	return 1.5*1.06*spread*x.size**(-1/5)
+
+### Function to fit the 10th, 50th and 90th expectile curves of y over age X with local-linear (LOESS-like) expectiles
+###   At each age of the grid, a Gaussian-weighted line is fitted by asymmetric least squares (as ExpectileGAM does)
+###   All ages of the grid are solved together, the weights are iterated until the sign of the residuals is stable
+###   Returns the age grid (same as ExpectileGAM) and the 90th, 50th and 10th centile curves as lists
+def fitLoessExpectiles(X, y, n=CENTILE_GRID, maxIter=100):
+	x = np.asarray(X, dtype=np.float64).ravel()
+	y = np.asarray(y, dtype=np.float64).ravel()
+
+	XX = np.linspace(x.min(), x.max(), n)
+	# Distance of each reference subject (columns) to each age of the grid (rows), and Gaussian kernel weights
+	D = x[None,:] - XX[:,None]
+	K = np.exp(-0.5*(D/loessBandwidth(x))**2)
+	# Terms of the weighted least squares sums (K, K*D, K*D^2, K*y, K*D*y), and their sums over all subjects
+	M = np.stack([K, K*D, K*D*D, K*y[None,:], K*D*y[None,:]])
+	Mall = M.sum(axis=2)
+
+	curves = {}
+	for expectile in [0.9, 0.5, 0.1]:
+		# Start from (symmetric) least squares
+		sums = Mall
+		above = None
+		for i in range(maxIter):
+			# Weighted least squares line at each age of the grid
+			S0, S1, S2, T0, T1 = sums
+			det = S0*S2 - S1*S1
+			intercept = (S2*T0 - S1*T1)/det
+			slope = (S0*T1 - S1*T0)/det
+
+			# Asymmetric weights from the sign of the residuals: expectile above the line, 1 - expectile below
+			aboveNew = y[None,:] >= intercept[:,None] + slope[:,None]*D
+			if above is not None and np.array_equal(aboveNew, above):
+				break
+			above = aboveNew
+			sums = (1 - expectile)*Mall + (2*expectile - 1)*np.einsum('kij,ij->ki', M, above.astype(np.float64))
+		curves[expectile] = list(intercept)
+
+	return list(XX), curves[0.9], curves[0.5], curves[0.1]
+
+# Fitting methods #
+CENTILE_FITTERS = {'gam':fitGamExpectiles, 'loess':fitLoessExpectiles}
+
+### Function to get the fitting method of a variable
+def centileMethod(variable):
+	method = CENTILE_METHODS.get(variable, CENTILE_METHODS['default'])
+	if method not in CENTILE_FITTERS:
+		raise ValueError('Unknown centile method for ' + variable + ': ' + str(method))
+	return method
+
+### Function to fit the 10th, 50th and 90th centile curves of y over age X with the given method
+def fitCentileCurves(X, y, method='gam'):
+	return CENTILE_FITTERS[method](X, y)
+
+### Function to fit one curve in a worker process: task is (X, y, method)
+def _fitCentileTask(task):
+	return fitCentileCurves(*task)
+
+### Function to fit several curves, in parallel if there is more than one
+###   tasks: list of (X, y, method)
+def fitCentileTasks(tasks):
+	workers = min(CENTILE_WORKERS, len(tasks))
+	if workers <= 1:
+		return [_fitCentileTask(task) for task in tasks]
+
+	with Pool(workers) as pool:
+		return pool.map(_fitCentileTask, tasks)
+
+### Function to name a curve
+def centileKey(sex, variable, diagnosis, icvAdjusted):
+	return '|'.join([str(sex), variable, diagnosis, 'ICV' if icvAdjusted else 'noICV'])
+
+### Function to summarize the reference values a curve is fitted on (sample count and sums)
+def refFingerprint(X, y):
+	X = np.asarray(X, dtype=np.float64)
+	y = np.asarray(y, dtype=np.float64)
+	return [int(y.size), float(X.sum()), float(y.sum()), float((y*y).sum())]
+
+### Function to compute the plotted reference values of one sex, as passed on by the roi quantifier
+###   Returns the MUSE and the WMLS reference values with Age, diagnosis and the plotted variables
+def refPlotValues(refcsv, wmlscsv, sex, icvAdjusted):
+	plotRefs = []
+	for csvfile, rois, icvcol, scores in [(refcsv, REF_PLOT_ROIS, '702', REF_PLOT_SCORES), (wmlscsv, WMLS_PLOT_ROIS, 'ICV', [])]:
+		dfRef = refstore.loadRef(csvfile, sex)
+		dfPlot = dfRef[['Age','Diagnosis_nearest_2.0'] + scores].copy()
+		for variable, cols in rois.items():
+			vol = dfRef[cols[0]]
+			for col in cols[1:]:
+				vol = vol + dfRef[col]
+			if icvAdjusted:
+				vol = vol.div(dfRef[icvcol], axis=0)*float(dfRef[icvcol].mean())
+			# Convert from mm^3 to cm^3
+			dfPlot[variable] = vol/1000
+		plotRefs.append(dfPlot)
+
+	return plotRefs
+
+### Function to fit all curves of the normative plots
+def buildNormCentiles(refcsv=refstore.MUSE_Ref_Values, wmlscsv=refstore.WMLS_Ref_Values):
+	normCentiles = {'version':NORM_CENTILES_VERSION, 'source':{}, 'curves':{}}
+	for csvfile in [refcsv, wmlscsv]:
+		normCentiles['source'][_os.path.basename(csvfile)] = refstore.stampRefFile(csvfile)
+
+	keys = []
+	tasks = []
+	for sex in ['F','M']:
+		for icvAdjusted in [True, False]:
+			dfRef, WMLSref = refPlotValues(refcsv, wmlscsv, sex, icvAdjusted)
+			for ref, variables in [(dfRef, list(REF_PLOT_ROIS.keys()) + REF_PLOT_SCORES), (WMLSref, list(WMLS_PLOT_ROIS.keys()))]:
+				for variable in variables:
+					for diagnosis in DIAGNOSES:
+						diagRef = ref.loc[ref['Diagnosis_nearest_2.0'] == diagnosis].dropna(subset=[variable])
+						keys.append(centileKey(sex, variable, diagnosis, icvAdjusted))
+						tasks.append((diagRef.Age.values.reshape([-1,1]), diagRef[variable].values.reshape([-1,1]), centileMethod(variable)))
+
+	print('Fitting ' + str(len(tasks)) + ' centile curves in ' + str(min(CENTILE_WORKERS, len(tasks))) + ' processes...')
+	for key, (X, y, method), (XX, XX90, XX50, XX10) in zip(keys, tasks, fitCentileTasks(tasks)):
+		normCentiles['curves'][key] = {'method':method, 'fingerprint':refFingerprint(X, y), 'x':XX, '90':XX90, '50':XX50, '10':XX10}
+
+	return normCentiles
+
+### Function to load the precomputed curves
+###   Returns no curves (i.e. fit them for each report) if the file is missing or stale
+def loadNormCentiles(centilefile=MUSE_Norm_Centiles, refcsv=refstore.MUSE_Ref_Values, wmlscsv=refstore.WMLS_Ref_Values):
+	if not _os.path.exists(centilefile):
+		print("Normative centile curves not found, fitting them from the reference values...")
+		return {}
+
+	with open(centilefile, 'r') as read_file:
+		normCentiles = json.load(read_file)
+
+	if normCentiles.get('version') != NORM_CENTILES_VERSION:
+		print("Normative centile curves version mismatch, fitting them from the reference values...")
+		return {}
+
+	for csvfile in [refcsv, wmlscsv]:
+		if _os.path.exists(csvfile) and normCentiles['source'].get(_os.path.basename(csvfile)) != refstore.stampRefFile(csvfile):
+			print("Normative centile curves out of date with " + csvfile + ", fitting them from the reference values...")
+			return {}
+
+	return normCentiles['curves']
+
+### Function to look up a curve in the curves read (or fitted) in this process
+###   Returns None if it is missing, or if it was fitted with another method or on other reference values
+def _cachedCurves(key, method, fingerprint):
+	global _normCentiles
+	if _normCentiles is None:
+		_normCentiles = loadNormCentiles()
+
+	curves = _normCentiles.get(key)
+	if curves is None or curves.get('method', 'gam') != method or curves['fingerprint'][0] != fingerprint[0] or not np.allclose(curves['fingerprint'], fingerprint, rtol=1e-5, atol=0):
+		return None
+
+	return curves
+
+### Function to fit, at once and in parallel, the curves that are not precomputed
+###   tasks: list of (X, y, sex, variable, diagnosis, icvAdjusted), as passed to getCentileCurves
+def prefetchCentileCurves(tasks):
+	misses = {}
+	for X, y, sex, variable, diagnosis, icvAdjusted in tasks:
+		method = centileMethod(variable)
+		key = centileKey(sex, variable, diagnosis, icvAdjusted)
+		fingerprint = refFingerprint(X, y)
+		if key not in misses and _cachedCurves(key, method, fingerprint) is None:
+			misses[key] = (X, y, method, fingerprint)
+
+	if len(misses) == 0:
+		return
+
+	print("Fitting " + str(len(misses)) + " centile curves in " + str(min(CENTILE_WORKERS, len(misses))) + " processes...")
+	results = fitCentileTasks([(X, y, method) for X, y, method, fingerprint in misses.values()])
+	for (key, (X, y, method, fingerprint)), (XX, XX90, XX50, XX10) in zip(misses.items(), results):
+		_normCentiles[key] = {'method':method, 'fingerprint':fingerprint, 'x':XX, '90':XX90, '50':XX50, '10':XX10}
+
+### Function to get the 10/50/90 curves of y over age X, from the precomputed curves if they match the reference values
+###   method: fitting method ('gam' or 'loess'), by default the one set for the variable
+###   Returns the age grid and the 90th, 50th and 10th centile curves as lists
+def getCentileCurves(X, y, sex, variable, diagnosis, icvAdjusted, method=None):
+	if method is None:
+		method = centileMethod(variable)
+	key = centileKey(sex, variable, diagnosis, icvAdjusted)
+	fingerprint = refFingerprint(X, y)
+	curves = _cachedCurves(key, method, fingerprint)
+	if curves is None:
+		print("Fitting centile curves of " + key + " (" + method + ")...")
+		XX, XX90, XX50, XX10 = fitCentileCurves(X, y, method)
+		curves = {'method':method, 'fingerprint':fingerprint, 'x':XX, '90':XX90, '50':XX50, '10':XX10}
+		_normCentiles[key] = curves
+
+	return list(curves['x']), list(curves['90']), list(curves['50']), list(curves['10'])
+
+if __name__ == '__main__':
+	centilefile = sys.argv[1] if len(sys.argv) > 1 else MUSE_Norm_Centiles
+	if not _os.path.exists(refstore.MUSE_Ref_Values) or not _os.path.exists(refstore.WMLS_Ref_Values):
+		print("Reference values not found, skipping (the centile curves will be fitted for each report)")
+		exit(0)
+	with open(centilefile, 'w') as f:
+		json.dump(buildNormCentiles(), f)
+	print("Normative centile curves written to " + centilefile)
@@ -0,0 +1,35 @@
+import os
+
+#### Cores available to a container ###
+# The CPU affinity of a process is the cores of the node, not the CPU limit of its pod: the limit is a CFS quota of the
+# cgroup of the container. Thread and process pools sized on the affinity alone oversubscribe the quota and are
+# throttled.
+
+### Function to get the number of cores available to this process: its CPU affinity, capped by the CPU quota of its
+### container (cgroup v2 cpu.max or v1 CFS quota), at least 1
+def available_cpus():
+    cpus = len(os.sched_getaffinity(0))
+    quota = None
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            limit, period = f.read().split()[:2]
+        if limit != 'max':
+            quota = int(limit)/int(period)
+    except (OSError, ValueError):
+        try:
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                limit = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit/period
+        except (OSError, ValueError):
+            pass
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+    return cpus
+
+### Function to get the number of workers of a pool: workers (0: all available cores), capped by the available cores
+def pool_workers(workers):
+    cpus = available_cpus()
+    return cpus if workers <= 0 else min(workers, cpus)
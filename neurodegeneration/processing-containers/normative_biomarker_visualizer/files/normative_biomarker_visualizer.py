@@ -2,7 +2,6 @@ import pickle
 import os as _os
 import pandas as pd
 import numpy as np
-from pygam import ExpectileGAM
 from pygam.datasets import mcycle
 from pygam import LinearGAM
 
@@ -19,6 +18,7 @@ import nrrd
 
 from spareAD import createSpareADplot
 from spareBA import createSpareBAplot
+from centiles import getCentileCurves, prefetchCentileCurves
 
 from createcmap import get_continuous_cmap
 
@@ -116,6 +116,10 @@ def plotWithRef(dfRef, WMLSref, dfSub, fname, spareAD, spareBA):
 	lowlim = int(dfSub.Age.values[0]) - 3
 	uplim = int(dfSub.Age.values[0]) + 3
 
+	# Centile curves are the same for all subjects of the same sex and ICV adjustment
+	refSex = dfSub['Sex'].values[0]
+	icvAdjusted = 'ICV' in dfSub.columns and pd.notna(dfSub['ICV'].values[0])
+
 	ADRef_ROI = dfRef.loc[dfRef['Diagnosis_nearest_2.0'] == 'AD']
 	CNRef_ROI = dfRef.loc[dfRef['Diagnosis_nearest_2.0'] == 'CN']
 
@@ -134,6 +138,14 @@ def plotWithRef(dfRef, WMLSref, dfSub, fname, spareAD, spareBA):
 	shownCNsubjs_WMLS = CNRef_WMLS.loc[(lowlim <= CNRef_WMLS['Age']) & (CNRef_WMLS['Age'] <= uplim)].shape[0]
 	shownADsubjs_WMLS = ADRef_WMLS.loc[(lowlim <= ADRef_WMLS['Age']) & (ADRef_WMLS['Age'] <= uplim)].shape[0]
 
+	### Fit the centile curves that are not precomputed (these and the SPARE ones) in parallel, before the plots are assembled
+	centileTasks = []
+	for var, ref in [(selVar, WMLSref if selVar == 'Total White Matter Hyperintensity Volume' else dfRef) for selVar in selVarlst] + [('SPARE_AD', dfRef.dropna(subset=['SPARE_AD'])), ('SPARE_BA', dfRef.dropna(subset=['SPARE_BA']))]:
+		for diagnosis in ['CN','AD']:
+			diagRef = ref.loc[ref['Diagnosis_nearest_2.0'] == diagnosis]
+			centileTasks.append((diagRef.Age.values.reshape([-1,1]), diagRef[var].values.reshape([-1,1]), refSex, var, diagnosis, icvAdjusted))
+	prefetchCentileCurves(centileTasks)
+
 	for idx, selVar in enumerate(selVarlst):
 		## Only allow legend to show up for one of the plots (for display purposes)
 		if mark:
@@ -159,40 +171,9 @@ def plotWithRef(dfRef, WMLSref, dfSub, fname, spareAD, spareBA):
 		X_AD = ADRef.Age.values.reshape([-1,1])
 		y_AD = ADRef[selVar].values.reshape([-1,1])
 
-		##############################################################
-		########### CN values ###########
-		# fit the mean model first by CV
-		gam50 = ExpectileGAM(expectile=0.5).gridsearch(X_CN, y_CN)
-
-		# and copy the smoothing to the other models
-		lam = gam50.lam
-
-		# fit a few more models
-		gam90 = ExpectileGAM(expectile=0.90, lam=lam).fit(X_CN, y_CN)
-		gam10 = ExpectileGAM(expectile=0.10, lam=lam).fit(X_CN, y_CN)
-	
-		XX_CN = gam50.generate_X_grid(term=0, n=100)
-		XX90_CN = list(gam90.predict(XX_CN).flatten())
-		XX50_CN = list(gam50.predict(XX_CN).flatten())
-		XX10_CN = list(gam10.predict(XX_CN).flatten())
-		XX_CN = list(XX_CN.flatten())
-
-		########### AD values ###########
-		# fit the mean model first by CV
-		gam50 = ExpectileGAM(expectile=0.5).gridsearch(X_AD, y_AD)
-
-		# and copy the smoothing to the other models
-		lam = gam50.lam
-
-		# fit a few more models
-		gam90 = ExpectileGAM(expectile=0.90, lam=lam).fit(X_AD, y_AD)
-		gam10 = ExpectileGAM(expectile=0.10, lam=lam).fit(X_AD, y_AD)
-	
-		XX_AD = gam50.generate_X_grid(term=0, n=100)
-		XX90_AD = list(gam90.predict(XX_AD).flatten())
-		XX50_AD = list(gam50.predict(XX_AD).flatten())
-		XX10_AD = list(gam10.predict(XX_AD).flatten())
-		XX_AD = list(XX_AD.flatten())
+		### Precomputed centile curves (fitted here only if they do not match the reference values)
+		XX_CN, XX90_CN, XX50_CN, XX10_CN = getCentileCurves(X_CN, y_CN, refSex, selVar, 'CN', icvAdjusted)
+		XX_AD, XX90_AD, XX50_AD, XX10_AD = getCentileCurves(X_AD, y_AD, refSex, selVar, 'AD', icvAdjusted)
 
 		CN_up5 = [abs(int(i)-(int(dfSub['Age'].values[0])+3)) for i in XX_CN]
 		CN_down5 = [abs(int(i)-(int(dfSub['Age'].values[0])-3)) for i in XX_CN]
@@ -0,0 +1,167 @@
+import sys
+import json
+import hashlib
+import shutil
+import numpy as np
+import pandas as pd
+import os as _os
+
+#### Memory-mapped columnar store of the harmonized reference values ###
+# Each reference csv is stored once, at image build time, as one .npy file per column and partition:
+#   'all'     all time-points, sorted by date (as used to train the SPARE models)
+#   'F', 'M'  first time-point of each subject with complete values, split by sex (as used for the z-scores and plots)
+# Values are float64 (one values.npy matrix per partition, a column per row), Sex/Diagnosis and the other text
+# columns are categorical. The store is checked against the size and modification time of the csv, not its content.
+# Usage: python3 refstore.py [reference csv ...]   (default: MUSE and WMLS reference values)
+
+# Harmonized reference MUSE and WMLS values #
+MUSE_Ref_Values = '/refs/combinedharmonized_out.csv'
+WMLS_Ref_Values = '/refs/WMLS_combinedrefs.csv'
+# Location of the store #
+REF_STORE_DIR = '/refs/refstore'
+# Bump when the layout of the store changes #
+REF_STORE_VERSION = 2
+
+PARTITIONS = ['all', 'F', 'M']
+
+################################################ FUNCTIONS ################################################
+
+### Function to hash the content of a reference csv
+def hashRefFile(csvfile):
+	with open(csvfile, 'rb') as f:
+		return hashlib.sha1(f.read()).hexdigest()
+
+### Function to stamp a reference csv by size and modification time (the store is rebuilt if it changes)
+def stampRefFile(csvfile):
+	stat = _os.stat(csvfile)
+	return [stat.st_size, stat.st_mtime_ns]
+
+### Function to convert the reference values to compact dtypes
+def compactRefValues(dfRef):
+	dfRef = dfRef.copy()
+	for col in dfRef.columns:
+		if col == 'Date':
+			continue
+		elif col == 'Sex':
+			# Replace binary variable with categorical
+			dfRef[col] = pd.Categorical(dfRef[col].map({0:'F', 1:'M', 'F':'F', 'M':'M'}), categories=['F','M'])
+		elif pd.api.types.is_numeric_dtype(dfRef[col]):
+			dfRef[col] = dfRef[col].astype(np.float64)
+		else:
+			dfRef[col] = dfRef[col].astype('category')
+
+	return dfRef
+
+### Function to read a reference csv and split it into the partitions of the store
+def readRefPartitions(csvfile):
+	dfAll = pd.read_csv(csvfile)
+
+	# All time-points, sorted by date
+	dfRef = dfAll.copy()
+	dfRef['Date'] = pd.to_datetime(dfRef.Date)
+	dfRef = dfRef.sort_values(by='Date')
+	partitions = {'all': compactRefValues(dfRef)}
+
+	# First time-points only, for subjects with complete values
+	dfRef = dfAll.dropna()
+	dfRef['Date'] = pd.to_datetime(dfRef.Date)
+	dfRef = dfRef.sort_values(by='Date')
+	dfRef = dfRef.drop_duplicates(subset=['PTID'], keep='first')
+	dfRef = compactRefValues(dfRef)
+	for sex in ['F','M']:
+		partitions[sex] = dfRef[dfRef.Sex == sex].copy()
+
+	return partitions
+
+### Function to write a reference csv into the store
+def writeRefStore(csvfile, storedir=REF_STORE_DIR):
+	outdir = _os.path.join(storedir, _os.path.splitext(_os.path.basename(csvfile))[0])
+	tmpdir = outdir + '.tmp'
+	shutil.rmtree(tmpdir, ignore_errors=True)
+
+	partitions = readRefPartitions(csvfile)
+	manifest = {'version':REF_STORE_VERSION, 'source':stampRefFile(csvfile), 'columns':[], 'partitions':{}}
+	floatcols = []
+	for col in partitions['all'].columns:
+		if isinstance(partitions['all'][col].dtype, pd.CategoricalDtype):
+			manifest['columns'].append({'name':col, 'categories':[str(c) for c in partitions['all'][col].cat.categories]})
+		elif partitions['all'][col].dtype == np.float64:
+			# Row of the column in the values matrix
+			manifest['columns'].append({'name':col, 'row':len(floatcols)})
+			floatcols.append(col)
+		else:
+			manifest['columns'].append({'name':col})
+
+	for partition, dfRef in partitions.items():
+		_os.makedirs(_os.path.join(tmpdir, partition))
+		manifest['partitions'][partition] = int(dfRef.shape[0])
+		# Float values as one matrix, each column contiguous, so that they are mapped into one block of the data frame
+		np.save(_os.path.join(tmpdir, partition, 'values.npy'), np.ascontiguousarray(dfRef[floatcols].values.T))
+		for ind, col in enumerate(dfRef.columns):
+			if col in floatcols:
+				continue
+			elif isinstance(dfRef[col].dtype, pd.CategoricalDtype):
+				# Categories are the same in all partitions, only the codes are stored
+				codes = pd.Categorical(dfRef[col].astype(object), categories=partitions['all'][col].cat.categories).codes
+				values = codes.astype(np.int8 if len(partitions['all'][col].cat.categories) < 127 else np.int32)
+			else:
+				values = dfRef[col].values
+			np.save(_os.path.join(tmpdir, partition, str(ind) + '.npy'), values)
+
+	with open(_os.path.join(tmpdir, 'manifest.json'), 'w') as f:
+		json.dump(manifest, f)
+
+	shutil.rmtree(outdir, ignore_errors=True)
+	_os.rename(tmpdir, outdir)
+
+	return outdir
+
+### Function to load one partition of a reference csv
+###   Reads the memory-mapped store if it is up to date, otherwise the csv itself
+###   The float values are not copied: they are mapped copy-on-write, so only the pages read are loaded
+###   columns: optional list of columns to load (all by default)
+def loadRef(csvfile, partition, columns=None, storedir=REF_STORE_DIR):
+	if partition not in PARTITIONS:
+		raise ValueError('Unknown reference partition: ' + str(partition))
+
+	refdir = _os.path.join(storedir, _os.path.splitext(_os.path.basename(csvfile))[0])
+	manifest = None
+	if _os.path.exists(_os.path.join(refdir, 'manifest.json')):
+		with open(_os.path.join(refdir, 'manifest.json'), 'r') as f:
+			manifest = json.load(f)
+		if manifest.get('version') != REF_STORE_VERSION or (_os.path.exists(csvfile) and manifest.get('source') != stampRefFile(csvfile)):
+			print("Reference store out of date with " + csvfile + ", reading the csv...")
+			manifest = None
+
+	if manifest is None:
+		dfRef = readRefPartitions(csvfile)[partition]
+		return dfRef if columns is None else dfRef[columns]
+
+	cols = [col for col in manifest['columns'] if columns is None or col['name'] in columns]
+	floatcols = [col for col in cols if 'row' in col]
+	values = np.load(_os.path.join(refdir, partition, 'values.npy'), mmap_mode='c')
+	if columns is not None:
+		values = values[[col['row'] for col in floatcols]]
+	# A data frame built from a 2-D array keeps the array as its block (a dict of columns would be copied)
+	dfRef = pd.DataFrame(values.T, columns=[col['name'] for col in floatcols], copy=False)
+
+	# Other columns inserted at their position, in order
+	for pos, col in enumerate(cols):
+		if 'row' in col:
+			continue
+		ind = manifest['columns'].index(col)
+		values = np.load(_os.path.join(refdir, partition, str(ind) + '.npy'), mmap_mode='c')
+		if 'categories' in col:
+			dfRef.insert(pos, col['name'], pd.Categorical.from_codes(np.asarray(values), categories=col['categories']))
+		else:
+			dfRef.insert(pos, col['name'], values)
+
+	return dfRef if columns is None else dfRef[columns]
+
+if __name__ == '__main__':
+	csvfiles = sys.argv[1:] if len(sys.argv) > 1 else [MUSE_Ref_Values, WMLS_Ref_Values]
+	for csvfile in csvfiles:
+		if not _os.path.exists(csvfile):
+			print("Reference values " + csvfile + " not found, skipping (the csv will be read for each subject)")
+			continue
+		print("Reference store written to " + writeRefStore(csvfile))
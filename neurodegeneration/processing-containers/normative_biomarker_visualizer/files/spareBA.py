@@ -11,23 +11,20 @@ from sklearn.model_selection import KFold
 from sklearn.metrics import confusion_matrix
 
 import plotly.graph_objects as go
-from pygam import ExpectileGAM
 from pygam.datasets import mcycle
 from pygam import LinearGAM
 import os as _os
+import refstore
+from centiles import getCentileCurves
 
 from joblib import dump, load
 
 from boxoffplot import WMHbox
 
 def calculateSpareBA(age,sex,test):
-	MUSE_Ref_Values = pd.read_csv('/refs/combinedharmonized_out.csv')
+	MUSE_Ref_Values = refstore.loadRef(refstore.MUSE_Ref_Values, 'all')
 
-	MUSE_Ref_Values['Date'] = pd.to_datetime(MUSE_Ref_Values.Date)
-
-	MUSE_Ref_Values = MUSE_Ref_Values.sort_values(by='Date')
-	MUSE_Ref_Values_hc = MUSE_Ref_Values.drop_duplicates(subset=['PTID'], keep='first')
-	MUSE_Ref_Values_pt = MUSE_Ref_Values[~MUSE_Ref_Values.isin(MUSE_Ref_Values_hc)].dropna()
+	MUSE_Ref_Values['Sex'] = MUSE_Ref_Values['Sex'].cat.codes
 
 	MUSE_Ref_Values = MUSE_Ref_Values.drop(['MRID','Study','PTID','SITE','Date', 'SPARE_AD', 'Diagnosis_nearest_2.0'], axis=1, inplace=False)
 
@@ -114,40 +111,11 @@ def createSpareBAplot(spareBA, dfSub, dfRef, fig, row, shownCNsubjs, shownADsubj
 	X_AD = ADRef.Age.values.reshape([-1,1])
 	y_AD = ADRef['SPARE_BA'].values.reshape([-1,1])
 
-	##############################################################
-	########### CN values ###########
-	# fit the mean model first by CV
-	gam50 = ExpectileGAM(expectile=0.5).gridsearch(X_CN, y_CN)
-
-	# and copy the smoothing to the other models
-	lam = gam50.lam
-
-	# fit a few more models
-	gam90 = ExpectileGAM(expectile=0.90, lam=lam).fit(X_CN, y_CN)
-	gam10 = ExpectileGAM(expectile=0.10, lam=lam).fit(X_CN, y_CN)
-	
-	XX_CN = gam50.generate_X_grid(term=0, n=100)
-	XX90_CN = list(gam90.predict(XX_CN).flatten())
-	XX50_CN = list(gam50.predict(XX_CN).flatten())
-	XX10_CN = list(gam10.predict(XX_CN).flatten())
-	XX_CN = list(XX_CN.flatten())
-
-	########### AD values ###########
-	# fit the mean model first by CV
-	gam50 = ExpectileGAM(expectile=0.5).gridsearch(X_AD, y_AD)
-
-	# and copy the smoothing to the other models
-	lam = gam50.lam
-
-	# fit a few more models
-	gam90 = ExpectileGAM(expectile=0.90, lam=lam).fit(X_AD, y_AD)
-	gam10 = ExpectileGAM(expectile=0.10, lam=lam).fit(X_AD, y_AD)
-	
-	XX_AD = gam50.generate_X_grid(term=0, n=100)
-	XX90_AD = list(gam90.predict(XX_AD).flatten())
-	XX50_AD = list(gam50.predict(XX_AD).flatten())
-	XX10_AD = list(gam10.predict(XX_AD).flatten())
-	XX_AD = list(XX_AD.flatten())
+	### Precomputed centile curves (fitted here only if they do not match the reference values)
+	refSex = dfSub['Sex'].values[0]
+	icvAdjusted = 'ICV' in dfSub.columns and pd.notna(dfSub['ICV'].values[0])
+	XX_CN, XX90_CN, XX50_CN, XX10_CN = getCentileCurves(X_CN, y_CN, refSex, 'SPARE_BA', 'CN', icvAdjusted)
+	XX_AD, XX90_AD, XX50_AD, XX10_AD = getCentileCurves(X_AD, y_AD, refSex, 'SPARE_BA', 'AD', icvAdjusted)
 
 	CN_up5 = [abs(int(i)-(int(dfSub['Age'].values[0])+3)) for i in XX_CN]
 	CN_down5 = [abs(int(i)-(int(dfSub['Age'].values[0])-3)) for i in XX_CN]
@@ -1,4 +1,3 @@
-import pandas as pd
 import numpy as np
 import nrrd
 from sklearn.linear_model import LinearRegression
@@ -20,20 +19,13 @@ from pygam import ExpectileGAM
 from pygam.datasets import mcycle
 from pygam import LinearGAM
 import os as _os
+import refstore
 
 from joblib import dump, load
 
 def createWMLSplot(dfSub, fname):
-	allref = pd.read_csv('/refs/WMLS_combinedrefs.csv').dropna()
-	allref['Date'] = pd.to_datetime(allref.Date)
-	allref = allref.sort_values(by='Date')
-	# Get first-time points only
-	allref = allref.drop_duplicates(subset=['PTID'], keep='first')
-	# Binarize sex
-	allref['Sex'].replace(0, 'F',inplace=True)
-	allref['Sex'].replace(1, 'M',inplace=True)
-	# same sex selection
-	allref = allref[allref.Sex == dfSub.loc[0,'Sex']]
+	# same sex selection (first-time points only)
+	allref = refstore.loadRef(refstore.WMLS_Ref_Values, dfSub.loc[0,'Sex'])
 
 	# Get only those reference subjects ±3 years from subject age
 	lowlim = int(dfSub['Age'].values[0]) - 3
@@ -0,0 +1,85 @@
+import sys
+import time
+import numpy as np
+import SimpleITK as sitk
+
+import labellut
+
+# Benchmark of the lookup-table relabeling (labellut) against sitk.ChangeLabel on synthetic 256^3 MUSE label maps
+#   'relabel'   consecutive labels -> MUSE labels, labels not in the mapping unchanged (relabel_roi_img)
+#               ChangeLabel with the mapping dict, vs apply_lut with the compiled table
+#   'combine'   MUSE labels -> derived regions, all other labels to 0 (combine_labels)
+#               LabelShapeStatistics (labels present) + ChangeLabel, vs apply_lut with the compiled table (default 0)
+#   for each pixel type of the label map, and checks that both outputs are identical (values, pixel type, geometry)
+#   Usage: python3 benchmark_relabel.py [consecutive -> MUSE mapping csv (IndexConsecutive, IndexMUSE)] [combine_labels csv]
+
+# Pixel types of the label maps #
+PIXEL_TYPES = [sitk.sitkUInt8, sitk.sitkUInt16, sitk.sitkInt16, sitk.sitkUInt32, sitk.sitkInt32]
+
+### Function to create a synthetic (256, 256, 256) label map: blocky parcellation of an ellipsoid head
+def syntheticLabels(labels, size=256, block=8):
+    rng = np.random.default_rng(0)
+    coarse = rng.choice(labels, (size//block,)*3)
+    nda = coarse.repeat(block, 0).repeat(block, 1).repeat(block, 2)
+    z, y, x = np.meshgrid(*(np.linspace(-1, 1, size),)*3, indexing='ij', sparse=True)
+    nda[z**2 + (y/0.9)**2 + (x/0.75)**2 > 0.9] = 0
+    img = sitk.GetImageFromArray(nda.astype(np.int32))
+    img.SetSpacing((1.0, 1.0, 1.0))
+    img.SetOrigin((-128.0, -128.0, -128.0))
+    return img
+
+### Function to read the combine_labels mapping csv (derived label, labels combined from the 4th column onwards)
+def readCombineCsv(csv_path):
+    mapDict = {}
+    with open(csv_path) as f:
+        for row in f.read().splitlines():
+            row = row.split(',')
+            for x in row[3:]:
+                mapDict[int(x)] = int(row[1])
+    return mapDict
+
+### Previous combine_labels relabeling, for reference
+def legacyCombine(image, mapDict):
+    stats = sitk.LabelShapeStatisticsImageFilter()
+    stats.Execute(image)
+    newDict = { i : 0 for i in stats.GetLabels() if (int(i) not in mapDict.keys()) }
+    newDict.update(mapDict)
+    return sitk.ChangeLabel(image, changeMap=newDict)
+
+def sameImage(a, b):
+    return a.GetPixelID() == b.GetPixelID() and a.GetSpacing() == b.GetSpacing() and a.GetOrigin() == b.GetOrigin() \
+        and np.array_equal(sitk.GetArrayViewFromImage(a), sitk.GetArrayViewFromImage(b))
+
+def timeit(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(1)
+    if len(sys.argv) > 1:
+        relabelMap = labellut.read_mapping_csv(sys.argv[1], 'IndexConsecutive', 'IndexMUSE')
+    else:
+        relabelMap = dict(enumerate([0] + sorted(rng.choice(np.arange(4, 208), 151, replace=False).tolist())))
+    if len(sys.argv) > 2:
+        combineMap = readCombineCsv(sys.argv[2])
+    else:
+        museLabels = sorted(set(relabelMap.values()) - {0})
+        combineMap = {int(k): 221 + i % 9 for i, k in enumerate(rng.choice(museLabels, 60, replace=False))}
+
+    consecutive = syntheticLabels(np.array(sorted(relabelMap.keys())))
+    muse = syntheticLabels(np.array(sorted(relabelMap.values())))
+
+    print(f'{"mode":8s} {"pixel type":22s} {"ChangeLabel s":>13s} {"LUT s":>7s} {"speedup":>8s} {"identical":>10s}')
+    for pixelType in PIXEL_TYPES:
+        image = sitk.Cast(consecutive, pixelType)
+        tOld, old = timeit(lambda: sitk.ChangeLabel(image, changeMap=relabelMap))
+        tNew, new = timeit(lambda: labellut.relabel_image(image, relabelMap))
+        print(f'{"relabel":8s} {image.GetPixelIDTypeAsString():22s} {tOld:13.3f} {tNew:7.3f} {tOld/tNew:7.1f}x {"yes" if sameImage(old, new) else "NO":>10s}')
+
+    for pixelType in PIXEL_TYPES:
+        image = sitk.Cast(muse, pixelType)
+        lut = labellut.compile_lut(combineMap, default=0)
+        tOld, old = timeit(lambda: legacyCombine(image, combineMap))
+        tNew, new = timeit(lambda: labellut.apply_lut(image, lut, default=0))
+        print(f'{"combine":8s} {image.GetPixelIDTypeAsString():22s} {tOld:13.3f} {tNew:7.3f} {tOld/tNew:7.1f}x {"yes" if sameImage(old, new) else "NO":>10s}')
@@ -0,0 +1,77 @@
+import SimpleITK as sitk
+import labellut
+
+#### Fused label map transforms ###
+# An ordered list of label transforms is run in memory on one label map, which is read and written once:
+#   relabel:<mapping csv>[:<from column>:<to column>]   labels mapped between two columns of a csv with header
+#                                                       (default IndexConsecutive -> IndexMUSE), other labels unchanged
+#   combine:<combine csv>                               labels combined into derived labels (combine_labels csv),
+#                                                       other labels set to 0
+#   reorient:<orientation code>                         reoriented to an orientation code, e.g. LPS (DICOMOrient)
+#   reorient:reference                                  reoriented to the orientation of the reference image
+# Transforms are separated by ';', e.g. "relabel:/refs/MUSE_mapping.csv;combine:/refs/derived.csv;reorient:LPS".
+# Consecutive relabel/combine transforms are composed into one lookup table, so they take one pass over the voxels.
+
+# Names of the transforms #
+TRANSFORMS = ['relabel', 'combine', 'reorient']
+# Default columns of the relabel mapping csv #
+RELABEL_FROM = 'IndexConsecutive'
+RELABEL_TO = 'IndexMUSE'
+
+### Function to parse a list of transforms: [(name, [arguments])]
+def parse_transforms(spec):
+    transforms = []
+    for step in spec.split(';'):
+        if step.strip() == '':
+            continue
+        name, _, args = step.strip().partition(':')
+        if name not in TRANSFORMS:
+            raise ValueError('Unknown label transform: ' + name)
+        args = args.split(':') if args else []
+        if len(args) == 0 or (name == 'relabel' and len(args) not in [1, 3]):
+            raise ValueError('Wrong arguments for label transform: ' + step)
+        transforms.append((name, args))
+    return transforms
+
+### Function to compile a relabel/combine transform into a lookup table: (lookup table, default)
+def compile_transform(name, args):
+    if name == 'relabel':
+        label_from, label_to = (args[1], args[2]) if len(args) == 3 else (RELABEL_FROM, RELABEL_TO)
+        return labellut.compile_lut(labellut.read_mapping_csv(args[0], label_from, label_to)), None
+    return labellut.compile_lut(labellut.read_combine_csv(args[0]), default=0), 0
+
+### Function to compile a list of transforms into steps: ('lut', (lookup table, default)) or ('reorient', orientation)
+###   consecutive relabel/combine transforms are composed into one lookup table
+def compile_transforms(transforms, refimage=None):
+    steps = []
+    for name, args in transforms:
+        if name == 'reorient':
+            if args[0] == 'reference':
+                if refimage is None:
+                    raise ValueError('No reference image to reorient to')
+                orientation = sitk.DICOMOrientImageFilter.GetOrientationFromDirectionCosines(refimage.GetDirection())
+            else:
+                orientation = args[0]
+            steps.append(('reorient', orientation))
+            continue
+
+        lut, default = compile_transform(name, args)
+        if len(steps) > 0 and steps[-1][0] == 'lut':
+            previous_lut, previous_default = steps[-1][1]
+            steps[-1] = ('lut', labellut.compose_lut(previous_lut, lut, previous_default, default))
+        else:
+            steps.append(('lut', (lut, default)))
+    return steps
+
+### Function to run compiled steps (compile_transforms) on a label image, in memory
+def run_steps(image, steps):
+    for step, value in steps:
+        if step == 'lut':
+            image = labellut.apply_lut(image, value[0], value[1])
+        else:
+            image = sitk.DICOMOrient(image, value)
+    return image
+
+### Function to run a list of transforms (parse_transforms) on a label image, in memory
+def transform_labels(image, transforms, refimage=None):
+    return run_steps(image, compile_transforms(transforms, refimage))
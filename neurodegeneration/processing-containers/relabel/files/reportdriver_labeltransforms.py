@@ -0,0 +1,74 @@
+import os
+import glob
+import labeltransforms
+import imageformat
+import SimpleITK as sitk
+
+# For local testng
+#os.environ["WORKFLOW_DIR"] = "/data"
+#os.environ["BATCH_NAME"] = "batch"
+#os.environ["OPERATOR_OUT_DIR"] = "output"
+#os.environ["OPERATOR_IN_DIR_ROI"] = "None"
+#os.environ["OPERATOR_IN_DIR_CSV"] = "None"
+#os.environ["OPERATOR_IN_DIR_REF"] = "None"
+#os.environ["LABEL_TRANSFORMS"] = "relabel:/refs/MUSE_mapping_consecutive_indices.csv;reorient:reference"
+#os.environ["OPERATOR_EXTENSION"] = "None"
+
+# Ordered list of label transforms, run in memory (see labeltransforms.py)
+# Without LABEL_TRANSFORMS, the mapping csv of the relabel operator is used (relabel only)
+if "LABEL_TRANSFORMS" in os.environ:
+    transforms = labeltransforms.parse_transforms(os.environ["LABEL_TRANSFORMS"])
+else:
+    transforms = labeltransforms.parse_transforms("relabel:" + os.environ["OPERATOR_IN_DIR_CSV"])
+# Lookup tables compiled once for all label maps, unless the reference image of each batch element is needed
+needs_reference = ('reorient', ['reference']) in transforms
+steps = None if needs_reference else labeltransforms.compile_transforms(transforms)
+
+# Label maps of the input operator, unless a roi folder is given
+roi_dir = os.environ.get("OPERATOR_IN_DIR_ROI", os.environ.get("OPERATOR_IN_DIR", "None"))
+
+# From the template
+batch_folders = sorted([f for f in glob.glob(os.path.join('/', os.environ['WORKFLOW_DIR'], os.environ['BATCH_NAME'], '*'))])
+
+for batch_element_dir in batch_folders:
+    roi = []
+    ref = []
+    extension = imageformat.intermediate_extension(".nii.gz")
+
+    if "None" not in roi_dir:
+        print("roi folder provided")
+        roi_input_dir = os.path.join(batch_element_dir, roi_dir)
+        roi = imageformat.find_images(roi_input_dir, ['.nrrd', '.nii.gz', '.nii'])
+        print(roi)
+
+    if "None" not in os.environ.get("OPERATOR_IN_DIR_REF", "None"):
+        print("ref folder provided")
+        ref_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR_REF'])
+        ref = imageformat.find_images(ref_input_dir)
+
+    if "None" not in os.environ.get("OPERATOR_EXTENSION", "None"):
+        print("extension choice provided")
+        extension = os.environ["OPERATOR_EXTENSION"]
+
+    element_output_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_OUT_DIR'])
+
+    if len(roi) == 0 or (needs_reference and len(ref) == 0):
+        print("No label map or reference image found!")
+        exit(1)
+    else:
+        if not os.path.exists(element_output_dir):
+            os.makedirs(element_output_dir)
+
+        # Declare UID of subject and where we want to save the label map
+        UID = os.path.basename(batch_element_dir)
+        outpath = os.path.join(element_output_dir, "{}{}".format(UID,extension))
+
+        # Read once, run all transforms in memory, write once
+        img = sitk.ReadImage(roi[0])
+        if needs_reference:
+            # header of the reference image only
+            element_steps = labeltransforms.compile_transforms(transforms, imageformat.read_image_information(ref[0]))
+        else:
+            element_steps = steps
+        imageformat.write_image(labeltransforms.run_steps(img, element_steps), outpath)
+        print("transformed label map written to path: ", outpath)
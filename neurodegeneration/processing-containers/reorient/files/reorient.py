@@ -1,4 +1,5 @@
 import SimpleITK as sitk
+import imageformat
 
 #read/write utils
 def writeimage(image, output_file_path):
@@ -24,8 +25,8 @@ def reorient_image(image_path, orientation):
     return reoriented
 
 def reorient_image_to_reference_image(image_path,reference_image_path):
-    #read reference image
-    refimage = readimage(str(reference_image_path))
+    #read reference image header only (no voxels)
+    refimage = imageformat.read_image_information(reference_image_path)
 
     #get direction cosine of reference image
     dc_ref = refimage.GetDirection()
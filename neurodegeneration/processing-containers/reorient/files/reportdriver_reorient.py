@@ -1,6 +1,7 @@
 import sys, os
 import glob
 import reorient
+import imageformat
 from datetime import datetime
 import SimpleITK as sitk
 
@@ -22,7 +23,7 @@ for batch_element_dir in batch_folders:
     img = []
     ref = []
     reorient_to = "None"
-    extension = ".nii.gz"
+    extension = imageformat.intermediate_extension(".nii.gz")
 
     print(f'Checking for nrrd/json files')
 
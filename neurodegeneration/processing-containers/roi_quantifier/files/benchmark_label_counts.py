@@ -0,0 +1,73 @@
+import sys, os
+import time
+import resource
+import subprocess
+import tempfile
+import numpy as np
+import nibabel as nib
+import roi_quantifier
+
+# Benchmark of the label counting used for the ROI, ICV and WMLS volumes
+#   Compares the previous float64 get_fdata + np.unique path with calcLabelCounts (native dtype + np.bincount),
+#   reading the whole image at once and in z-slabs under memory budgets (VOLUMETRY_MEMORY_MB)
+#   Each case runs in a fresh process so that the peak RSS of one case does not hide the other
+#   Usage: python3 benchmark_label_counts.py [label image (.nii/.nii.gz)] [repeats]
+#   Without an input image, a synthetic 256^3 int16 MUSE-like label map is used
+
+### Previous implementation of the ROI counts (calcRoiVolumes) and mask volume (calcMaskVolume)
+def fdataUnique(maskfile):
+	roinii = nib.load(maskfile)
+	roiimg = roinii.get_fdata()
+	ROIs, Counts = np.unique(roiimg, return_counts=True)
+	maskCount = np.sum(roiimg.flatten()>0)
+	return ROIs.astype(int), Counts, maskCount
+
+### Current implementation, with a memory budget in MB (None: whole image at once)
+def labelCounts(memoryMB):
+	def counts(maskfile):
+		ROIs, Counts, voxvol = roi_quantifier.calcLabelCounts(maskfile, memoryMB)
+		maskCount = np.sum(Counts[ROIs > 0])
+		return ROIs.astype(int), Counts, maskCount
+	return counts
+
+CASES = {'get_fdata+unique':fdataUnique, 'native+bincount':labelCounts(None),
+         'slabs 256 MB':labelCounts(256), 'slabs 64 MB':labelCounts(64), 'slabs 16 MB':labelCounts(16)}
+
+### Function to write a synthetic label map with MUSE-like labels
+def writeSyntheticLabels(path, shape=(256,256,256)):
+	rng = np.random.default_rng(0)
+	labels = np.array([0,4,11,23,30,31,32,35,36,37,38,39,40,41,47,48,49,50,51,52,55,56,57,58,59,60,61,62,71,72,73,75,76,81,82,83,84,85,86,87,88,89,90,91,92,93,94,95] + list(range(100,208)), dtype=np.int16)
+	# Blocky labels so that the compressed size is close to a real segmentation
+	blocks = rng.choice(labels, size=(shape[0]//8, shape[1]//8, shape[2]//8))
+	img = np.kron(blocks, np.ones((8,8,8), dtype=np.int16)).astype(np.int16)
+	nib.save(nib.Nifti1Image(img, np.eye(4)), path)
+
+### Function to run one case in the current process and print wall time and peak RSS
+def runCase(name, maskfile, repeats):
+	# Everything is imported with the module, so that only the counting is measured
+	rssBefore = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	times = []
+	for i in range(repeats):
+		start = time.perf_counter()
+		ROIs, Counts, maskCount = CASES[name](maskfile)
+		times.append(time.perf_counter() - start)
+	rssPeak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# ru_maxrss is in KB on Linux
+	print(f'{name:20s} wall {np.median(times):8.3f} s (median of {repeats})   peak RSS {rssPeak/1024:8.1f} MB   (+{(rssPeak-rssBefore)/1024:.1f} MB)   labels {len(ROIs)}   mask voxels {int(maskCount)}')
+
+if __name__ == '__main__':
+	if len(sys.argv) > 1 and sys.argv[1] == '--case':
+		runCase(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+		exit(0)
+
+	repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+	with tempfile.TemporaryDirectory() as tmp:
+		if len(sys.argv) > 1:
+			maskfile = sys.argv[1]
+		else:
+			maskfile = os.path.join(tmp, 'labels.nii.gz')
+			writeSyntheticLabels(maskfile)
+		print('Label image: ' + maskfile + ' ' + str(nib.load(maskfile).shape) + ' ' + str(nib.load(maskfile).get_data_dtype()))
+
+		for name in CASES.keys():
+			subprocess.run([sys.executable, os.path.abspath(__file__), '--case', name, maskfile, str(repeats)], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,24 @@
+import sys, os
+import json
+import roi_quantifier
+
+# Writes the per-sex normative statistics of the reference values to /refs/MUSE_NormStats.json
+#   Run at image build time, after the reference csv files are copied to /refs
+#   Usage: python3 build_normstats.py [ref csv] [wmls ref csv] [output json]
+
+ref_csv = roi_quantifier.MUSE_Ref_Values
+wmls_csv = roi_quantifier.WMLS_Ref_Values
+out_json = roi_quantifier.MUSE_Norm_Stats
+if len(sys.argv) == 4:
+    ref_csv, wmls_csv, out_json = sys.argv[1:4]
+
+if not os.path.exists(ref_csv) or not os.path.exists(wmls_csv):
+    print("Reference values not found, skipping normative statistics (they will be computed for each subject)")
+    exit(0)
+
+print("Building normative statistics from " + ref_csv + " and " + wmls_csv)
+normStats = roi_quantifier.buildNormStats(ref_csv, wmls_csv)
+
+with open(out_json, 'w') as f:
+    json.dump(normStats, f)
+print("Normative statistics written to " + out_json)
@@ -0,0 +1,39 @@
+import sys
+import pandas as pd
+import numpy as np
+import roi_quantifier
+
+# Recomputes the derived ROI volumes of many subjects at once from their single ROI volumes
+#   Input csv has one row per subject and single ROI volumes in columns named by ROI index
+#   (as in the harmonized reference values); all other columns are copied to the output
+#   Usage: python3 derive_roi_volumes.py [input csv] [output csv] [mapping csv (optional)]
+
+if len(sys.argv) < 3:
+    print("Usage: python3 derive_roi_volumes.py [input csv] [output csv] [mapping csv (optional)]")
+    exit(1)
+
+in_csv = sys.argv[1]
+out_csv = sys.argv[2]
+map_csv = sys.argv[3] if len(sys.argv) > 3 else roi_quantifier.MUSE_ROI_Mapping
+
+df = pd.read_csv(in_csv)
+DerivedROIs, mapMat = roi_quantifier.readDerivedMapping(map_csv)
+
+# Single ROIs are the mapping columns that are present in the input csv
+singleROIs = [str(i) for i in np.unique(mapMat.indices) if str(i) in df.columns]
+# Derived ROIs without single ROIs in the mapping (e.g. 702, ICV) are not recomputed
+derivedOnly = [roi for roi, n in zip(DerivedROIs, np.diff(mapMat.indptr)) if roi not in singleROIs and n > 0]
+print("Input: " + str(df.shape[0]) + " subjects, " + str(len(singleROIs)) + " single ROIs")
+
+# Subjects x ROI index matrix of single ROI volumes
+VolumesInd = np.zeros((df.shape[0], mapMat.shape[1]))
+VolumesInd[:, [int(i) for i in singleROIs]] = df[singleROIs].fillna(0).values
+
+# Derived volumes for all subjects with a single matrix product
+DerivedROIs, DerivedVols = roi_quantifier.calcDerivedVolumes(VolumesInd, map_csv)
+dfDerived = pd.DataFrame(DerivedVols, columns=DerivedROIs, index=df.index)
+
+# Keep the input columns, replacing derived ROIs with the recomputed values
+df = pd.concat([df.drop(columns=[roi for roi in derivedOnly if roi in df.columns]), dfDerived[derivedOnly]], axis=1)
+df.to_csv(out_csv, index=False)
+print("Derived ROI volumes written to " + out_csv)
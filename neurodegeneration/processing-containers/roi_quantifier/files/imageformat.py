@@ -0,0 +1,223 @@
+import os
+import glob
+import gzip
+import numpy as np
+
+#### Intermediate image format ###
+# Images handed off between the containers of the pipeline (label maps, masks) are written in one pipeline-wide
+# format, set by the INTERMEDIATE_FORMAT environment variable:
+#   nii.gz   gzip-compressed NIfTI
+#   nii      uncompressed NIfTI, opened without decompression (memory-mapped, see memmap_image)
+#   nrrd     raw NRRD, opened without decompression (memory-mapped, see memmap_image)
+#   None     (default) each container keeps its own output format
+# The uncompressed formats skip the single-threaded gzip encode/decode at each hop; compression is left to the final
+# archival step. Readers accept all the formats (find_images).
+# Metadata-only questions (size, spacing, direction) are answered from the headers (probe_image, read_image_information)
+# and scans over the voxels read bounded slabs of slices (iter_slabs), without loading whole volumes. The slabs can be
+# sized to a memory budget (budget_slab_size). Headers are read with nibabel (NIfTI, Analyze) and pynrrd (NRRD), which
+# the containers that scan voxels (roi_quantifier) install; the other containers only find, probe and write images.
+
+# Intermediate formats and their file extensions #
+INTERMEDIATE_FORMATS = {'nii.gz':'.nii.gz', 'nii':'.nii', 'nrrd':'.nrrd'}
+# Extensions of the images read, in order of preference #
+IMAGE_EXTENSIONS = ['.nii.gz', '.nii', '.nrrd']
+
+# Number of slices read at a time by the lazy slab reader #
+SLAB_SIZE = 16
+# Working bytes per voxel of a slab on top of its stored type (one working copy: float64 scaling, sort, int64 labels) #
+SLAB_WORKING_BYTES = 8
+
+# NRRD types of the images read from their headers #
+NRRD_DTYPES = {'i1':['signed char', 'int8', 'int8_t'],
+               'u1':['uchar', 'unsigned char', 'uint8', 'uint8_t'],
+               'i2':['short', 'short int', 'signed short', 'signed short int', 'int16', 'int16_t'],
+               'u2':['ushort', 'unsigned short', 'unsigned short int', 'uint16', 'uint16_t'],
+               'i4':['int', 'signed int', 'int32', 'int32_t'],
+               'u4':['uint', 'unsigned int', 'uint32', 'uint32_t'],
+               'i8':['longlong', 'long long', 'long long int', 'signed long long', 'signed long long int', 'int64', 'int64_t'],
+               'u8':['ulonglong', 'unsigned long long', 'unsigned long long int', 'uint64', 'uint64_t'],
+               'f4':['float'],
+               'f8':['double']}
+
+### Function to get the intermediate format (INTERMEDIATE_FORMAT), None if not set
+def intermediate_format():
+    fmt = os.environ.get("INTERMEDIATE_FORMAT", "None")
+    if fmt == "None":
+        return None
+    if fmt not in INTERMEDIATE_FORMATS:
+        raise ValueError('Unknown intermediate image format: ' + fmt)
+    return fmt
+
+### Function to get the extension of the images written: intermediate format, or default (the container's own format)
+def intermediate_extension(default):
+    fmt = intermediate_format()
+    return default if fmt is None else INTERMEDIATE_FORMATS[fmt]
+
+### Function to find the images of a directory, in any of the formats (first extension found in IMAGE_EXTENSIONS)
+def find_images(input_dir, extensions=IMAGE_EXTENSIONS):
+    for extension in extensions:
+        images = sorted(glob.glob(os.path.join(input_dir, "*" + extension)))
+        if len(images) > 0:
+            return images
+    return []
+
+### Function to write an image, compressed only if the extension is (.nii.gz, .nrrd.gz: gzip)
+def write_image(image, output_file_path):
+    # SimpleITK is only needed to write (the containers that only read images do not install it)
+    import SimpleITK as sitk
+    writer = sitk.ImageFileWriter()
+    writer.SetFileName ( str(output_file_path) )
+    writer.SetUseCompression( str(output_file_path).endswith('.gz') )
+    writer.Execute ( image )
+
+### Function to tell whether an image is a NRRD image (.nrrd, .nhdr), read with pynrrd, or a NIfTI/Analyze image, read
+### with nibabel
+def is_nrrd(input_file_path):
+    return str(input_file_path).endswith('.nrrd') or str(input_file_path).endswith('.nhdr')
+
+### Function to open a NIfTI or Analyze image (.nii, .nii.gz, .hdr/.img) with nibabel: header and data proxy, no voxels
+###   The file is kept open by the proxy, so that the slabs of a compressed image read in order are decompressed once
+###   mmap: memory-map uncompressed data (nibabel)
+def load_nifti(input_file_path, mmap=False):
+    import nibabel as nib
+    return nib.load(str(input_file_path), mmap=mmap, keep_file_open=True)
+
+### Function to tell whether the data of a nibabel image is scaled (slope, intercept), i.e. read as float64
+def nifti_scaled(image):
+    import nibabel as nib
+    dataobj = image.dataobj
+    return nib.is_proxy(dataobj) and (float(dataobj.slope) != 1 or float(dataobj.inter) != 0)
+
+### Function to read the header of a NRRD image with pynrrd: (header, offset of the attached data)
+def read_nrrd_header(input_file_path):
+    import nrrd
+    with open(input_file_path, 'rb') as f:
+        header = nrrd.read_header(f)
+        offset = f.tell()
+    return header, offset
+
+### Function to get the geometry of a NRRD header (pynrrd): (dtype, shape, spacing)
+def nrrd_geometry(header):
+    dtype = next((code for code, names in NRRD_DTYPES.items() if header['type'] in names), None)
+    if dtype is None:
+        raise ValueError('Unsupported NRRD type: ' + str(header['type']))
+    shape = tuple(int(s) for s in header['sizes'])
+    # Spacing: norm of the space directions (1 for the non-spatial axes), or spacings
+    if 'space directions' in header:
+        spacing = tuple(float(np.linalg.norm(d)) if np.all(np.isfinite(d)) else 1.0 for d in np.asarray(header['space directions'], dtype=float))
+    else:
+        spacing = tuple(float(s) for s in header.get('spacings', [1.0] * len(shape)))
+    return np.dtype(('>' if header.get('endian') == 'big' else '<') + dtype), shape, spacing
+
+### Function to get the encoding of the data of a NRRD header (pynrrd) read as a stream from the file: 'raw' or 'gzip'
+###   None for the encodings (bzip2, ascii, ...) and layouts (detached data, byte/line skips) read in memory by pynrrd
+def nrrd_stream_encoding(header):
+    if any(key in header for key in ['data file', 'datafile', 'byte skip', 'byteskip', 'line skip', 'lineskip']):
+        return None
+    encoding = {'gz':'gzip'}.get(header['encoding'], header['encoding'])
+    return encoding if encoding in ['raw', 'gzip'] else None
+
+### Function to get the slabs geometry of an image shape: (shape of a slice, number of slices)
+###   slabs are cut along the 3rd axis (z), the axes after it (e.g. t of a 4-D (x, y, z, 1) label map) being stacked
+###   along z, so that a slice is always one (x, y) plane
+def slab_geometry(shape):
+    if len(shape) < 3:
+        return tuple(shape[:-1]), int(shape[-1])
+    return tuple(shape[:2]), int(np.prod(shape[2:]))
+
+### Function to probe an image (.nii, .nii.gz, .hdr, .nrrd) from its header only: (dtype, shape, spacing), in file order
+### (x, y, z); the dtype is float64 for scaled data
+def probe_image(input_file_path):
+    if is_nrrd(input_file_path):
+        header, offset = read_nrrd_header(input_file_path)
+        return nrrd_geometry(header)
+    image = load_nifti(input_file_path)
+    dtype = np.dtype(np.float64) if nifti_scaled(image) else image.get_data_dtype()
+    return dtype, tuple(image.shape), tuple(float(z) for z in image.header.get_zooms())
+
+### Function to read the header of an image with SimpleITK (any format): image file reader with size, spacing, origin,
+### direction, pixel type and meta-data, without the voxels
+def read_image_information(input_file_path):
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName ( str(input_file_path) )
+    reader.ReadImageInformation()
+    return reader
+
+### Function to memory-map an uncompressed image (.nii or raw .nrrd): (array, spacing)
+###   The array is indexed in the file order (x, y, z), as nibabel arrays, i.e. the transpose of sitk.GetArrayFromImage
+def memmap_image(input_file_path):
+    path = str(input_file_path)
+    if is_nrrd(path):
+        header, offset = read_nrrd_header(path)
+        if nrrd_stream_encoding(header) != 'raw':
+            raise ValueError('Only raw NRRD images with attached data can be memory-mapped: ' + path)
+        dtype, shape, spacing = nrrd_geometry(header)
+        return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F'), spacing
+    image = load_nifti(path, mmap='r')
+    if nifti_scaled(image):
+        raise ValueError('Scaled NIfTI data cannot be memory-mapped: ' + path)
+    data = np.asanyarray(image.dataobj)
+    if not isinstance(data, np.memmap):
+        raise ValueError('Only uncompressed single-file NIfTI images can be memory-mapped: ' + path)
+    return data, tuple(float(z) for z in image.header.get_zooms())
+
+### Function to get the number of slices of the slabs of an image (iter_slabs) that fit in a memory budget in MB
+###   a slab takes its stored type plus one working copy (SLAB_WORKING_BYTES per voxel), and at least one slice
+###   memory_mb None: no budget, the whole image in one slab
+def budget_slab_size(input_file_path, memory_mb):
+    dtype, shape, spacing = probe_image(input_file_path)
+    slice_shape, slices = slab_geometry(shape)
+    if memory_mb is None:
+        return slices
+    slice_bytes = int(np.prod(slice_shape)) * (dtype.itemsize + SLAB_WORKING_BYTES)
+    return max(1, min(slices, int(float(memory_mb) * 1024 * 1024) // slice_bytes))
+
+### Function to read an image (.nii, .nii.gz, .hdr, .nrrd) lazily, slab by slab along z (see slab_geometry)
+###   yields (index of the first slice, slab array indexed in file order (x, y, z)), holding one slab in memory
+###   (compressed data is decompressed as a stream, scaled NIfTI data is scaled in float64)
+###   NIfTI slabs are read from the nibabel proxy, NRRD slabs from the data after the pynrrd header (read in memory by
+###   pynrrd for the other encodings, see nrrd_stream_encoding)
+def iter_slabs(input_file_path, slab_size=SLAB_SIZE):
+    path = str(input_file_path)
+    if not is_nrrd(path):
+        image = load_nifti(path)
+        yield from iter_array_slabs(image.dataobj, slab_size, nifti_scaled(image))
+        return
+
+    header, offset = read_nrrd_header(path)
+    encoding = nrrd_stream_encoding(header)
+    if encoding is None:
+        import nrrd
+        data, header = nrrd.read(path, index_order='F')
+        yield from iter_array_slabs(data, slab_size)
+        return
+    dtype, shape, spacing = nrrd_geometry(header)
+    f = open(path, 'rb')
+    f.seek(offset)
+    if encoding == 'gzip':
+        f = gzip.GzipFile(fileobj=f, mode='rb')
+
+    slice_shape, slices = slab_geometry(shape)
+    slice_bytes = int(np.prod(slice_shape)) * dtype.itemsize
+    with f:
+        for start in range(0, slices, slab_size):
+            count = min(slab_size, slices - start)
+            data = f.read(slice_bytes * count)
+            if len(data) != slice_bytes * count:
+                raise ValueError('Truncated image data: ' + path)
+            yield start, np.frombuffer(data, dtype=dtype).reshape(slice_shape + (count,), order='F')
+
+### Function to read the slabs (iter_slabs) of an array indexed in file order: nibabel proxy or pynrrd array
+###   scaled: the slabs are read as float64
+def iter_array_slabs(data, slab_size=SLAB_SIZE, scaled=False):
+    shape = tuple(data.shape)
+    if len(shape) < 3:
+        slab = np.asarray(data)
+        yield 0, slab.astype(np.float64) if scaled else slab
+        return
+    # One z range of one volume (index of the axes after z) at a time
+    for v, volume in enumerate(np.ndindex(*shape[3:])):
+        for start in range(0, shape[2], slab_size):
+            slab = np.asarray(data[(slice(None), slice(None), slice(start, start + slab_size)) + volume])
+            yield v * shape[2] + start, slab.astype(np.float64) if scaled else slab
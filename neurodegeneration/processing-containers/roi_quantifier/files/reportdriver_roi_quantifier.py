@@ -2,6 +2,7 @@ import sys, os
 import glob
 import json
 import roi_quantifier
+import imageformat
 from datetime import datetime
 
 # For local testng
@@ -12,6 +13,7 @@ from datetime import datetime
 # os.environ["OPERATOR_IN_DIR_ICV"] = "extract_dlicv_result"
 # os.environ["OPERATOR_IN_DIR_ROI"] = "extract_muse_result"
 # os.environ["OPERATOR_IN_DIR_WMLS"] = 'wmls-output'
+# os.environ["VOLUMETRY_MEMORY_MB"] = "64"
 
 # From the template
 batch_folders = sorted([f for f in glob.glob(os.path.join('/', os.environ['WORKFLOW_DIR'], os.environ['BATCH_NAME'], '*'))])
@@ -26,17 +28,17 @@ for batch_element_dir in batch_folders:
     if "None" not in os.environ["OPERATOR_IN_DIR_ICV"]:
         print("icv folder provided")
         icv_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR_ICV'])
-        icv = sorted(glob.glob(os.path.join(icv_input_dir, "*.nii*"), recursive=True))
+        icv = imageformat.find_images(icv_input_dir)
 
     if "None" not in os.environ["OPERATOR_IN_DIR_ROI"]:
         print("roi folder provided")
         roi_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR_ROI'])
-        roi = sorted(glob.glob(os.path.join(roi_input_dir, "*.nii*"), recursive=True))
+        roi = imageformat.find_images(roi_input_dir)
 
     if "None" not in os.environ["OPERATOR_IN_DIR_WMLS"]:
         print("wmls folder provided")
         wmls_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DIR_WMLS'])
-        wmls = sorted(glob.glob(os.path.join(wmls_input_dir, "*.nii*"), recursive=True))
+        wmls = imageformat.find_images(wmls_input_dir)
 
     tmp_json = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_DCM_METADATA_DIR'])
 
@@ -2,10 +2,13 @@ import pandas as pd
 import numpy as np
 import pickle
 import json
-import nibabel as nib
+import scipy.sparse as _sparse
 from datetime import datetime
 import csv as _csv
 import os as _os
+import refstore
+import imageformat
+from dcmjson import readDicomJson, getDicomValues
   
 #### Hardcoded reference data ###
 # Harmonized reference MUSE values #
@@ -16,6 +19,16 @@ maphemi = pd.read_csv('/refs/MUSE_ROI_Dictionary.csv')
 MUSE_ROI_Mapping = '/refs/MUSE_DerivedROIs_Mappings.csv'
 # Harmonized reference WMLS values #
 WMLS_Ref_Values = '/refs/WMLS_combinedrefs.csv'
+# Precomputed per-sex normative statistics (see build_normstats.py) #
+MUSE_Norm_Stats = '/refs/MUSE_NormStats.json'
+# Bump when the content or layout of the normative statistics changes #
+NORM_STATS_VERSION = 2
+# Memory budget of the volumetry in MB (VOLUMETRY_MEMORY_MB): label maps and masks are read and counted in z-slabs #
+# that fit in it, None: whole images at once #
+VOLUMETRY_MEMORY_MB = _os.environ.get('VOLUMETRY_MEMORY_MB', '64')
+VOLUMETRY_MEMORY_MB = None if VOLUMETRY_MEMORY_MB == 'None' else float(VOLUMETRY_MEMORY_MB)
+# Largest label counted with np.bincount (bounds the size of the histogram), larger labels are counted with np.unique #
+BINCOUNT_MAX_LABEL = 65535
 
 ################################################ FUNCTIONS ################################################
 
@@ -33,28 +46,111 @@ def readSubjInfo(subjfile):
 				subDict = {rows[0]:rows[1] for rows in reader}
 	
 	if subjfile.endswith('.json'):
-		with open(subjfile, 'r') as read_file:
-			data = json.load(read_file)
-			
-			## WARNING: Trying to parse fields in a robust way
-			## This part is based on assumptions on dicom field names
-			## it should be tested carefully and updated for different patterns
-			subID = [value for key, value in data.items() if 'PatientID' in key][0]
-			
-			for key, value in data.items():
-				if ('PatientAge' in key) and ('Y' in str(value)):
-					print("Successfully identified patient age in JSON...")
-					subAge = float(str(value).replace('Y',''))
-					break
-
-			subSex = [value for key, value in data.items() if 'PatientSex' in key][0]
-			subExamDate = [value for key, value in data.items() if 'StudyDate_date' in key][0]
-			subExamDate = datetime.strptime(subExamDate, "%Y-%m-%d").strftime("%m/%d/%Y")
-			
-			subDict = {'MRID':subID, 'Age':subAge, 'Sex':subSex, "ExamDate":subExamDate}
+		## Single pass over the json, up to the last field needed
+		data = readDicomJson(subjfile, ['PatientID','PatientAge','PatientSex','StudyDate_date'])
+		## WARNING: Trying to parse fields in a robust way
+		## This part is based on assumptions on dicom field names
+		## it should be tested carefully and updated for different patterns
+		subID = getDicomValues(data, 'PatientID')[0]
+		
+		for value in getDicomValues(data, 'PatientAge'):
+			if 'Y' in str(value):
+				print("Successfully identified patient age in JSON...")
+				subAge = float(str(value).replace('Y',''))
+				break
+
+		subSex = getDicomValues(data, 'PatientSex')[0]
+		subExamDate = getDicomValues(data, 'StudyDate_date')[0]
+		subExamDate = datetime.strptime(subExamDate, "%Y-%m-%d").strftime("%m/%d/%Y")
+		
+		subDict = {'MRID':subID, 'Age':subAge, 'Sex':subSex, "ExamDate":subExamDate}
 
 	return subDict
 
+### Function to count the voxels of each label in a label/mask image
+###   The image is read lazily in z-slabs that fit in a memory budget (memoryMB, None: whole image at once), in its
+###   stored type (no float64 copy), and the label histogram is accumulated slab by slab with np.bincount instead of
+###   sorting the whole image with np.unique. The counts do not depend on the budget.
+def calcLabelCounts(maskfile, memoryMB=VOLUMETRY_MEMORY_MB):
+
+	### Get voxel dimensions (header only)
+	dtype, shape, voxdims = imageformat.probe_image(maskfile)
+	voxdims1, voxdims2, voxdims3 = voxdims[:3]
+	voxvol = float(voxdims1)*float(voxdims2)*float(voxdims3)
+
+	### Calculate label counts, slab by slab
+	Counts = np.zeros(1, dtype=np.int64)
+	otherROIs = []
+	otherCounts = []
+	for start, slab in imageformat.iter_slabs(maskfile, imageformat.budget_slab_size(maskfile, memoryMB)):
+		if np.issubdtype(slab.dtype, np.integer) and slab.min() >= 0 and slab.max() <= BINCOUNT_MAX_LABEL:
+			slabCounts = np.bincount(slab.ravel(order='K'))
+			if len(slabCounts) > len(Counts):
+				Counts = np.pad(Counts, (0, len(slabCounts)-len(Counts)))
+			Counts[:len(slabCounts)] += slabCounts
+		else:
+			# Non-integer, signed or very large labels, e.g. scaled or float images
+			slabROIs, slabCounts = np.unique(slab, return_counts=True)
+			otherROIs.append(slabROIs)
+			otherCounts.append(slabCounts)
+
+	ROIs = np.nonzero(Counts)[0]
+	Counts = Counts[ROIs]
+	if len(otherROIs) > 0:
+		# Merge the counts of all slabs
+		ROIs, inverse = np.unique(np.concatenate([ROIs.astype(otherROIs[0].dtype)] + otherROIs), return_inverse=True)
+		Counts = np.bincount(inverse, weights=np.concatenate([Counts] + otherCounts)).astype(np.int64)
+
+	return ROIs, Counts, voxvol
+
+### Function to compile the single to derived ROI mapping into a sparse matrix
+###   Row i of the matrix adds up the single ROIs of the i-th derived ROI, so that derived
+###   volumes are a single product with a volume vector (one subject) or matrix (many subjects)
+###   The compiled mapping is cached per mapping file (and modification time)
+_derivedMappingCache = {}
+def readDerivedMapping(mapcsv):
+	cacheKey = (_os.path.abspath(mapcsv), _os.path.getmtime(mapcsv))
+	if cacheKey in _derivedMappingCache:
+		return _derivedMappingCache[cacheKey]
+
+	DerivedROIs = []
+	mapRows = []
+	mapCols = []
+	with open(mapcsv) as mapcsvfile:
+		reader = _csv.reader(mapcsvfile, delimiter=',')
+		# Read each line in the csv map files
+		for row in reader:
+			row = list(filter(lambda a: a != '', row))
+			# Append the ROI number to the list
+			roiInds = [int(x) for x in row[2:]]
+			mapRows.extend([len(DerivedROIs)] * len(roiInds))
+			mapCols.extend(roiInds)
+			DerivedROIs.append(row[0])
+
+	# Repeated single ROIs in a row are summed up, as with np.sum(VolumesInd[roiInds])
+	mapMat = _sparse.csr_matrix((np.ones(len(mapCols)), (mapRows, mapCols)), shape=(len(DerivedROIs), max(mapCols)+1))
+
+	_derivedMappingCache[cacheKey] = (DerivedROIs, mapMat)
+	return DerivedROIs, mapMat
+
+### Function to calculate derived ROI volumes from single ROI volumes indexed by ROI number
+###   VolumesInd is a vector (one subject) or a matrix with one row per subject
+def calcDerivedVolumes(VolumesInd, mapcsv):
+	DerivedROIs, mapMat = readDerivedMapping(mapcsv)
+
+	# Match the single ROI axis to the mapping (ROIs not in the image have zero volume)
+	VolumesInd = np.asarray(VolumesInd, dtype=np.float64)
+	numROIs = mapMat.shape[1]
+	if VolumesInd.shape[-1] < numROIs:
+		padding = [(0, 0)] * (VolumesInd.ndim - 1) + [(0, numROIs - VolumesInd.shape[-1])]
+		VolumesInd = np.pad(VolumesInd, padding)
+	else:
+		VolumesInd = VolumesInd[..., :numROIs]
+
+	DerivedVols = mapMat.dot(VolumesInd.T).T
+
+	return DerivedROIs, DerivedVols
+
 ### Function to calculate any mask volume
 def calcMaskVolume(maskfile):
 	
@@ -63,61 +159,146 @@ def calcMaskVolume(maskfile):
 		print("ERROR: Input file not provided!!!")
 		sys.exit(0) 
 
-	### Read the input image
-	roinii = nib.load(maskfile)
-	roiimg = roinii.get_fdata()
-
-	### Get voxel dimensions
-	voxdims1, voxdims2, voxdims3 = roinii.header.get_zooms()
-	voxvol = float(voxdims1)*float(voxdims2)*float(voxdims3)
+	### Count voxels of each label
+	ROIs, Counts, voxvol = calcLabelCounts(maskfile)
 
 	### Calculate mask volume
-	maskVol = voxvol * np.sum(roiimg.flatten()>0)
+	maskVol = voxvol * np.sum(Counts[ROIs > 0])
 	
 	return maskVol
 
+### Function to read the harmonized WMLS reference values (first time-point of each subject) of one sex
+def readWMLSRefValues(wmlscsv, sex):
+	WMLSref = refstore.loadRef(wmlscsv, sex)
+	# Rename 604 to Total White Matter Hyperintensity Volume
+	WMLSref.rename(columns={'604':'Total White Matter Hyperintensity Volume'}, inplace=True)
+
+	return WMLSref
+
+### Function to list the non-ROI columns of the reference values (demographics, ICV and asymmetry indices)
+def refNonROI(dfRef):
+	nonROI = list(dfRef.columns[dfRef.columns.str.contains('AI')].values)
+	nonROI.extend(['MRID','Study','PTID','Age','Sex','Diagnosis_nearest_2.0','SITE','Date','ICV','SPARE_AD','SPARE_BA'])
+
+	return nonROI
+
+### Function to ICV-adjust the reference ROIs to a given mean ICV and scale down by 1000
+def adjustRefByICV(dfRef, nonROI, icvMean):
+	cols = dfRef.columns.difference(nonROI)
+	dfRef[cols] = dfRef[cols].div(dfRef['ICV'], axis=0)*icvMean
+	# Convert from mm^3 to cm^3
+	dfRef[cols] = dfRef[cols]/1000
+
+	return dfRef
+
+### Function to calculate mean, std and sample count of the given reference columns
+def calcRefStats(dfRef, cols):
+	means = dfRef[cols].mean()
+	stds = dfRef[cols].std()
+	counts = dfRef[cols].count()
+
+	return {str(col): {'mean':float(means[col]), 'std':float(stds[col]), 'n':int(counts[col])} for col in cols}
+
+### Function to add the reported ROIs (hemisphere totals and asymmetry indices) to the reference values
+def calcRefReportVolumes(dfRef):
+
+	# Get all left and right ROIs
+	Rinds = list(maphemi.loc[(maphemi['HEMISPHERE'] == 'R'), 'ROI_INDEX'].values)
+	Linds = list(maphemi.loc[(maphemi['HEMISPHERE'] == 'L'), 'ROI_INDEX'].values)
+
+	### Brain volumes ###
+	# Total brain volume
+	dfRef.rename(columns={"701":"Total Brain Volume"}, inplace = True)
+	# Right brain volume (1/2 of all indivisible ROIs: 4,11,35,46,71,72,73,95)
+	dfRef["Right Brain Volume"] = dfRef[[str(i) for i in Rinds]].sum(axis=1) + (dfRef[['4','11','35','71','72','73','95']].sum(axis=1))/2
+	# Left brain volume (1/2 of all indivisible ROIs: 4,11,35,46,71,72,73,95)
+	dfRef["Left Brain Volume"] = dfRef[[str(i) for i in Linds]].sum(axis=1) + (dfRef[['4','11','35','71','72','73','95']].sum(axis=1))/2
+	# Asymmetry index for brain
+	dfRef["Brain AI"] = (dfRef["Left Brain Volume"] - dfRef["Right Brain Volume"]).abs().div((dfRef["Left Brain Volume"] + dfRef["Right Brain Volume"])/2,axis=0)
+
+	### Brainstem ### - had to adjust this ROI
+	dfRef["35"] = dfRef["35"] + dfRef["61"] + dfRef["62"]
+	dfRef.rename(columns={"35":"Total Brainstem Volume"}, inplace = True)
+
+	### Ventricles###
+	# Total ventricle
+	dfRef.rename(columns={"509":"Total Ventricle Volume"}, inplace = True)
+	# Right ventricle (1/2 of 3rd + 4th)
+	dfRef["Right Ventricle Volume"] = dfRef["49"] + dfRef["51"] + dfRef["4"]/2 + dfRef["11"]/2
+	# Left ventricle (1/2 of 3rd + 4th)
+	dfRef["Left Ventricle Volume"] = dfRef["50"] + dfRef["52"] + dfRef["4"]/2 + dfRef["11"]/2
+	# Asymmetry index for ventricles
+	dfRef["Ventricle AI"] = (dfRef["Left Ventricle Volume"] - dfRef["Right Ventricle Volume"]).abs().div((dfRef["Left Ventricle Volume"] + dfRef["Right Ventricle Volume"])/2,axis=0)
+
+	### Cerebellum ###
+	# Total cerebellum
+	dfRef.rename(columns={"502":"Total Cerebellum Volume"}, inplace = True)
+	# Right cerebellum
+	dfRef["Right Cerebellum Volume"] = dfRef["518"]
+	# Left cerebellum
+	dfRef["Left Cerebellum Volume"] = dfRef["510"]
+	# Asymmetry index for cerebellum
+	dfRef["Cerebellum AI"] = (dfRef["Left Cerebellum Volume"] - dfRef["Right Cerebellum Volume"]).abs().div((dfRef["Left Cerebellum Volume"] + dfRef["Right Cerebellum Volume"])/2,axis=0)
+
+	### Gray Matter ###
+	# Total gray matter
+	dfRef["601"] = dfRef["601"]
+	dfRef.rename(columns={"601":"Total Gray Matter Volume"}, inplace = True)
+	# Right gray matter - had to adjust this ROI with 1/2 of certain ROIs
+	dfRef["613"] = dfRef["613"] + dfRef["71"]/2 + dfRef["72"]/2 + dfRef["73"]/2
+	dfRef.rename(columns={"613":"Right Gray Matter Volume"}, inplace = True)
+	# Left gray matter - had to adjust this ROI with 1/2 of certain ROIs
+	dfRef["606"] = dfRef["606"] + dfRef["71"]/2 + dfRef["72"]/2 + dfRef["73"]/2
+	dfRef.rename(columns={"606":"Left Gray Matter Volume"}, inplace = True)
+
+	# Asymmetry index for gray matter
+	dfRef["Gray Matter AI"] = (dfRef["Left Gray Matter Volume"] - dfRef["Right Gray Matter Volume"]).abs().div((dfRef["Left Gray Matter Volume"] + dfRef["Right Gray Matter Volume"])/2,axis=0)
+
+	### White Matter ###
+	# Total white matter
+	dfRef.rename(columns={"604":"Total White Matter Volume"}, inplace = True)
+	# Right white matter - had to adjust this ROI with 1/2 of certain ROIs
+	dfRef.rename(columns={"614":"Right White Matter Volume"}, inplace = True)
+	# Left white matter - had to adjust this ROI with 1/2 of certain ROIs
+	dfRef.rename(columns={"607":"Left White Matter Volume"}, inplace = True)
+	# Asymmetry index for white matter
+	dfRef["White Matter AI"] = (dfRef["Left White Matter Volume"] - dfRef["Right White Matter Volume"]).abs().div((dfRef["Left White Matter Volume"] + dfRef["Right White Matter Volume"])/2, axis = 0)
+
+	### Hippocampus ###
+	# Total Hippocampus
+	dfRef["Total Hippocampus Volume"] = dfRef["47"] + dfRef["48"]
+	# Right Hippocampus
+	dfRef["Right Hippocampus Volume"] = dfRef["47"]
+	#Left Hippocampus
+	dfRef["Left Hippocampus Volume"] = dfRef["48"]
+	# Asymmetry index for hippocampus
+	dfRef["Hippocampus AI"] = (dfRef["Left Hippocampus Volume"] - dfRef["Right Hippocampus Volume"]).abs().div((dfRef["Left Hippocampus Volume"] + dfRef["Right Hippocampus Volume"])/2, axis = 0)
+
+
+	return dfRef
+
 ### Function to calculate derived ROI volumes for MUSE
-def calcRoiVolumes(maskfile, mapcsv, dfRef, subDict):
+def calcRoiVolumes(maskfile, mapcsv, dfRef, subDict, normStats=None):
 	
 	### Check input mask
 	if not maskfile:
 		print("ERROR: Input file not provided!!!")
 		sys.exit(0) 
 
-	### Read the input image
-	roinii = nib.load(maskfile)
-	roiimg = roinii.get_fdata()
-
-	### Get voxel dimensions
-	voxdims1, voxdims2, voxdims3 = roinii.header.get_zooms()
-	voxvol = float(voxdims1)*float(voxdims2)*float(voxdims3)
-
 	### Calculate ROI count and volume
-	ROIs, Counts = np.unique(roiimg, return_counts=True)
+	ROIs, Counts, voxvol = calcLabelCounts(maskfile)
 	ROIs = ROIs.astype(int)
 	Volumes = voxvol * Counts
 
 	### Create an array indexed from 0 to max ROI index
 	###   This array will speed up calculations for calculating derived ROIs
-	###   Instead of adding ROIs in a loop, they are added at once using: 
-	###          np.sum(all indexes for a derived ROI)  (see below)
+	###   Instead of adding ROIs in a loop, all derived ROIs are added at once using
+	###          the sparse single to derived ROI matrix (see readDerivedMapping)
 	VolumesInd = np.zeros(ROIs.max()+1)
 	VolumesInd[ROIs] = Volumes
 	
 	### Calculate derived volumes
-	DerivedROIs = []
-	DerivedVols = []
-	ROIlist = []
-	Vollist = []
-	with open(mapcsv) as mapcsvfile:
-		reader = _csv.reader(mapcsvfile, delimiter=',')
-		# Read each line in the csv map files
-		for row in reader:
-			row = list(filter(lambda a: a != '', row))
-			# Append the ROI number to the list
-			DerivedROIs.append(row[0])
-			roiInds = [int(x) for x in row[2:]]
-			DerivedVols.append(np.sum(VolumesInd[roiInds]))
+	DerivedROIs, DerivedVols = calcDerivedVolumes(VolumesInd, mapcsv)
 
 	### Declare objects we want to store
 	all_MuseROIs =  dict(zip(DerivedROIs, DerivedVols))
@@ -131,23 +312,24 @@ def calcRoiVolumes(maskfile, mapcsv, dfRef, subDict):
 	Linds = list(maphemi.loc[(maphemi['HEMISPHERE'] == 'L'), 'ROI_INDEX'].values)
 
 	#### Correct ref values temporarily for age + gender controlled z-score calculation ####
-	nonROI = list(dfRef.columns[dfRef.columns.str.contains('AI')].values)
-	nonROI.extend(['MRID','Study','PTID','Age','Sex','Diagnosis_nearest_2.0','SITE','Date','ICV','SPARE_AD','SPARE_BA'])
-	dfRefTmp = dfRef.copy(deep=True)
-	# Rename 702 to ICV
-	dfRefTmp.rename(columns={'702':'ICV'}, inplace=True)
-
-	# Do the ICV-adjust
-	dfRefTmp[dfRefTmp.columns.difference(nonROI)] = dfRefTmp[dfRefTmp.columns.difference(nonROI)].div(dfRefTmp['ICV'], axis=0)*dfRefTmp['ICV'].mean()
+	# Use the precomputed normative statistics if available, otherwise compute them from the reference values
+	if normStats is not None:
+		roiStats = normStats['ROI']
+	else:
+		dfRefTmp = dfRef.copy(deep=True)
+		# Rename 702 to ICV
+		dfRefTmp.rename(columns={'702':'ICV'}, inplace=True)
+		nonROI = refNonROI(dfRefTmp)
 
-	# Convert from mm^3 to cm^3
-	dfRefTmp[dfRefTmp.columns.difference(nonROI)] = dfRefTmp[dfRefTmp.columns.difference(nonROI)]/1000
+		# Do the ICV-adjust and convert from mm^3 to cm^3
+		dfRefTmp = adjustRefByICV(dfRefTmp, nonROI, dfRefTmp['ICV'].mean())
+		roiStats = calcRefStats(dfRefTmp, [i for i in all_MuseROIs.keys() if int(i) <= 207])
 
 	## Create anatomical structure to z-score equivalency for the subject; only considering ROIs Ilya said to use! - z-score is calculated across all same sex ref patients
 	for i in list(all_MuseROIs.keys()):
 		# Only look at single ROIs
 		if int(i) <= 207:
-			allz[i] = ((all_MuseROIs[i]/1000) - dfRefTmp[i].mean())/(dfRefTmp[i].std())
+			allz[i] = ((all_MuseROIs[i]/1000) - roiStats[i]['mean'])/(roiStats[i]['std'])
 			allz_num[i] = allz[i]
 			name = list(maphemi.loc[(maphemi['ROI_INDEX'] == int(i)), 'ROI_NAME'].values)[0]
 			allz[name] = allz.pop(i)
@@ -155,113 +337,95 @@ def calcRoiVolumes(maskfile, mapcsv, dfRef, subDict):
 		else:
 			continue
 	
-	### Select patient ROIs to report and add colloquial terminology to selected patient (dictr) and reference ROIs (dfRef) ###
+	### Select patient ROIs to report and add colloquial terminology to selected patient (dictr) ###
 	### Brain volumes ###
 	# Total brain volume
 	dictr["Total Brain Volume"] = all_MuseROIs["701"]
-	dfRef.rename(columns={"701":"Total Brain Volume"}, inplace = True)
 	# Right brain volume (1/2 of all indivisible ROIs: 4,11,35,46,71,72,73,95)
 	dictr["Right Brain Volume"] = np.sum(VolumesInd[Rinds]) + np.sum(VolumesInd[[4,11,35,71,72,73,95]])/2
-	dfRef["Right Brain Volume"] = dfRef[[str(i) for i in Rinds]].sum(axis=1) + (dfRef[['4','11','35','71','72','73','95']].sum(axis=1))/2
 	# Left brain volume (1/2 of all indivisible ROIs: 4,11,35,46,71,72,73,95)
 	dictr["Left Brain Volume"] = np.sum(VolumesInd[Linds]) + np.sum(VolumesInd[[4,11,35,71,72,73,95]])/2
-	dfRef["Left Brain Volume"] = dfRef[[str(i) for i in Linds]].sum(axis=1) + (dfRef[['4','11','35','71','72','73','95']].sum(axis=1))/2
 	# Asymmetry index for brain
 	dictr["Brain AI"] = abs(dictr["Left Brain Volume"] - dictr["Right Brain Volume"])/((dictr["Left Brain Volume"] + dictr["Right Brain Volume"])/2)
-	dfRef["Brain AI"] = (dfRef["Left Brain Volume"] - dfRef["Right Brain Volume"]).abs().div((dfRef["Left Brain Volume"] + dfRef["Right Brain Volume"])/2,axis=0)
 
 	### Brainstem ### - had to adjust this ROI
 	dictr["Total Brainstem Volume"] = all_MuseROIs["35"] + all_MuseROIs["61"] + all_MuseROIs["62"]
-	dfRef["35"] = dfRef["35"] + dfRef["61"] + dfRef["62"]
-	dfRef.rename(columns={"35":"Total Brainstem Volume"}, inplace = True)
 
 	### Ventricles###
 	# Total ventricle
 	dictr["Total Ventricle Volume"] = all_MuseROIs["509"]
-	dfRef.rename(columns={"509":"Total Ventricle Volume"}, inplace = True)
 	# Right ventricle (1/2 of 3rd + 4th)
 	dictr["Right Ventricle Volume"] = all_MuseROIs["49"] + all_MuseROIs["51"] + all_MuseROIs["4"]/2 + all_MuseROIs["11"]/2
-	dfRef["Right Ventricle Volume"] = dfRef["49"] + dfRef["51"] + dfRef["4"]/2 + dfRef["11"]/2
 	# Left ventricle (1/2 of 3rd + 4th)
 	dictr["Left Ventricle Volume"] = all_MuseROIs["50"] + all_MuseROIs["52"] + all_MuseROIs["4"]/2 + all_MuseROIs["11"]/2
-	dfRef["Left Ventricle Volume"] = dfRef["50"] + dfRef["52"] + dfRef["4"]/2 + dfRef["11"]/2
 	# Asymmetry index for ventricles
 	dictr["Ventricle AI"] = abs(dictr["Left Ventricle Volume"] - dictr["Right Ventricle Volume"])/((dictr["Left Ventricle Volume"] + dictr["Right Ventricle Volume"])/2)
-	dfRef["Ventricle AI"] = (dfRef["Left Ventricle Volume"] - dfRef["Right Ventricle Volume"]).abs().div((dfRef["Left Ventricle Volume"] + dfRef["Right Ventricle Volume"])/2,axis=0)
 
 	### Cerebellum ###
 	# Total cerebellum
 	dictr["Total Cerebellum Volume"] = all_MuseROIs["502"]
-	dfRef.rename(columns={"502":"Total Cerebellum Volume"}, inplace = True)
 	# Right cerebellum
 	dictr["Right Cerebellum Volume"] = all_MuseROIs["518"]
-	dfRef["Right Cerebellum Volume"] = dfRef["518"]
 	# Left cerebellum
 	dictr["Left Cerebellum Volume"] = all_MuseROIs["510"]
-	dfRef["Left Cerebellum Volume"] = dfRef["510"]
 	# Asymmetry index for cerebellum
 	dictr["Cerebellum AI"] = abs(dictr["Left Cerebellum Volume"] - dictr["Right Cerebellum Volume"])/((dictr["Left Cerebellum Volume"] + dictr["Right Cerebellum Volume"])/2)
-	dfRef["Cerebellum AI"] = (dfRef["Left Cerebellum Volume"] - dfRef["Right Cerebellum Volume"]).abs().div((dfRef["Left Cerebellum Volume"] + dfRef["Right Cerebellum Volume"])/2,axis=0)
 
 	### Gray Matter ###
 	# Total gray matter
 	dictr["Total Gray Matter Volume"] = all_MuseROIs["601"]
-	dfRef["601"] = dfRef["601"]
-	dfRef.rename(columns={"601":"Total Gray Matter Volume"}, inplace = True)
 	# Right gray matter - had to adjust this ROI with 1/2 of certain ROIs
 	dictr["Right Gray Matter Volume"] = all_MuseROIs["613"] + all_MuseROIs["71"]/2 + all_MuseROIs["72"]/2 + all_MuseROIs["73"]/2
-	dfRef["613"] = dfRef["613"] + dfRef["71"]/2 + dfRef["72"]/2 + dfRef["73"]/2
-	dfRef.rename(columns={"613":"Right Gray Matter Volume"}, inplace = True)
 	# Left gray matter - had to adjust this ROI with 1/2 of certain ROIs
 	dictr["Left Gray Matter Volume"] = all_MuseROIs["606"] + all_MuseROIs["71"]/2 + all_MuseROIs["72"]/2 + all_MuseROIs["73"]/2
-	dfRef["606"] = dfRef["606"] + dfRef["71"]/2 + dfRef["72"]/2 + dfRef["73"]/2
-	dfRef.rename(columns={"606":"Left Gray Matter Volume"}, inplace = True)
 
 	# Asymmetry index for gray matter
 	dictr["Gray Matter AI"] = abs(dictr["Left Gray Matter Volume"] - dictr["Right Gray Matter Volume"])/((dictr["Left Gray Matter Volume"] + dictr["Right Gray Matter Volume"])/2)
-	dfRef["Gray Matter AI"] = (dfRef["Left Gray Matter Volume"] - dfRef["Right Gray Matter Volume"]).abs().div((dfRef["Left Gray Matter Volume"] + dfRef["Right Gray Matter Volume"])/2,axis=0)
 
 	### White Matter ###
 	# Total white matter
 	dictr["Total White Matter Volume"] = all_MuseROIs["604"]
-	dfRef.rename(columns={"604":"Total White Matter Volume"}, inplace = True)
 	# Right white matter - had to adjust this ROI with 1/2 of certain ROIs
 	dictr["Right White Matter Volume"] = all_MuseROIs["614"] + all_MuseROIs["95"]/2
-	dfRef.rename(columns={"614":"Right White Matter Volume"}, inplace = True)
 	# Left white matter - had to adjust this ROI with 1/2 of certain ROIs
 	dictr["Left White Matter Volume"] = all_MuseROIs["607"] + all_MuseROIs["95"]/2
-	dfRef.rename(columns={"607":"Left White Matter Volume"}, inplace = True)
 	# Asymmetry index for white matter
 	dictr["White Matter AI"] = abs(dictr["Left White Matter Volume"] - dictr["Right White Matter Volume"])/((dictr["Left White Matter Volume"] + dictr["Right White Matter Volume"])/2)
-	dfRef["White Matter AI"] = (dfRef["Left White Matter Volume"] - dfRef["Right White Matter Volume"]).abs().div((dfRef["Left White Matter Volume"] + dfRef["Right White Matter Volume"])/2, axis = 0)
 
 	### Hippocampus ###
 	# Total Hippocampus
 	dictr["Total Hippocampus Volume"] = all_MuseROIs["47"] + all_MuseROIs["48"]
-	dfRef["Total Hippocampus Volume"] = dfRef["47"] + dfRef["48"]
 	# Right Hippocampus
 	dictr["Right Hippocampus Volume"] = all_MuseROIs["47"]
-	dfRef["Right Hippocampus Volume"] = dfRef["47"]
 	#Left Hippocampus
 	dictr["Left Hippocampus Volume"] = all_MuseROIs["48"]
-	dfRef["Left Hippocampus Volume"] = dfRef["48"]
 	# Asymmetry index for hippocampus
 	dictr["Hippocampus AI"] = abs(dictr["Left Hippocampus Volume"] - dictr["Right Hippocampus Volume"])/((dictr["Left Hippocampus Volume"] + dictr["Right Hippocampus Volume"])/2)
-	dfRef["Hippocampus AI"] = (dfRef["Left Hippocampus Volume"] - dfRef["Right Hippocampus Volume"]).abs().div((dfRef["Left Hippocampus Volume"] + dfRef["Right Hippocampus Volume"])/2, axis = 0)
+
+	### Add the same colloquial terminology to the reference ROIs (dfRef) ###
+	dfRef = calcRefReportVolumes(dfRef)
 
 	return dictr, dfRef, allz, allz_num, all_MuseROIs, all_MuseROIs_name
 
 ### Function adjust all ROIs by ICV and scales down by 1000 ###
-def ICVAdjust(dfSub, dfRef,WMLSref,all_MuseROIs_num,all_MuseROIs_name):
+def ICVAdjust(dfSub, dfRef,WMLSref,all_MuseROIs_num,all_MuseROIs_name,normStats=None):
+	## Mean reference ICVs, precomputed if available
+	if normStats is not None:
+		refICV = normStats['ICV']['mean']
+		WMLSrefICV = normStats['WMLS_ICV']['mean']
+	else:
+		refICV = dfRef['ICV'].mean()
+		WMLSrefICV = WMLSref['ICV'].mean()
+
 	## ICV-adjustment for subject values
 	nonROI = list(dfSub.columns[dfSub.columns.str.contains('AI')].values)
 	othervars = ['MRID','Age','Sex','ICV']
 	nonROI.extend(othervars)
 
 	#### ICV-adjustment for subject values ####
-	dfSub[dfSub.columns.difference(nonROI)] = dfSub[dfSub.columns.difference(nonROI)].div(dfSub['ICV'], axis=0)*dfRef['ICV'].mean()
-	all_MuseROIs_num = {key: ((value / dfSub['ICV'].values[0])*dfRef['ICV'].mean())/1000 for key, value in all_MuseROIs_num.items()}
-	all_MuseROIs_name = {key: ((value / dfSub['ICV'].values[0])*dfRef['ICV'].mean())/1000 for key, value in all_MuseROIs_name.items()}
+	dfSub[dfSub.columns.difference(nonROI)] = dfSub[dfSub.columns.difference(nonROI)].div(dfSub['ICV'], axis=0)*refICV
+	all_MuseROIs_num = {key: ((value / dfSub['ICV'].values[0])*refICV)/1000 for key, value in all_MuseROIs_num.items()}
+	all_MuseROIs_name = {key: ((value / dfSub['ICV'].values[0])*refICV)/1000 for key, value in all_MuseROIs_name.items()}
 	# make 702 into actual ICV value
 	all_MuseROIs_num['702'] = dfSub['ICV'].values[0]
 
@@ -269,20 +433,16 @@ def ICVAdjust(dfSub, dfRef,WMLSref,all_MuseROIs_num,all_MuseROIs_name):
 	dfSub[dfSub.columns.difference(nonROI)] = dfSub[dfSub.columns.difference(nonROI)]/1000
 
 	## ICV-adjustment for ROI reference values
-	nonROI = list(dfRef.columns[dfRef.columns.str.contains('AI')].values)
-	othervars = ['MRID','Study','PTID','Age','Sex','Diagnosis_nearest_2.0','SITE','Date','ICV','SPARE_AD','SPARE_BA']
-	nonROI.extend(othervars)
+	nonROI = refNonROI(dfRef)
 
 	#### ICV-adjustment for ROI reference values ####
-	dfRef[dfRef.columns.difference(nonROI)] = dfRef[dfRef.columns.difference(nonROI)].div(dfRef['ICV'], axis=0)*dfRef['ICV'].mean()
-	# Convert from mm^3 to cm^3
-	dfRef[dfRef.columns.difference(nonROI)] = dfRef[dfRef.columns.difference(nonROI)]/1000
+	dfRef = adjustRefByICV(dfRef, nonROI, refICV)
 
 	## ICV-adjustment for WMLS reference values
 	nonROI = ['ID','Phase','PTID','Age','Sex','Diagnosis_nearest_2.0','Date','ICV']
 
 	#### ICV-adjustment for WMLS reference values ####
-	WMLSref[WMLSref.columns.difference(nonROI)] = WMLSref[WMLSref.columns.difference(nonROI)].div(WMLSref['ICV'], axis=0)*WMLSref['ICV'].mean()
+	WMLSref[WMLSref.columns.difference(nonROI)] = WMLSref[WMLSref.columns.difference(nonROI)].div(WMLSref['ICV'], axis=0)*WMLSrefICV
 	# Convert from mm^3 to cm^3
 	WMLSref[WMLSref.columns.difference(nonROI)] = WMLSref[WMLSref.columns.difference(nonROI)]/1000
 
@@ -312,21 +472,81 @@ def nonICVAdjust(dfSub,dfRef,WMLSref,all_MuseROIs_num,all_MuseROIs_name):
 
 	return dfSub, dfRef, WMLSref, all_MuseROIs_num, all_MuseROIs_name
 
+### Function to precompute the per-sex normative statistics used for the subject z-scores
+def buildNormStats(refcsv, wmlscsv):
+	# Identify L and R pairs of single ROIs (as in the AI table of the report)
+	R = dict(zip(maphemi.loc[(maphemi['HEMISPHERE'] == 'R'), 'ROI_NAME'].values, maphemi.loc[(maphemi['HEMISPHERE'] == 'R'), 'ROI_INDEX'].values))
+	L = dict(zip(maphemi.loc[(maphemi['HEMISPHERE'] == 'L'), 'ROI_NAME'].values, maphemi.loc[(maphemi['HEMISPHERE'] == 'L'), 'ROI_INDEX'].values))
+
+	normStats = {'version':NORM_STATS_VERSION, 'source':{}}
+	for csvfile in [refcsv, wmlscsv]:
+		normStats['source'][_os.path.basename(csvfile)] = refstore.stampRefFile(csvfile)
+
+	for sex in ['F','M']:
+		dfRef = refstore.loadRef(refcsv, sex)
+		WMLSref = readWMLSRefValues(wmlscsv, sex)
+		sexStats = {}
+
+		# Mean reference ICVs
+		sexStats['ICV'] = {'mean':float(dfRef['702'].mean())}
+		sexStats['WMLS_ICV'] = {'mean':float(WMLSref['ICV'].mean())}
+
+		# Single and derived ROIs, as corrected temporarily in calcRoiVolumes
+		dfRefTmp = dfRef.rename(columns={'702':'ICV'})
+		nonROI = refNonROI(dfRefTmp)
+		dfRefTmp = adjustRefByICV(dfRefTmp, nonROI, dfRefTmp['ICV'].mean())
+		sexStats['ROI'] = calcRefStats(dfRefTmp, dfRefTmp.columns.difference(nonROI))
+
+		# Reported ROIs and asymmetry indices, as in the reference values passed on by _main
+		dfRefRep = calcRefReportVolumes(dfRef).rename(columns={'702':'ICV'})
+		nonROI = refNonROI(dfRefRep)
+		dfRefRep = adjustRefByICV(dfRefRep, nonROI, sexStats['ICV']['mean'])
+		sexStats['Report'] = calcRefStats(dfRefRep, dfRefRep.columns.difference(['MRID','Study','PTID','Sex','Diagnosis_nearest_2.0','SITE','Date']))
+
+		# Asymmetry index of each L/R pair of single ROIs, keyed by the base name of the ROI
+		aiStats = {}
+		for i in L.keys():
+			base = i.split()
+			base[0] = 'Right'
+			j = ' '.join(base)
+			if j not in R or str(L[i]) not in dfRefRep.columns or str(R[j]) not in dfRefRep.columns:
+				continue
+			AI_ref = (dfRefRep[str(L[i])] - dfRefRep[str(R[j])]).abs().div((dfRefRep[str(L[i])] + dfRefRep[str(R[j])])/2, axis = 0)
+			base[1] = base[1].title()
+			aiStats[' '.join(base[1:])] = {'mean':float(AI_ref.mean()), 'std':float(AI_ref.std()), 'n':int(AI_ref.count())}
+		sexStats['AI'] = aiStats
+
+		normStats[sex] = sexStats
+
+	return normStats
+
+### Function to load the precomputed normative statistics for one sex
+###   Returns None (i.e. compute from the reference values) if the table is missing or stale
+def loadNormStats(statsfile, sex, refcsv=MUSE_Ref_Values, wmlscsv=WMLS_Ref_Values):
+	if not _os.path.exists(statsfile):
+		print("Normative statistics not found, computing them from the reference values...")
+		return None
+
+	with open(statsfile, 'r') as read_file:
+		normStats = json.load(read_file)
+
+	if normStats.get('version') != NORM_STATS_VERSION:
+		print("Normative statistics version mismatch, computing them from the reference values...")
+		return None
+
+	# Size and modification time of the reference csvs, not their content (checked for each subject)
+	for csvfile in [refcsv, wmlscsv]:
+		if _os.path.exists(csvfile) and normStats['source'].get(_os.path.basename(csvfile)) != refstore.stampRefFile(csvfile):
+			print("Normative statistics out of date with " + csvfile + ", computing them from the reference values...")
+			return None
+
+	return normStats.get(sex)
+
 ############## MAIN ##############
 #DEF
 def _main(roi, icv, wmls, _json, out_path):
 	UID = _os.path.basename(out_path.removesuffix(".pdf"))
-	##########################################################################
-	##### Read and initial filter for reference ROI values
-	dfRef = pd.read_csv(MUSE_Ref_Values).dropna()
 	out = _os.path.dirname(out_path)
-	dfRef['Date'] = pd.to_datetime(dfRef.Date)
-	dfRef = dfRef.sort_values(by='Date')
-	# Get first-time points only from reference values
-	dfRef = dfRef.drop_duplicates(subset=['PTID'], keep='first')
-	# Replace binary variable with categorical
-	dfRef['Sex'].replace(0, 'F',inplace=True)
-	dfRef['Sex'].replace(1, 'M',inplace=True)
 
 	##########################################################################
 	##### Read subject data (demog and MRI)
@@ -349,8 +569,11 @@ def _main(roi, icv, wmls, _json, out_path):
 	dfPat.loc[3] = str(subDict['ExamDate'])
 	dfPat.loc[4] = datetime.today().strftime('%m-%d-%Y')
 
-	# same sex selection - all work with dfRef onwards is based on same sex
-	dfRef = dfRef[dfRef.Sex == dfSub.loc[0,'Sex']]
+	##### Read reference ROI values
+	# same sex selection - all work with dfRef onwards is based on same sex (first time-points only)
+	dfRef = refstore.loadRef(MUSE_Ref_Values, dfSub.loc[0,'Sex'])
+	# Precomputed same sex normative statistics
+	normStats = loadNormStats(MUSE_Norm_Stats, dfSub.loc[0,'Sex'])
 
 	## Read icv, if provided
 	icvVol = None
@@ -360,7 +583,7 @@ def _main(roi, icv, wmls, _json, out_path):
 		dfSub['ICV'] = icvVol
 
 	# Obtain foundational objects for after this container
-	roiVols, dfRef, allz, allz_num, all_MuseROIs_num, all_MuseROIs_name = calcRoiVolumes(roi[0], MUSE_ROI_Mapping, dfRef, subDict)
+	roiVols, dfRef, allz, allz_num, all_MuseROIs_num, all_MuseROIs_name = calcRoiVolumes(roi[0], MUSE_ROI_Mapping, dfRef, subDict, normStats)
 	# Add subject MUSE volumes to 
 	for key in roiVols.keys():
 		dfSub.loc[0, key] = roiVols[key]
@@ -375,23 +598,15 @@ def _main(roi, icv, wmls, _json, out_path):
 	dfSub['Total White Matter Hyperintensity Volume'] = wmlsVol
 
 	### Add WMLS 604 reference datapoints to dfRef ###
-	WMLSref = pd.read_csv('/refs/WMLS_combinedrefs.csv').dropna()
-	WMLSref['Date'] = pd.to_datetime(WMLSref.Date)
-	WMLSref = WMLSref.sort_values(by='Date')
-	# Get first-time points only
-	WMLSref = WMLSref.drop_duplicates(subset=['PTID'], keep='first')
-	# Binarize sex
-	WMLSref['Sex'].replace(0, 'F',inplace=True)
-	WMLSref['Sex'].replace(1, 'M',inplace=True)
-	# same sex selection - all work with WMLSref onwards is based on same sex
-	WMLSref = WMLSref[WMLSref.Sex == dfSub.loc[0,'Sex']]
-	# Rename 604 to Total White Matter Hyperintensity Volume
-	WMLSref.rename(columns={'604':'Total White Matter Hyperintensity Volume'}, inplace=True)
+	# same sex selection - all work with WMLSref onwards is based on same sex (first time-points only)
+	WMLSref = readWMLSRefValues(WMLS_Ref_Values, dfSub.loc[0,'Sex'])
 
 	# ICV-adjust only if ICV is available - in final version, we should throw an error and stop the pipeline
 	if dfSub.loc[0,'ICV'] is not None:
-		dfSub, dfRef, WMLSref, all_MuseROIs_num, all_MuseROIs_name = ICVAdjust(dfSub,dfRef,WMLSref,all_MuseROIs_num,all_MuseROIs_name)
+		dfSub, dfRef, WMLSref, all_MuseROIs_num, all_MuseROIs_name = ICVAdjust(dfSub,dfRef,WMLSref,all_MuseROIs_num,all_MuseROIs_name,normStats)
 	else:
+		# Precomputed statistics are of ICV-adjusted reference values only
+		normStats = None
 		dfSub, dfRef, WMLSref, all_MuseROIs_num, all_MuseROIs_name = nonICVAdjust(dfSub,dfRef,WMLSref,all_MuseROIs_num,all_MuseROIs_name)
 
 	# Define which directory to save to
@@ -414,6 +629,9 @@ def _main(roi, icv, wmls, _json, out_path):
 		pickle.dump(all_MuseROIs_num,pickle_file)
 	with open(_os.path.join(out,UID+'_all_MuseROIs_name.pkl'), 'wb') as pickle_file:
 		pickle.dump(all_MuseROIs_name,pickle_file)
+	if normStats is not None:
+		with open(_os.path.join(out,UID+'_normStats.pkl'), 'wb') as pickle_file:
+			pickle.dump(normStats,pickle_file)
 
 
 ####### Local Test ##############
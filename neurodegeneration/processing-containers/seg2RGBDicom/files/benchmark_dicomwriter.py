@@ -0,0 +1,104 @@
+import sys, os
+import time
+import filecmp
+import tempfile
+import numpy as np
+import SimpleITK as sitk
+
+import dicomwriter
+from cpuquota import available_cpus
+
+# Benchmark of the dicom series writer on a synthetic RGB overlay (gray head with colored label blobs)
+#   'legacy'      previous writer: tags converted and set one by one for each slice, one shared writer, one process
+#   'workers=N'   dicomwriter.write_series with N writer processes
+#   The series written with several workers are compared byte by byte with the series written by one worker
+#   Then each output mode (slices with all workers, multiframe) is written with each compression: number of files,
+#   size, and whether the image read back (SimpleITK) is identical to the overlay (lossless)
+#   Usage: python3 benchmark_dicomwriter.py [number of slices (default 200)] [workers, comma separated (default 1,2,4,all cores available to the container)]
+
+### Function to create a synthetic (slices, 256, 256) RGB overlay and the tags of its series
+def syntheticSeries(depth):
+    rng = np.random.default_rng(0)
+    z, y, x = np.meshgrid(np.linspace(-1, 1, depth), np.linspace(-1, 1, 256), np.linspace(-1, 1, 256), indexing='ij', sparse=True)
+    r = np.sqrt(z**2 + (y/0.9)**2 + (x/0.75)**2)
+    gray = np.where(r < 0.95, 90 + 60*np.cos(12*r) + rng.normal(0, 8, r.shape), 0).clip(0, 255).astype(np.uint8)
+    rgb = np.repeat(gray[..., None], 3, axis=3)
+    for center, color in zip(rng.uniform(-0.5, 0.5, (12, 3)), rng.integers(0, 256, (12, 3))):
+        blob = (z - center[0])**2 + (y - center[1])**2 + (x - center[2])**2 < 0.02
+        rgb[blob] = (rgb[blob]*0.5 + color*0.5).astype(np.uint8)
+    img = sitk.GetImageFromArray(rgb, isVector=True)
+    img.SetSpacing((0.9, 0.9, 1.2))
+    direction = img.GetDirection()
+    date, now = time.strftime("%Y%m%d"), time.strftime("%H%M%S")
+    tags = [("0008|0031", now), ("0008|0021", date), ("0008|0008", "DERIVED\\SECONDARY"),
+            ("0020|000e", "1.2.826.0.1.3680043.2.1125." + date + ".1" + now),
+            ("0020|0037", '\\'.join(map(str, (direction[0], direction[3], direction[6], direction[1], direction[4], direction[7])))),
+            ("0008|103e", "Segmentation Overlay"), ("0010|0020", "BENCH"), ("0010|0010", "BENCHMARK^SERIES"),
+            ("0010|0040", "F"), ("0010|1010", "070Y"), ("0020|000D", "1.2.826.0.1.3680043.2.1125.1." + date),
+            ("0020|0010", "1"), ("0008|0020", date), ("0008|0030", now), ("0008|0060", "MR"), ("0008|0050", "1")]
+    return img, tags
+
+### Previous writer, for reference
+def legacyWrite(outdir, tags_to_write, new_img):
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    for i in range(new_img.GetDepth()):
+        image_slice = new_img[:,:,i]
+        list(map(lambda tag_value: image_slice.SetMetaData(tag_value[0], str(tag_value[1])), tags_to_write))
+        image_slice.SetMetaData("0008|0012", time.strftime("%Y%m%d"))
+        image_slice.SetMetaData("0008|0013", time.strftime("%H%M%S"))
+        image_slice.SetMetaData("0020|0032", '\\'.join(map(str,new_img.TransformIndexToPhysicalPoint((0,0,i)))))
+        image_slice.SetMetaData("0020|0013", str(i))
+        image_slice.SetMetaData("0020|0011", "901")
+        writer.SetFileName(os.path.join(outdir,str(i)+'.dcm'))
+        writer.Execute(image_slice)
+
+if __name__ == '__main__':
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    cores = available_cpus()
+    workerCounts = [int(w) for w in sys.argv[2].split(',')] if len(sys.argv) > 2 else sorted(set([1, 2, 4, cores]))
+
+    img, tags = syntheticSeries(depth)
+    shared = dicomwriter.series_tags(tags, "901")
+    print(f'{depth} slices of {img.GetSize()[0]}x{img.GetSize()[1]} RGB, {cores} cores')
+    print(f'{"writer":12s} {"wall s":>8s} {"slices/s":>9s} {"identical":>10s}')
+    with tempfile.TemporaryDirectory() as tmp:
+        outdir = os.path.join(tmp, 'legacy')
+        os.makedirs(outdir)
+        start = time.perf_counter()
+        legacyWrite(outdir, tags, img)
+        wall = time.perf_counter() - start
+        print(f'{"legacy":12s} {wall:8.2f} {depth/wall:9.1f} {"-":>10s}')
+
+        reference = None
+        for workers in workerCounts:
+            outdir = os.path.join(tmp, 'workers' + str(workers))
+            os.makedirs(outdir)
+            start = time.perf_counter()
+            dicomwriter.write_series(outdir, shared, img, workers)
+            wall = time.perf_counter() - start
+            names = [str(i) + '.dcm' for i in range(depth)]
+            if reference is None:
+                reference = outdir
+            match, mismatch, errors = filecmp.cmpfiles(reference, outdir, names, shallow=False)
+            identical = 'yes' if len(match) == depth else f'{len(mismatch) + len(errors)} differ'
+            print(f'{"workers=" + str(workers):12s} {wall:8.2f} {depth/wall:9.1f} {identical:>10s}')
+
+        print(f'\n{"mode":11s} {"compression":11s} {"wall s":>8s} {"files":>6s} {"MB":>8s} {"lossless":>9s}')
+        for mode in dicomwriter.OUTPUT_MODES:
+            for compression in dicomwriter.COMPRESSIONS:
+                outdir = os.path.join(tmp, mode + '_' + str(compression))
+                os.makedirs(outdir)
+                start = time.perf_counter()
+                dicomwriter.write_dicom(outdir, shared, sitk.Image(img), mode, max(workerCounts), compression)
+                wall = time.perf_counter() - start
+                files = [os.path.join(outdir, f) for f in os.listdir(outdir)]
+                size = sum(os.path.getsize(f) for f in files)/2**20
+                if mode == 'slices':
+                    reader = sitk.ImageSeriesReader()
+                    reader.SetFileNames(reader.GetGDCMSeriesFileNames(outdir))
+                    readback = reader.Execute()
+                else:
+                    readback = sitk.ReadImage(files[0])
+                lossless = 'yes' if np.array_equal(sitk.GetArrayViewFromImage(readback), sitk.GetArrayViewFromImage(img)) else 'no'
+                print(f'{mode:11s} {str(compression):11s} {wall:8.2f} {len(files):6d} {size:8.2f} {lossless:>9s}')
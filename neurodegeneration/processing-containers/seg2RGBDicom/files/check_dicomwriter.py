@@ -0,0 +1,44 @@
+import sys, os
+import tempfile
+import numpy as np
+import SimpleITK as sitk
+import pydicom
+
+import dicomwriter
+from benchmark_dicomwriter import syntheticSeries
+
+# Check of the multi-frame output of dicomwriter, read back with pydicom (not GDCM, which wrote it)
+#   For each compression: SOP class, number of frames, transfer syntax, and pixels decoded identical to the image
+#   Run at image build time, so that the build fails if a compression is not written or decoded as expected
+#   Usage: python3 check_dicomwriter.py [number of slices (default 16)]
+
+# Transfer syntax of each compression (COMPRESSIONS) #
+TRANSFER_SYNTAXES = {None: '1.2.840.10008.1.2', # Implicit VR Little Endian
+                     'JPEG': '1.2.840.10008.1.2.4.70', # JPEG Lossless, Process 14 (Selection Value 1)
+                     'JPEG2000': '1.2.840.10008.1.2.4.90', # JPEG 2000 Lossless Only
+                     'RLE': '1.2.840.10008.1.2.5'} # RLE Lossless
+
+### Function to check a multi-frame instance written by write_multiframe against the image written
+def check_multiframe(path, img, compression=None):
+    ds = pydicom.dcmread(path)
+    assert ds.file_meta.TransferSyntaxUID == TRANSFER_SYNTAXES[compression], f'{compression}: transfer syntax {ds.file_meta.TransferSyntaxUID}'
+    assert ds.SOPClassUID == dicomwriter.MULTIFRAME_SOP_CLASS_UID, f'{compression}: SOP class {ds.SOPClassUID}'
+    assert int(ds.NumberOfFrames) == img.GetDepth(), f'{compression}: {ds.NumberOfFrames} frames for {img.GetDepth()} slices'
+    assert ds.SamplesPerPixel == 3 and ds.PhotometricInterpretation == 'RGB', f'{compression}: {ds.SamplesPerPixel} samples, {ds.PhotometricInterpretation}'
+    pixels = ds.pixel_array
+    expected = sitk.GetArrayViewFromImage(img)
+    assert pixels.shape == expected.shape, f'{compression}: decoded pixels of shape {pixels.shape}, expected {expected.shape}'
+    assert np.array_equal(pixels, expected), f'{compression}: decoded pixels differ from the image'
+
+if __name__ == '__main__':
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    img, tags = syntheticSeries(depth)
+    shared = dicomwriter.series_tags(tags, "901")
+    with tempfile.TemporaryDirectory() as tmp:
+        for compression in dicomwriter.COMPRESSIONS:
+            outdir = os.path.join(tmp, str(compression))
+            os.makedirs(outdir)
+            dicomwriter.write_multiframe(outdir, shared, sitk.Image(img), compression)
+            check_multiframe(os.path.join(outdir, 'multiframe.dcm'), img, compression)
+            print(f'multiframe {str(compression):9s} ok: {depth} frames, transfer syntax {TRANSFER_SYNTAXES[compression]}')
+    print("Multi-frame output read back identical with pydicom")
@@ -0,0 +1,151 @@
+import os
+import time
+import uuid
+from multiprocessing import get_context
+import SimpleITK as sitk
+import pydicom
+from pydicom.uid import RLELossless
+
+#### DICOM series writer ###
+# The tags shared by the series are built once, and the slices are written by worker processes (forked with the
+# image, no copies), each with its own ImageFileWriter.
+# The SOP Instance UID of each slice is derived from a UID root generated once per series (series_tags) and the slice
+# index, so a slice file does not depend on the process (or the order) in which it is written, and two series written
+# at the same time (e.g. T1 and FLAIR overlays) never share instance UIDs.
+# Alternatively, the whole image is written as one multi-frame instance (the per-frame positions are written by GDCM).
+# Both can be compressed losslessly, with the codecs of GDCM: JPEG lossless (process 14) or JPEG 2000 lossless, or with
+# the RLE lossless encoder of pydicom (GDCM, as wrapped by SimpleITK, has no RLE encoder): the file is written
+# uncompressed by GDCM, then compressed in place.
+
+# SOP Instance UID tag #
+SOP_INSTANCE_UID_TAG = "0008|0018"
+
+# Output modes: one file per slice, or one multi-frame file #
+OUTPUT_MODES = ['slices', 'multiframe']
+# Lossless compressions (None: uncompressed) #
+COMPRESSIONS = [None, 'JPEG', 'JPEG2000', 'RLE']
+# Compressions encoded by pydicom (native encoders, no codec plugin needed): transfer syntax #
+PYDICOM_COMPRESSIONS = {'RLE': RLELossless}
+# SOP class of the multi-frame instance: Multi-frame True Color Secondary Capture Image Storage (GDCM would pick the
+# enhanced storage class of the modality, e.g. Enhanced MR, which does not allow RGB) #
+MULTIFRAME_SOP_CLASS_UID = "1.2.840.10008.5.1.4.1.1.7.4"
+
+# Series being written, inherited by the forked worker processes #
+_series = {}
+# Writers of this (worker) process, by compression #
+_writers = {}
+
+### Function to generate a unique DICOM UID (UUID derived, 2.25.<uuid as integer>)
+def generate_uid():
+    return "2.25." + str(uuid.uuid4().int)
+
+### Function to build the tags shared by all slices of a series: list of (tag, value as string)
+###   The SOP Instance UID tag holds the UID root of the instances of the series (instance_uid)
+def series_tags(tags_to_write, series_number):
+    tags = [(tag, str(value)) for tag, value in tags_to_write if tag != SOP_INSTANCE_UID_TAG]
+    tags.append((SOP_INSTANCE_UID_TAG, generate_uid())) # SOP Instance UID root
+    tags.append(("0008|0012", time.strftime("%Y%m%d"))) # Instance Creation Date
+    tags.append(("0008|0013", time.strftime("%H%M%S"))) # Instance Creation Time
+    tags.append(("0020|0011", str(series_number))) # Series Number - default 901
+    return tags
+
+### Function to get the SOP Instance UID of instance i of a series (series_tags)
+def instance_uid(tags, i):
+    return dict(tags)[SOP_INSTANCE_UID_TAG] + "." + str(i)
+
+### Function to get the dicom writer of this process for a compression (None: uncompressed)
+def get_writer(compression=None):
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown dicom compression: ' + str(compression))
+    if compression not in _writers:
+        writer = sitk.ImageFileWriter()
+        writer.KeepOriginalImageUIDOn()
+        if compression is not None and compression not in PYDICOM_COMPRESSIONS:
+            writer.SetUseCompression(True)
+            writer.SetCompressor(compression)
+        _writers[compression] = writer
+    return _writers[compression]
+
+### Function to write an image as a dicom file with the writer of a compression (get_writer)
+###   Compressions of pydicom (PYDICOM_COMPRESSIONS) are applied to the file written uncompressed by GDCM
+def write_file(path, image, compression=None):
+    writer = get_writer(compression)
+    writer.SetFileName(path)
+    writer.Execute(image)
+    if compression in PYDICOM_COMPRESSIONS:
+        ds = pydicom.dcmread(path)
+        uid = ds.SOPInstanceUID
+        ds.compress(PYDICOM_COMPRESSIONS[compression])
+        # Keep the instance UID of the series (pydicom >= 3 generates a new one)
+        ds.SOPInstanceUID = uid
+        ds.file_meta.MediaStorageSOPInstanceUID = uid
+        ds.save_as(path)
+
+### Function to write slice i of a 3D image as a dicom file (outdir/i.dcm)
+def write_slice(outdir, tags, new_img, i, compression=None):
+    image_slice = new_img[:,:,i]
+
+    # Tags shared by the series.
+    for tag, value in tags:
+        image_slice.SetMetaData(tag, value)
+
+    # Slice specific tags.
+    # (0020, 0032) image position patient determines the 3D spacing between slices.
+    image_slice.SetMetaData("0020|0032", '\\'.join(map(str,new_img.TransformIndexToPhysicalPoint((0,0,i))))) # Image Position (Patient)
+    image_slice.SetMetaData("0020|0013", str(i)) # Instance Number
+    image_slice.SetMetaData(SOP_INSTANCE_UID_TAG, instance_uid(tags, i)) # SOP Instance UID
+
+    # Write to the output directory and add the extension dcm, to force writing in DICOM format.
+    write_file(os.path.join(outdir,str(i)+'.dcm'), image_slice, compression)
+
+def _write_slices_task(task):
+    start, stop = task
+    for i in range(start, stop):
+        write_slice(_series['outdir'], _series['tags'], _series['image'], i, _series['compression'])
+
+### Function to write all slices of a 3D image as a dicom series
+###   tags: shared tags of the series (series_tags), workers: number of writer processes (1: in this process)
+###   compression: lossless compression of the slices (COMPRESSIONS)
+def write_series(outdir, tags, new_img, workers=1, compression=None):
+    get_writer(compression)
+    depth = new_img.GetDepth()
+    workers = max(1, min(workers, depth))
+    if workers == 1:
+        for i in range(depth):
+            write_slice(outdir, tags, new_img, i, compression)
+        return
+
+    # Contiguous blocks of slices, a few per worker to balance the load
+    nblocks = min(depth, 4*workers)
+    bounds = [depth*b//nblocks for b in range(nblocks + 1)]
+    _series.update({'outdir':outdir, 'tags':tags, 'image':new_img, 'compression':compression})
+    try:
+        with get_context('fork').Pool(workers) as pool:
+            pool.map(_write_slices_task, list(zip(bounds[:-1], bounds[1:])))
+    finally:
+        _series.clear()
+
+### Function to write a 3D image as one multi-frame dicom instance (outdir/multiframe.dcm)
+###   The tags are set on new_img. compression: lossless compression of the frames (COMPRESSIONS)
+def write_multiframe(outdir, tags, new_img, compression=None):
+    get_writer(compression)
+
+    # Tags shared by the series.
+    for tag, value in tags:
+        new_img.SetMetaData(tag, value)
+
+    # Instance tags.
+    new_img.SetMetaData("0008|0016", MULTIFRAME_SOP_CLASS_UID) # SOP Class UID
+    new_img.SetMetaData("0020|0013", "1") # Instance Number
+    new_img.SetMetaData(SOP_INSTANCE_UID_TAG, instance_uid(tags, 1)) # SOP Instance UID
+
+    write_file(os.path.join(outdir,'multiframe.dcm'), new_img, compression)
+
+### Function to write a 3D image in an output mode (OUTPUT_MODES): dicom series of slices or multi-frame instance
+def write_dicom(outdir, tags, new_img, mode='slices', workers=1, compression=None):
+    if mode == 'slices':
+        write_series(outdir, tags, new_img, workers, compression)
+    elif mode == 'multiframe':
+        write_multiframe(outdir, tags, new_img, compression)
+    else:
+        raise ValueError('Unknown dicom output mode: ' + str(mode))
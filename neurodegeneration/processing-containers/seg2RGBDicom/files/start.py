@@ -1,10 +1,15 @@
  #!/usr/bin/env python
 
 import SimpleITK as sitk
-import sys, os, glob, json, time, csv
+import sys, os, glob, time, csv
 from datetime import datetime
 import numpy as np
 
+import dicomwriter
+import dcmjson
+import imageformat
+from cpuquota import pool_workers
+
 # For local testng
 # os.environ["WORKFLOW_DIR"] = "/sharedFolder/F1" #"<your data directory>"
 # os.environ["BATCH_NAME"] = "batch"
@@ -24,6 +29,9 @@ user_specified_series_number = os.environ["SERIES_NUM"] #Default Series Number:
 user_specified_series_description = os.environ["SERIES_DESC"] #Default Series Description: "Segmentation Overlay"
 user_specified_opacity = float(os.environ["OPACITY"]) #Default opacity: 0.5
 user_specified_color_scheme = os.environ["COLOR_SCHEME"] #Path to color scheme file
+user_specified_write_workers = pool_workers(int(os.environ.get("WRITE_WORKERS", "1"))) #Processes writing the dicom slices, default: 1 (0: all cores available to the container), capped by its CPU quota
+user_specified_output_mode = os.environ.get("OUTPUT_MODE", "slices") #Default: one dicom file per slice, "multiframe": one multi-frame file
+user_specified_compression = None if os.environ.get("COMPRESSION", "None") == "None" else os.environ["COMPRESSION"] #Lossless compression: "JPEG", "JPEG2000" or "RLE", default: None
 
 def writeimage(image, output_file_path):
     writer = sitk.ImageFileWriter()
@@ -57,138 +65,100 @@ def read_color_scheme(csv_path):
     return cdict
 
 def do_overlay(image, segmentation, color_dict,opacity=0.5):
-    nda_mask = sitk.GetArrayFromImage(segmentation)
-    nda_img = sitk.GetArrayFromImage(image)
-    new_img = np.copy(nda_img)
-    new_img2 = np.zeros([new_img.shape[0],new_img.shape[1],new_img.shape[2],3])
-    new_img2[:,:,:,0] = new_img
-    new_img2[:,:,:,1] = new_img
-    new_img2[:,:,:,2] = new_img
-
-    for k in color_dict:
-        new_img2[nda_mask == k] += opacity * np.array(hex_to_rgb(color_dict[k]))
-
-    rgb_img = sitk.GetImageFromArray(new_img2)
-    rgb_img.CopyInformation(segmentation)
-
-    rgb_img_rescaled = sitk.RescaleIntensity(rgb_img)
-    result_img = sitk.Cast(rgb_img_rescaled,sitk.sitkVectorUInt8)
+    # The overlay value of a voxel only depends on its (label, gray value) pair: gray + opacity * label color, each
+    # channel rescaled to 0-255 over the volume (RescaleIntensity) and cast to uint8.
+    # The uint8 RGB value of every pair is computed once in a lookup table, then the voxels are mapped in one pass.
+    nda_mask = sitk.GetArrayViewFromImage(segmentation)
+    nda_img = sitk.GetArrayViewFromImage(image)
+    if not np.issubdtype(nda_mask.dtype, np.integer):
+        # label maps stored as floats
+        nda_mask = nda_mask.astype(np.int64)
+
+    # gray value -> index (the reference image is rescaled to uint8 before the overlay)
+    if nda_img.dtype == np.uint8:
+        gray_values, gray_index = np.arange(256), nda_img
+    else:
+        gray_values, gray_index = np.unique(nda_img, return_inverse=True)
+        gray_index = gray_index.reshape(nda_img.shape)
+    ngray = len(gray_values)
+
+    # label -> index of its color in the table (0: labels without color)
+    labels = [k for k in color_dict]
+    colors = np.zeros([len(labels) + 1, 3])
+    colors[1:] = [hex_to_rgb(color_dict[k]) for k in labels]
+    low = min(int(nda_mask.min()), 0)
+    label_lut = np.zeros(int(nda_mask.max()) - low + 1, dtype=np.min_scalar_type(len(colors) * ngray - 1))
+    for i, k in enumerate(labels):
+        if low <= k <= int(nda_mask.max()):
+            label_lut[k - low] = (i + 1) * ngray
+
+    # (label, gray value) pair of each voxel, and pairs present in the volume
+    pairs = label_lut[nda_mask - low if low < 0 else nda_mask] + gray_index
+    present = np.zeros(len(colors) * ngray, dtype=bool)
+    for z in range(0, pairs.shape[0], 16):
+        present |= np.bincount(pairs[z:z + 16].ravel(), minlength=len(present)) > 0
+
+    # Blended value of each pair, rescaled per channel over the pairs present (same arithmetic as RescaleIntensity)
+    blend = (gray_values[None, :, None].astype(np.float64) + opacity * colors[:, None, :]).reshape(-1, 3)
+    blend_min = blend[present].min(axis=0)
+    blend_max = blend[present].max(axis=0)
+    # constant channel: scale 0 and shift to the output minimum
+    span = blend_max - blend_min
+    scale = np.divide(255.0 - 0.0, span, out=np.zeros_like(span), where=span != 0)
+    shift = np.where(span != 0, 0.0 - blend_min * scale, 0.0)
+    rgb_lut = np.clip(blend * scale + shift, 0, 255).astype(np.uint8)
+
+    result_img = sitk.GetImageFromArray(rgb_lut[pairs], isVector=True)
+    result_img.CopyInformation(segmentation)
     return result_img
 
+# Tags copied from the metadata json of the reference image: (keyword in the json, dicom tag) #
+json_tags_to_copy = [('PatientID', "0010|0020"), # Patient ID
+                     ('PatientName', "0010|0010"), # Patient Name
+                     ('PatientSex', "0010|0040"), # Patient Sex
+                     ('PatientAge', "0010|1010"), # Patient age
+                     ('PatientSize', "0010|1020"), # Patient size
+                     ('PatientWeight', "0010|1030"), # Patient wt
+                     ('StudyInstanceUID', "0020|000D"), # Study Instance UID, for machine consumption
+                     ('StudyID', "0020|0010"), # Study ID, for human consumption
+                     ('StudyDate', "0008|0020"), # Study Date
+                     ('StudyTime', "0008|0030")] # Study Time
+
 def get_dicom_tags_from_json(dcm_json_file):
-    with open(dcm_json_file, 'r') as json_file:
-        data = json.load(json_file)
-
-        print("reading dicom metadata from json")
-        tags_to_copy = []
-
-        # identify relevant tags from the original meta-data dictionary of input image
-        ####patient specific tags########
-        patient_id = next((value for key, value in data.items() if 'PatientID' in key),None)
-        print("patient id: ", patient_id)
-        if(patient_id != None):
-            tags_to_copy.append(("0010|0020", patient_id))# Patient ID
-
-        patient_name = next((value for key, value in data.items() if 'PatientName' in key),None)
-        print("patient name: ", patient_name)
-        if(patient_name != None):
-            tags_to_copy.append(("0010|0010", patient_name))# Patient Name
-
-        patient_sex = next((value for key, value in data.items() if 'PatientSex' in key),None)
-        print("patient sex: ", patient_sex)
-        if(patient_sex != None):
-            tags_to_copy.append(("0010|0040", patient_sex))# Patient Sex
-
-        patient_age = [value for key, value in data.items() if 'PatientAge' in key][0]
-        print("patient age: ", patient_age)
-        if(patient_age != None):
-            tags_to_copy.append(("0010|1010", patient_age))# Patient age
-
-        patient_size = next((value for key, value in data.items() if 'PatientSize' in key),None)
-        print("patient size: ", patient_size)
-        if(patient_size != None):
-            tags_to_copy.append(("0010|1020", patient_size))# Patient size
-
-        patient_wt = next((value for key, value in data.items() if 'PatientWeight' in key),None)
-        print("patient wt: ", patient_wt)
-        if(patient_wt != None):
-            tags_to_copy.append(("0010|1030", patient_wt))# Patient wt
-
-        #####study specific tags#####
-        study_uid = next((value for key, value in data.items() if 'StudyInstanceUID' in key),None)
-        print("study uid ", study_uid)
-        if(study_uid != None):
-            tags_to_copy.append(("0020|000D", study_uid))# Study Instance UID, for machine consumption
-
-        study_id = next((value for key, value in data.items() if 'StudyID' in key),None)
-        print("study id ", study_id)
-        if(study_id != None):
-            tags_to_copy.append(("0020|0010", study_id))# Study ID, for human consumption
-
-        study_date = next((value for key, value in data.items() if 'StudyDate' in key),None)
-        print("study date ", study_date)
-        if(study_date != None):
-            tags_to_copy.append(("0008|0020", study_date))# Study Date
-
-        study_time = next((value for key, value in data.items() if 'StudyTime' in key),None)
-        print("study time ", study_time)
-        if(study_time != None):
-            tags_to_copy.append(("0008|0030", study_time))# Study Time
-
-        #####other tags####
-        #use modality specified by user(think multi-modality pipeline) otherwise use the one from reference image
-        if(user_specified_modality == "None"):
-            modality = next((value for key, value in data.items() if 'Modality' in key),None)
-        else:
-            modality = user_specified_modality
-        print("modality ", modality)
-        if(study_time != None):
-            tags_to_copy.append(("0008|0060", modality))  # Modality
-
-        #accession number
-        possible_accession_number_values = [value for key, value in data.items() if 'AccessionNumber' in key]
-        if len(possible_accession_number_values) == 0:
-            attribute_sequence = [value for key, value in data.items() if 'RequestAttributesSequence_object_object' in key][0]
-            possible_accession_number_values = [value for key, value in attribute_sequence.items() if 'AccessionNumber' in key]
-            if len(possible_accession_number_values) == 0:
-                print("accession number not found")
-                accession_number_found = False
-            else:
-                accession_number_found = True
-                accession_number = possible_accession_number_values[0]
-        else:
-            accession_number_found = True
-            accession_number = possible_accession_number_values[0]
-
-        # print('accession_number: ', accession_number)
-
-        if(accession_number_found):
-            tags_to_copy.append(("0008|0050", accession_number)) #AccessionNumber
+    # the json is read once into an index (keyword -> values), up to the last tag needed
+    names = [keyword for keyword, tag in json_tags_to_copy] + ['Modality', 'AccessionNumber', 'RequestAttributesSequence.AccessionNumber']
+    data = dcmjson.readDicomJson(dcm_json_file, names)
+
+    print("reading dicom metadata from json")
+    tags_to_copy = []
+
+    # identify relevant tags from the original meta-data dictionary of input image
+    ####patient and study specific tags########
+    for keyword, tag in json_tags_to_copy:
+        value = dcmjson.getDicomValue(data, keyword)
+        print(keyword + ": ", value)
+        if(value != None):
+            tags_to_copy.append((tag, value))
+
+    #####other tags####
+    #use modality specified by user(think multi-modality pipeline) otherwise use the one from reference image
+    if(user_specified_modality == "None"):
+        modality = dcmjson.getDicomValue(data, 'Modality')
+    else:
+        modality = user_specified_modality
+    print("modality ", modality)
+    if(modality != None):
+        tags_to_copy.append(("0008|0060", modality))  # Modality
+
+    #accession number, in the request attributes sequence if not at the top level
+    accession_number = dcmjson.getDicomValue(data, 'AccessionNumber', dcmjson.getDicomValue(data, 'RequestAttributesSequence.AccessionNumber'))
+    if(accession_number != None):
+        tags_to_copy.append(("0008|0050", accession_number)) #AccessionNumber
+    else:
+        print("accession number not found")
 
     return tags_to_copy
 
-def write_dicom_slices(outdir, tags_to_write, new_img, i):
-    image_slice = new_img[:,:,i]
-
-    # Tags shared by the series.
-    list(map(lambda tag_value: image_slice.SetMetaData(tag_value[0], str(tag_value[1])), tags_to_write))
-
-    # Slice specific tags.
-    image_slice.SetMetaData("0008|0012", time.strftime("%Y%m%d")) # Instance Creation Date
-    image_slice.SetMetaData("0008|0013", time.strftime("%H%M%S")) # Instance Creation Time
-
-    #Setting the type to CT preserves the slice location.
-    #image_slice.SetMetaData("0008|0060", "MR")  # set the type to CT so the thickness is carried over
-
-    # (0020, 0032) image position patient determines the 3D spacing between slices.
-    image_slice.SetMetaData("0020|0032", '\\'.join(map(str,new_img.TransformIndexToPhysicalPoint((0,0,i))))) # Image Position (Patient)
-    image_slice.SetMetaData("0020|0013", str(i)) # Instance Number
-    image_slice.SetMetaData("0020|0011", str(user_specified_series_number)) # Series Number - default 901
-
-    # Write to the output directory and add the extension dcm, to force writing in DICOM format.
-    writer.SetFileName(os.path.join(outdir,str(i)+'.dcm'))
-    writer.Execute(image_slice)
-
 batch_folders = [f for f in glob.glob(os.path.join('/', os.environ['WORKFLOW_DIR'], os.environ['BATCH_NAME'], '*'))]
 print('batch_folders: ',batch_folders)
 
@@ -197,13 +167,13 @@ for batch_element_dir in batch_folders:
     if "None" not in os.environ["OPERATOR_IN_REFERENCE_IMAGE_DIR"]:
         print("Reference image folder provided")
         ref_image_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_REFERENCE_IMAGE_DIR'])
-        ref_image_file = sorted(glob.glob(os.path.join(ref_image_input_dir, "*.nii.gz"), recursive=True)) or sorted(glob.glob(os.path.join(ref_image_input_dir, "*.nrrd"), recursive=True))
+        ref_image_file = imageformat.find_images(ref_image_input_dir)
         print(ref_image_file)
 
     if "None" not in os.environ["OPERATOR_IN_MASK_DIR"]:
         print("mask image folder provided")
         mask_image_input_dir = os.path.join(batch_element_dir, os.environ['OPERATOR_IN_MASK_DIR'])
-        mask_image_file = sorted(glob.glob(os.path.join(mask_image_input_dir, "*.nrrd"), recursive=True)) or sorted(glob.glob(os.path.join(mask_image_input_dir, "*.nii.gz"), recursive=True))
+        mask_image_file = imageformat.find_images(mask_image_input_dir, ['.nrrd', '.nii.gz', '.nii'])
         print(mask_image_file)
 
     if "None" not in os.environ["OPERATOR_IN_DCM_JSON_DIR"]:
@@ -235,10 +205,6 @@ for batch_element_dir in batch_folders:
         overlaid_img = do_overlay(img_255,mask,cDict,user_specified_opacity)
         print("Label Overlay Done")
 
-        #dicom creation
-        writer = sitk.ImageFileWriter()
-        writer.KeepOriginalImageUIDOn()
-
         #create new dicom tags for our dicom file
         modification_time = time.strftime("%H%M%S")
         modification_date = time.strftime("%Y%m%d")
@@ -259,6 +225,6 @@ for batch_element_dir in batch_folders:
         if not os.path.exists(element_output_dir):
             os.makedirs(element_output_dir)
 
-        #write dicom images
-        list(map(lambda i: write_dicom_slices(element_output_dir,tags_to_write, overlaid_img, i), range(overlaid_img.GetDepth())))
+        #write dicom images (slices or multi-frame), the shared tags are built once for the series
+        dicomwriter.write_dicom(element_output_dir, dicomwriter.series_tags(tags_to_write, user_specified_series_number), overlaid_img, user_specified_output_mode, user_specified_write_workers, user_specified_compression)
         print("dicom rgb overlay written")
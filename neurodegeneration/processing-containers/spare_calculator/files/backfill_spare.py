@@ -0,0 +1,20 @@
+import sys
+import pandas as pd
+import spare_calculator
+
+# Calculates SPARE-AD and SPARE-BA for many subjects at once with the linear scorers
+#   Input csv has one row per subject with Age, Sex (F/M or 0/1) and the ROI columns of the reference values
+#   The SPARE_AD and SPARE_BA columns are added (or replaced) in the output csv
+#   Usage: python3 backfill_spare.py [input csv] [output csv]
+
+if len(sys.argv) < 3:
+    print("Usage: python3 backfill_spare.py [input csv] [output csv]")
+    exit(1)
+
+df = pd.read_csv(sys.argv[1])
+print("Scoring " + str(df.shape[0]) + " subjects")
+dfSpare = spare_calculator.calculateSpareBatch(df)
+df['SPARE_AD'] = dfSpare['SPARE_AD']
+df['SPARE_BA'] = dfSpare['SPARE_BA']
+df.to_csv(sys.argv[2], index=False)
+print("SPARE scores written to " + sys.argv[2])
@@ -0,0 +1,14 @@
+import os
+import spare_calculator
+
+# Trains the SPARE-AD and SPARE-BA models on the reference values and stores them (and their linear scorers) in /models
+#   Run at image build time, after the reference store is built
+
+if not os.path.exists(spare_calculator.refstore.MUSE_Ref_Values):
+    print("Reference values not found, skipping SPARE models (they will be trained on first use)")
+    exit(0)
+
+for name in spare_calculator.SPARE_TRAINERS.keys():
+    spare_calculator.loadSpareModel(name)
+    spare_calculator.loadLinearSpare(name)
+    print(name + " model and linear scorer stored in " + spare_calculator.SPARE_Model_Dir)
@@ -0,0 +1,51 @@
+import sys, os
+import time
+import numpy as np
+import spare_calculator
+
+# Parity check of the linear SPARE scorers against the trained sklearn models
+#   Scores the reference values with decision_function (SPARE-AD) / predict (SPARE-BA)
+#   and with scoreLinearSpare, and asserts that they differ by at most the tolerance
+#   Run at image build time, after the models are built, so that the build fails on a mismatch
+#   Usage: python3 check_spare_linear.py [tolerance]
+
+### Function to score the reference values with the sklearn model and with the linear scorer: (expected, scores)
+def scoreBoth(name, dfRef):
+    spareModel = spare_calculator.loadSpareModel(name)
+    linearModel = spare_calculator.loadLinearSpare(name)
+    X = spare_calculator.makeSpareMatrix(linearModel, dfRef)
+
+    start = time.perf_counter()
+    X_sc = spareModel['scaler'].transform(dfRef.assign(Sex=dfRef['Sex'].cat.codes)[spareModel['columns']].astype(np.float64))
+    if name == 'spareAD':
+        expected = spareModel['model'].decision_function(X_sc)
+    else:
+        expected = spareModel['model'].predict(X_sc)
+    sklearnTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = spare_calculator.scoreLinearSpare(linearModel, X)
+    linearTime = time.perf_counter() - start
+
+    print(f'{name}: {X.shape[0]} subjects, sklearn {sklearnTime*1000:.1f} ms, linear {linearTime*1000:.1f} ms')
+    return expected, scores
+
+### Function to check that the linear scorer of a model matches it
+def checkSpareLinear(name, dfRef, tolerance):
+    expected, scores = scoreBoth(name, dfRef)
+    assert scores.shape == expected.shape, name + ': ' + str(scores.shape) + ' scores for ' + str(expected.shape) + ' subjects'
+    maxDiff = np.max(np.abs(scores - expected))
+    print(f'{name}: max abs difference {maxDiff:.3e}')
+    assert maxDiff <= tolerance, f'{name}: linear scorer differs from the trained model by {maxDiff:.3e} (tolerance {tolerance:.1e})'
+
+if __name__ == '__main__':
+    tolerance = float(sys.argv[1]) if len(sys.argv) > 1 else 1e-8
+
+    if not os.path.exists(spare_calculator.refstore.MUSE_Ref_Values):
+        print("Reference values not found, skipping the SPARE parity check")
+        exit(0)
+
+    dfRef = spare_calculator.refstore.loadRef(spare_calculator.refstore.MUSE_Ref_Values, 'all').dropna()
+    for name in spare_calculator.SPARE_TRAINERS.keys():
+        checkSpareLinear(name, dfRef, tolerance)
+    print("Linear scorers match the trained models")
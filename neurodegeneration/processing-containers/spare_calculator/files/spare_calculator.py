@@ -10,57 +10,43 @@ from sklearn.model_selection import KFold
 from sklearn.metrics import confusion_matrix
 
 import pickle
+from joblib import dump, load
 
 import os as _os
+import refstore
 
-### Function to train and test model to calculate SPARE-AD score for subject
-def calculateSpareAD(age,sex,test):
-	# Read in reference values
-	MUSE_Ref_Values = pd.read_csv('/refs/combinedharmonized_out.csv')
+#### Trained SPARE models ###
+# Models are trained once on the reference values and stored here, keyed by a hash of the reference csv #
+SPARE_Model_Dir = '/models'
+# Bump when the features or settings of the SPARE models change #
+SPARE_MODEL_VERSION = 1
+
+# Models loaded in this process #
+_spareModels = {}
+
+### Function to train SPARE-AD model (scaler + linear SVC) on the reference values
+def trainSpareAD():
+	# Read in reference values (all timepoints, sorted by date)
+	MUSE_Ref_Values = refstore.loadRef(refstore.MUSE_Ref_Values, 'all')
 	MUSE_Ref_Values.drop('SPARE_AD',axis=1,inplace=True)
-	# Select first timepoint only
-	MUSE_Ref_Values['Date'] = pd.to_datetime(MUSE_Ref_Values.Date)
-	MUSE_Ref_Values = MUSE_Ref_Values.sort_values(by='Date')
-	MUSE_Ref_Values_hc = MUSE_Ref_Values.drop_duplicates(subset=['PTID'], keep='first')
-	# Drop NA values
-	MUSE_Ref_Values_pt = MUSE_Ref_Values[~MUSE_Ref_Values.isin(MUSE_Ref_Values_hc)].dropna()
+	# Sex back to binary variable (F: 0, M: 1)
+	MUSE_Ref_Values['Sex'] = MUSE_Ref_Values['Sex'].cat.codes
 
 	MUSE_Ref_Values = MUSE_Ref_Values.drop(['MRID','Study','PTID','SITE','Date', 'SPARE_BA'], axis=1, inplace=False)
-
-	# Make dataframe from patient's age, sex, and ROI dictionaries
-	test = pd.DataFrame(test, index=[0])
-	test.drop('702',axis=1,inplace=True)
 	MUSE_Ref_Values.drop('702',axis=1,inplace=True)
-	test['Age'] = age
-	if sex == "F":
-		test['Sex'] = 0
-	else:
-		test['Sex'] = 1
-
-	# Order test data's columns to those of the reference data
-	MUSE_Ref_Values_tmp = MUSE_Ref_Values.drop('Diagnosis_nearest_2.0',axis=1,inplace=False)
-	test = test[MUSE_Ref_Values_tmp.columns]
 
 	MUSE_Ref_Values = MUSE_Ref_Values.loc[(MUSE_Ref_Values['Diagnosis_nearest_2.0'] == "CN") | (MUSE_Ref_Values['Diagnosis_nearest_2.0'] == "AD")]
-	MUSE_Ref_Values["Diagnosis_nearest_2.0"].replace({"CN": 0, "AD": 1}, inplace=True)
-
-	### Make numpy arrays of zeros to store results for the classifier ###
-	distances_MUSE_Ref_Values = np.zeros( 1 )
-	predictions_MUSE_Ref_Values = np.zeros( 1 )
+	MUSE_Ref_Values["Diagnosis_nearest_2.0"] = (MUSE_Ref_Values["Diagnosis_nearest_2.0"] == "AD").astype(int)
 
 	### Get data to be used in classification analysis ###
 	# Training data
 	X_train_MUSE_Ref_Values = MUSE_Ref_Values.loc[:,MUSE_Ref_Values.columns != "Diagnosis_nearest_2.0"]
 	Y_train_MUSE_Ref_Values = MUSE_Ref_Values.loc[:,"Diagnosis_nearest_2.0"].values
 
-	#Testing data
-	X_test = test.loc[:,test.columns]
-
-	### Actual train + testing ###
+	### Actual training ###
 	# scale features
 	scaler_MUSE_Ref_Values = preprocessing.MinMaxScaler( feature_range=(0,1) ).fit( X_train_MUSE_Ref_Values )
 	X_train_MUSE_Ref_Values_norm_sc = scaler_MUSE_Ref_Values.transform( X_train_MUSE_Ref_Values )
-	X_test_MUSE_Ref_Values_norm_sc = scaler_MUSE_Ref_Values.transform( X_test )
 
 	# load classifers
 	svc_MUSE_Ref_Values = svm.SVC( probability=True, kernel='linear', C=1 );
@@ -68,47 +54,17 @@ def calculateSpareAD(age,sex,test):
 	# fit classifers
 	svc_MUSE_Ref_Values.fit( X_train_MUSE_Ref_Values_norm_sc, Y_train_MUSE_Ref_Values )
 
-	# Save newly trained svc model
-	#dump(svc_MUSE_Ref_Values, '/data/spareAD.joblib')
-
-	# Load trained reference model
-	#svc_MUSE_Ref_Values = load('/models/spareAD.joblib') 
+	return {'columns':list(X_train_MUSE_Ref_Values.columns), 'scaler':scaler_MUSE_Ref_Values, 'model':svc_MUSE_Ref_Values}
 
-	# get distance and predictions for the test subject
-	distances_MUSE_Ref_Values = svc_MUSE_Ref_Values.decision_function( X_test_MUSE_Ref_Values_norm_sc )
-	predictions_MUSE_Ref_Values = svc_MUSE_Ref_Values.predict( X_test_MUSE_Ref_Values_norm_sc )
-
-	return distances_MUSE_Ref_Values
-
-def calculateSpareBA(age,sex,test):
-	# Read in reference values
-	MUSE_Ref_Values = pd.read_csv('/refs/combinedharmonized_out.csv')
-	# Select first timepoint only
-	MUSE_Ref_Values['Date'] = pd.to_datetime(MUSE_Ref_Values.Date)
-	MUSE_Ref_Values = MUSE_Ref_Values.sort_values(by='Date')
-	MUSE_Ref_Values_hc = MUSE_Ref_Values.drop_duplicates(subset=['PTID'], keep='first')
-	# Drop NA values
-	MUSE_Ref_Values_pt = MUSE_Ref_Values[~MUSE_Ref_Values.isin(MUSE_Ref_Values_hc)].dropna()
+### Function to train SPARE-BA model (scaler + linear SVR) on the reference values
+def trainSpareBA():
+	# Read in reference values (all timepoints, sorted by date)
+	MUSE_Ref_Values = refstore.loadRef(refstore.MUSE_Ref_Values, 'all')
+	# Sex back to binary variable (F: 0, M: 1)
+	MUSE_Ref_Values['Sex'] = MUSE_Ref_Values['Sex'].cat.codes
 
 	MUSE_Ref_Values = MUSE_Ref_Values.drop(['MRID','Study','PTID','SITE','Date', 'SPARE_AD', 'Diagnosis_nearest_2.0'], axis=1, inplace=False)
-
-	# Make dataframe from patient's age, sex, and ROI dictionaries
-	test = pd.DataFrame(test, index=[0])
-	test.drop('702',axis=1,inplace=True)
 	MUSE_Ref_Values.drop('702',axis=1,inplace=True)
-	test['Age'] = age
-	if sex == "F":
-		test['Sex'] = 0
-	else:
-		test['Sex'] = 1
-
-	# Order test data's columns to those of the reference data
-	MUSE_Ref_Values_tmp = MUSE_Ref_Values.drop('SPARE_BA',axis=1,inplace=False)
-	test = test[MUSE_Ref_Values_tmp.columns]
-
-	### Make numpy arrays of zeros to store results for the classifier ###
-	distances_MUSE_Ref_Values = np.zeros( 1 )
-	predictions_MUSE_Ref_Values = np.zeros( 1 )
 
 	### Drop subjects w/o SPARE-BA
 	MUSE_Ref_Values = MUSE_Ref_Values.dropna(subset=['SPARE_BA'])
@@ -118,14 +74,10 @@ def calculateSpareBA(age,sex,test):
 	X_train_MUSE_Ref_Values = MUSE_Ref_Values.loc[:,MUSE_Ref_Values.columns != "SPARE_BA"]
 	Y_train_MUSE_Ref_Values = MUSE_Ref_Values.loc[:,"SPARE_BA"].values
 
-	#Testing data
-	X_test = test.loc[:,test.columns]
-
-	### Actual train + testing ###
+	### Actual training ###
 	# scale features
 	scaler_MUSE_Ref_Values = preprocessing.MinMaxScaler( feature_range=(0,1) ).fit( X_train_MUSE_Ref_Values )
 	X_train_MUSE_Ref_Values_norm_sc = scaler_MUSE_Ref_Values.transform( X_train_MUSE_Ref_Values )
-	X_test_MUSE_Ref_Values_norm_sc = scaler_MUSE_Ref_Values.transform( X_test )
 
 	# load classifers
 	svr_MUSE_Ref_Values = svm.SVR( kernel='linear', C=1 );
@@ -133,17 +85,133 @@ def calculateSpareBA(age,sex,test):
 	# fit classifers
 	svr_MUSE_Ref_Values.fit( X_train_MUSE_Ref_Values_norm_sc, Y_train_MUSE_Ref_Values )
 
-	# Save newly trained svc model
-	#dump(svr_MUSE_Ref_Values, '/data/spareBA.joblib')
+	return {'columns':list(X_train_MUSE_Ref_Values.columns), 'scaler':scaler_MUSE_Ref_Values, 'model':svr_MUSE_Ref_Values}
+
+SPARE_TRAINERS = {'spareAD':trainSpareAD, 'spareBA':trainSpareBA}
 
-	# Load trained reference model
-	#svr_MUSE_Ref_Values = load('/models/spareBA.joblib') 
+### Function to get the path of a stored SPARE model for the current reference values
+def spareModelPath(name):
+	refHash = refstore.hashRefFile(refstore.MUSE_Ref_Values)
+	return _os.path.join(SPARE_Model_Dir, name + '_v' + str(SPARE_MODEL_VERSION) + '_' + refHash[:16] + '.joblib')
 
-	# get distance and predictions for the test subject
-	predictions_MUSE_Ref_Values = svr_MUSE_Ref_Values.predict( X_test_MUSE_Ref_Values_norm_sc )
+### Function to load a SPARE model: from this process, from the model store, or trained (and stored) if not found
+def loadSpareModel(name):
+	if name in _spareModels:
+		return _spareModels[name]
+
+	modelPath = spareModelPath(name)
+	if _os.path.exists(modelPath):
+		spareModel = load(modelPath)
+	else:
+		print("No stored " + name + " model for the current reference values, training...")
+		spareModel = SPARE_TRAINERS[name]()
+		try:
+			_os.makedirs(SPARE_Model_Dir, exist_ok=True)
+			dump(spareModel, modelPath)
+		except OSError:
+			print("Could not store " + name + " model in " + SPARE_Model_Dir)
+
+	_spareModels[name] = spareModel
+	return spareModel
+
+### Function to make the (scaled) test features of a subject, ordered as the reference data
+def makeSpareFeatures(spareModel,age,sex,test):
+	# Make dataframe from patient's age, sex, and ROI dictionaries
+	test = pd.DataFrame(test, index=[0])
+	test.drop('702',axis=1,inplace=True)
+	test['Age'] = age
+	if sex == "F":
+		test['Sex'] = 0
+	else:
+		test['Sex'] = 1
+
+	# Order test data's columns to those of the reference data
+	X_test = test[spareModel['columns']]
+
+	return spareModel['scaler'].transform( X_test )
+
+### Function to calculate SPARE-AD score for subject
+def calculateSpareAD(age,sex,test):
+	spareModel = loadSpareModel('spareAD')
+	X_test_MUSE_Ref_Values_norm_sc = makeSpareFeatures(spareModel,age,sex,test)
+
+	# get distance for the test subject
+	distances_MUSE_Ref_Values = spareModel['model'].decision_function( X_test_MUSE_Ref_Values_norm_sc )
+
+	return distances_MUSE_Ref_Values
+
+### Function to calculate SPARE-BA score for subject
+def calculateSpareBA(age,sex,test):
+	spareModel = loadSpareModel('spareBA')
+	X_test_MUSE_Ref_Values_norm_sc = makeSpareFeatures(spareModel,age,sex,test)
+
+	# get predictions for the test subject
+	predictions_MUSE_Ref_Values = spareModel['model'].predict( X_test_MUSE_Ref_Values_norm_sc )
 
 	return predictions_MUSE_Ref_Values
 
+#### Closed-form scoring for the linear SPARE models ###
+# Both models use a linear kernel, so a score is ((X * scale) + min) . coef + intercept
+# Only these vectors are exported, to score many subjects with one matrix product
+
+# Linear scorers loaded in this process #
+_linearSpareModels = {}
+
+### Function to export a trained SPARE model as scaler min/scale and linear coefficient vectors
+def exportLinearSpare(spareModel):
+	return {'columns':np.array(spareModel['columns']),
+		'min':np.asarray(spareModel['scaler'].min_, dtype=np.float64),
+		'scale':np.asarray(spareModel['scaler'].scale_, dtype=np.float64),
+		'coef':np.asarray(spareModel['model'].coef_, dtype=np.float64).ravel(),
+		'intercept':float(np.ravel(spareModel['model'].intercept_)[0])}
+
+### Function to load the linear scorer of a SPARE model (exported from the stored model if not found)
+def loadLinearSpare(name):
+	if name in _linearSpareModels:
+		return _linearSpareModels[name]
+
+	linearPath = spareModelPath(name).replace('.joblib', '_linear.npz')
+	if _os.path.exists(linearPath):
+		with np.load(linearPath) as f:
+			linearModel = {key:f[key] for key in f.files}
+		linearModel['intercept'] = float(linearModel['intercept'])
+	else:
+		linearModel = exportLinearSpare(loadSpareModel(name))
+		try:
+			np.savez(linearPath, **linearModel)
+		except OSError:
+			print("Could not store " + name + " linear scorer in " + SPARE_Model_Dir)
+
+	_linearSpareModels[name] = linearModel
+	return linearModel
+
+### Function to make the (N subjects x features) matrix of a linear scorer from a dataframe
+###   dfSubjects has Age, Sex (F/M or 0/1) and the ROI columns of the reference values
+def makeSpareMatrix(linearModel, dfSubjects):
+	dfSubjects = dfSubjects.copy()
+	dfSubjects.columns = dfSubjects.columns.astype(str)
+	if not pd.api.types.is_numeric_dtype(dfSubjects['Sex']):
+		dfSubjects['Sex'] = dfSubjects['Sex'].map({'F':0, 'M':1})
+
+	return dfSubjects[list(linearModel['columns'])].values.astype(np.float64)
+
+### Function to score an (N subjects x features) matrix with a linear scorer
+def scoreLinearSpare(linearModel, X):
+	# Fold the scaling into the coefficients: X . (scale * coef) + (min . coef + intercept)
+	weights = linearModel['scale'] * linearModel['coef']
+	offset = np.dot(linearModel['min'], linearModel['coef']) + linearModel['intercept']
+
+	return np.asarray(X, dtype=np.float64).dot(weights) + offset
+
+### Function to calculate SPARE-AD and SPARE-BA scores for many subjects at once
+def calculateSpareBatch(dfSubjects):
+	dfSpare = pd.DataFrame(index=dfSubjects.index)
+	for name, col in [('spareAD','SPARE_AD'), ('spareBA','SPARE_BA')]:
+		linearModel = loadLinearSpare(name)
+		dfSpare[col] = scoreLinearSpare(linearModel, makeSpareMatrix(linearModel, dfSubjects))
+
+	return dfSpare
+
 # Main function that decides order in which functions run in this script
 def _main(dfSub,all_MuseROIs_num,out_path):
 	UID = _os.path.basename(out_path.removesuffix(".pdf"))